@@ -0,0 +1,283 @@
+import json
+import math
+import os
+import shutil
+import time
+import uuid
+from typing import Any, Callable, Iterable, Optional
+
+import numpy as np
+
+from local_search import DEFAULT_OVERSAMPLING, LocalVectorIndex, dequantize, normalize, precision_of, quantize, quantized_scores, top_k
+
+_SNAPSHOTS = "snapshots"
+_CURRENT = "CURRENT"
+
+def snapshot_path(directory: str) -> Optional[str]:
+    """The directory holding the files of the snapshot IVFIndex.save() last wrote to directory, None if there is none."""
+    try:
+        with open(os.path.join(directory, _CURRENT), "r") as f:
+            return os.path.join(directory, _SNAPSHOTS, f.read().strip())
+    except FileNotFoundError:
+        # Written before snapshots were versioned
+        return directory if os.path.exists(os.path.join(directory, "meta.json")) else None
+
+class IVFIndex:
+    """Inverted-file ANN index: vectors clustered around k-means centroids, stored contiguously per cluster.
+
+    A query only scores the rows of the nprobe clusters whose centroids are closest to it, so the cost grows
+    with n / nlist * nprobe rather than n. Inserts go to a small unclustered tail that is always scored until
+    compact() files them under their nearest centroid; deletes are tombstones. save() writes plain .npy files
+    that load() memory-maps, so workers share the pages and start without reading the matrix.
+
+    The clustered rows can be quantized like LocalVectorIndex's; with full-precision originals kept, the best
+    k * oversampling candidates of the probed clusters are re-scored with them.
+    """
+
+    def __init__(self, centroids: np.ndarray, vectors: np.ndarray, offsets: np.ndarray, documents: list[dict[str, Any]],
+                 deleted: Optional[np.ndarray] = None, nprobe: int = 8, scales: Optional[np.ndarray] = None,
+                 originals: Optional[np.ndarray] = None, oversampling: float = DEFAULT_OVERSAMPLING):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.scales = scales
+        self.originals = originals
+        self.oversampling = oversampling
+        # Rows of cluster c are vectors[offsets[c]:offsets[c + 1]]
+        self.offsets = offsets
+        self.documents = documents
+        self.deleted = deleted if deleted is not None else np.zeros(len(documents), dtype=bool)
+        self.nprobe = nprobe
+        self._pending_vectors: list[np.ndarray] = []
+        self._pending_documents: list[dict[str, Any]] = []
+        self._pending_deleted: list[bool] = []
+        self._rows_by_id = {doc.get("id"): row for row, doc in enumerate(documents)}
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def dimensions(self) -> int:
+        return self.centroids.shape[1]
+
+    @property
+    def precision(self) -> str:
+        return precision_of(self.vectors)
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + self.centroids.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self) -> int:
+        return int(len(self.documents) - self.deleted.sum()) + self._pending_deleted.count(False)
+
+    @staticmethod
+    def build(documents: list[dict[str, Any]], embeddings: Optional[np.ndarray] = None, nlist: Optional[int] = None,
+              iterations: int = 10, precision: str = "float32", nprobe: int = 8, seed: int = 0, rescore: bool = False,
+              oversampling: float = DEFAULT_OVERSAMPLING) -> "IVFIndex":
+        """Clusters documents (with an 'embedding' field unless embeddings are given) with spherical k-means."""
+        if embeddings is None:
+            embeddings = np.array([doc["embedding"] for doc in documents], dtype=np.float32)
+        vectors = normalize(embeddings)
+        documents = [{key: value for key, value in doc.items() if key != "embedding"} for doc in documents]
+        nlist = max(1, min(len(vectors), nlist or int(round(math.sqrt(len(vectors))))))
+
+        rng = np.random.default_rng(seed)
+        # k-means converges about as well on a sample, and the full matrix may not fit next to its copies
+        sample = vectors[rng.choice(len(vectors), size=min(len(vectors), nlist * 256), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[assignment == c]
+                if len(members):
+                    centroids[c] = members.sum(axis=0)
+            centroids = normalize(centroids)
+
+        assignment = IVFIndex._assign(vectors, centroids)
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignment, minlength=nlist))
+        vectors = vectors[order]
+        codes, scales = quantize(vectors, precision)
+        return IVFIndex(centroids, codes, offsets, [documents[i] for i in order], nprobe=nprobe, scales=scales,
+                        originals=vectors if rescore and precision != "float32" else None, oversampling=oversampling)
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray, batch: int = 4096) -> np.ndarray:
+        return np.concatenate([np.argmax(vectors[i:i + batch] @ centroids.T, axis=1) for i in range(0, len(vectors), batch)]) \
+            if len(vectors) else np.empty(0, dtype=np.int64)
+
+    def insert(self, documents: list[dict[str, Any]], embeddings: Optional[np.ndarray] = None):
+        if embeddings is None:
+            embeddings = np.array([doc["embedding"] for doc in documents], dtype=np.float32)
+        vectors = normalize(embeddings)
+        for doc, vector in zip(documents, vectors):
+            self.delete([doc.get("id")])
+            self._rows_by_id[doc.get("id")] = len(self.documents) + len(self._pending_documents)
+            self._pending_documents.append({key: value for key, value in doc.items() if key != "embedding"})
+            self._pending_vectors.append(vector)
+            self._pending_deleted.append(False)
+
+    def delete(self, ids: Iterable[Any]):
+        for id in ids:
+            row = self._rows_by_id.pop(id, None)
+            if row is None:
+                continue
+            if row < len(self.documents):
+                self.deleted[row] = True
+            else:
+                self._pending_deleted[row - len(self.documents)] = True
+
+    def compact(self):
+        """Files pending inserts under their clusters and drops deleted rows. Centroids are kept as trained."""
+        live = ~self.deleted
+        vectors = [self.as_float32()[live]] + ([np.array(self._pending_vectors)] if self._pending_vectors else [])
+        vectors = np.concatenate(vectors)
+        documents = [doc for doc, dead in zip(self.documents, self.deleted) if not dead]
+        documents += [doc for doc, dead in zip(self._pending_documents, self._pending_deleted) if not dead]
+        if self._pending_vectors:
+            vectors = vectors[np.concatenate([np.ones(live.sum(), dtype=bool), ~np.array(self._pending_deleted)])]
+
+        assignment = self._assign(vectors, self.centroids)
+        order = np.argsort(assignment, kind="stable")
+        self.offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(assignment, minlength=self.nlist))
+        vectors = vectors[order]
+        self.vectors, self.scales = quantize(vectors, self.precision)
+        if self.originals is not None:
+            self.originals = vectors
+        self.documents = [documents[i] for i in order]
+        self.deleted = np.zeros(len(self.documents), dtype=bool)
+        self._pending_vectors, self._pending_documents, self._pending_deleted = [], [], []
+        self._rows_by_id = {doc.get("id"): row for row, doc in enumerate(self.documents)}
+
+    def _probe(self, query: np.ndarray, nprobe: int) -> tuple[np.ndarray, np.ndarray]:
+        rows, scores = [], []
+        for c in np.argsort(-(self.centroids @ query))[:nprobe]:
+            start, end = self.offsets[c], self.offsets[c + 1]
+            if start < end:
+                rows.append(np.arange(start, end))
+                scores.append(quantized_scores(self.vectors[start:end], self.scales[start:end] if self.scales is not None else None, query))
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return np.concatenate(rows), np.concatenate(scores)
+
+    def search(self, embedding: Iterable[float], k: int = 3, where: Optional[Callable[[dict[str, Any]], bool]] = None,
+               nprobe: Optional[int] = None) -> list[dict[str, Any]]:
+        """Approximate top-k by cosine similarity, shaped like LocalVectorIndex.search."""
+        query = normalize(embedding)
+        if query.shape != (self.dimensions,):
+            raise ValueError(f"Query has {query.size} dimensions, the index has {self.dimensions}")
+        nprobe = min(self.nlist, nprobe or self.nprobe)
+
+        pending = np.array(self._pending_vectors) @ query if self._pending_vectors else np.empty(0, dtype=np.float32)
+        pending[np.array(self._pending_deleted, dtype=bool)] = -np.inf
+        while True:
+            rows, scores = self._probe(query, nprobe)
+            scores[self.deleted[rows]] = -np.inf
+            rows = np.concatenate([rows, np.arange(len(self.documents), len(self.documents) + len(pending))])
+            scores = np.concatenate([scores, pending])
+            if where is not None:
+                scores[[i for i, row in enumerate(rows) if scores[i] != -np.inf and not where(self._document(row))]] = -np.inf
+            matches = int(np.count_nonzero(scores != -np.inf))
+            # A selective filter can leave the probed clusters short of k matches, widen the probe until it can't
+            if matches >= k or nprobe >= self.nlist:
+                break
+            nprobe = min(self.nlist, nprobe * 2)
+
+        k = min(k, matches)
+        if self.originals is None:
+            top = top_k(scores, k)
+        else:
+            candidates = top_k(scores, math.ceil(k * self.oversampling))
+            candidates = candidates[scores[candidates] != -np.inf]
+            # Pending rows were scored at full precision already
+            clustered = candidates[rows[candidates] < len(self.documents)]
+            clustered = clustered[np.argsort(rows[clustered])]
+            scores[clustered] = np.asarray(self.originals[rows[clustered]], dtype=np.float32) @ query
+            top = candidates[np.argsort(-scores[candidates], kind="stable")][:k]
+        return [{**self._document(rows[i]), "@search.score": float(scores[i])} for i in top]
+
+    def _document(self, row: int) -> dict[str, Any]:
+        return self.documents[row] if row < len(self.documents) else self._pending_documents[row - len(self.documents)]
+
+    def filter(self, where: Callable[[dict[str, Any]], bool], top: int = 50) -> list[dict[str, Any]]:
+        docs = [doc for doc, dead in zip(self.documents, self.deleted) if not dead]
+        docs += [doc for doc, dead in zip(self._pending_documents, self._pending_deleted) if not dead]
+        return [dict(doc) for doc in docs if where(doc)][:top]
+
+    def as_float32(self) -> np.ndarray:
+        """The clustered rows as normalized float32: the originals if kept, otherwise approximated from the codes."""
+        if self.originals is not None:
+            return np.asarray(self.originals, dtype=np.float32)
+        return dequantize(self.vectors, self.scales, self.dimensions)
+
+    @staticmethod
+    def from_local_index(index: LocalVectorIndex, **kwargs) -> "IVFIndex":
+        return IVFIndex.build(index.documents, index.as_float32(), **kwargs)
+
+    def save(self, directory: str):
+        """Writes a new snapshot under directory/snapshots and then points directory/CURRENT at it.
+
+        The pointer is swapped with a single rename, so load() in another worker sees either the old or the new
+        snapshot, never files of both. The previous snapshot is kept for loads that read the pointer just before
+        the swap, older ones are removed.
+        """
+        if self._pending_vectors or self.deleted.any():
+            self.compact()
+        snapshots = os.path.join(directory, _SNAPSHOTS)
+        snapshot_id = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        path = os.path.join(snapshots, snapshot_id)
+        os.makedirs(path)
+
+        def write_array(name: str, array: np.ndarray):
+            with open(os.path.join(path, name), "wb") as f:
+                np.save(f, array)
+
+        def write_json(name: str, value: Any):
+            with open(os.path.join(path, name), "w") as f:
+                json.dump(value, f)
+
+        write_array("vectors.npy", self.vectors)
+        write_array("centroids.npy", self.centroids)
+        write_array("offsets.npy", self.offsets)
+        if self.scales is not None:
+            write_array("scales.npy", self.scales)
+        if self.originals is not None:
+            write_array("originals.npy", np.asarray(self.originals, dtype=np.float32))
+        write_json("documents.json", self.documents)
+        write_json("meta.json", {"nlist": self.nlist, "dimensions": self.dimensions, "precision": self.precision, "nprobe": self.nprobe,
+                                 "originals": self.originals is not None})
+
+        tmp = os.path.join(directory, f".{_CURRENT}.tmp")
+        with open(tmp, "w") as f:
+            f.write(snapshot_id)
+        os.replace(tmp, os.path.join(directory, _CURRENT))
+
+        for old in sorted(os.listdir(snapshots), key=lambda name: int(name.split("-")[0]))[:-2]:
+            # Workers keep the pages they mapped; where a mapped file can't be removed (Windows) it goes next time
+            shutil.rmtree(os.path.join(snapshots, old), ignore_errors=True)
+
+    @staticmethod
+    def load(directory: str, mmap: bool = True, nprobe: Optional[int] = None, rescore: bool = False,
+             oversampling: float = DEFAULT_OVERSAMPLING) -> "IVFIndex":
+        mmap_mode = "r" if mmap else None
+        path = snapshot_path(directory)
+        if path is None:
+            raise FileNotFoundError(f"No IVF index in {directory}, build one with index_manager.py --local")
+        directory = path
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+        with open(os.path.join(directory, "documents.json"), "r") as f:
+            documents = json.load(f)
+        return IVFIndex(
+            centroids=np.load(os.path.join(directory, "centroids.npy")),
+            vectors=np.load(os.path.join(directory, "vectors.npy"), mmap_mode=mmap_mode),
+            offsets=np.load(os.path.join(directory, "offsets.npy")),
+            documents=documents,
+            nprobe=nprobe or meta["nprobe"],
+            scales=np.load(os.path.join(directory, "scales.npy")) if meta["precision"] == "int8" else None,
+            originals=np.load(os.path.join(directory, "originals.npy"), mmap_mode=mmap_mode) if rescore and meta.get("originals") else None,
+            oversampling=oversampling,
+        )
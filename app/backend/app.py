@@ -7,10 +7,16 @@ from azure.core.credentials import AzureKeyCredential
 from azure.identity import AzureDeveloperCliCredential, DefaultAzureCredential
 from dotenv import load_dotenv
 
+from ann_index import IVFIndex
+from embedding_cache import EmbeddingCache
+from local_search import DEFAULT_OVERSAMPLING, LocalVectorIndex
+from metrics import metrics_handler
+from result_cache import IndexGeneration, SearchResultCache
 from ragtools import attach_rag_tools
 from rtmt import RTMiddleTier
 
 from search_manager import SearchManager
+from token_manager import TokenManager
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("voicerag")
@@ -35,15 +41,27 @@ async def create_app():
     search_credential = AzureKeyCredential(search_key) if search_key else credential
     
     app = web.Application()
+    current_directory = Path(__file__).parent
+
+    # One background-refreshed token cache for every scope the app needs
+    token_manager = None
+    if credential is not None:
+        token_manager = TokenManager(credential)
+        token_manager.attach_to_app(app)
 
     rtmt = RTMiddleTier(
         credentials=llm_credential,
         endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
         deployment=os.environ["AZURE_OPENAI_REALTIME_DEPLOYMENT"],
-        voice_choice=os.environ.get("AZURE_OPENAI_REALTIME_VOICE_CHOICE") or "alloy"
+        voice_choice=os.environ.get("AZURE_OPENAI_REALTIME_VOICE_CHOICE") or "alloy",
+        token_manager=token_manager
         )
     rtmt.temperature = 0.6
     rtmt.max_tokens = 1000
+    rtmt.prewarm_pool_size = int(os.environ.get("REALTIME_PREWARM_POOL_SIZE") or 0)
+    if audio_coalesce_ms := os.environ.get("REALTIME_AUDIO_COALESCE_MS"):
+        rtmt.audio_coalesce_ms = float(audio_coalesce_ms)
+    rtmt.record_dir = os.environ.get("REALTIME_RECORD_DIR") or None
     rtmt.system_message = """
     You are a helpful real estate assistant helping users find the right flat in Vienna. 
     You have access to a knowledge base containing data about flat listings in Vienna.
@@ -80,17 +98,57 @@ async def create_app():
     Remember to use the update_preferences tool whenever the user provides new information about 
     their preferences, and use these preferences to refine your search queries.
     """
+    local_index = None
+    search_backend = os.environ.get("SEARCH_BACKEND") or "azure"
+    # Quantized local indexes re-score k * oversampling candidates with their full-precision vectors
+    rescore = (os.environ.get("LOCAL_INDEX_RESCORE") or "false").lower() == "true"
+    oversampling = float(os.environ.get("SEARCH_OVERSAMPLING") or 0) or None
+    if search_backend == "ann":
+        ann_index_path = os.environ.get("ANN_INDEX_PATH") or str(current_directory.parent.parent / "data" / "flat_ivf")
+        local_index = IVFIndex.load(ann_index_path, nprobe=int(os.environ.get("ANN_NPROBE") or 0) or None, rescore=rescore, oversampling=oversampling or DEFAULT_OVERSAMPLING)
+        logger.info("Searching %d listings in-process with IVF (%d lists, nprobe %d, %s%s)", len(local_index), local_index.nlist, local_index.nprobe,
+                    local_index.precision, ", rescored" if local_index.originals is not None else "")
+    elif search_backend == "local":
+        local_index_path = os.environ.get("LOCAL_INDEX_PATH") or str(current_directory.parent.parent / "data" / "flat_index.npz")
+        local_index = LocalVectorIndex.load(local_index_path, precision=os.environ.get("LOCAL_INDEX_PRECISION") or None, rescore=rescore, oversampling=oversampling or DEFAULT_OVERSAMPLING)
+        logger.info("Searching %d listings in-process (%s%s, %.1f MB)", len(local_index), local_index.precision,
+                    ", rescored" if local_index.originals is not None else "", local_index.nbytes / 1e6)
+
+    generation = None
+    if search_backend == "azure":
+        generation = IndexGeneration(f"https://{os.getenv('AZURE_SEARCH_SERVICE_NAME')}.search.windows.net", os.getenv("AZURE_SEARCH_INDEX"),
+                                     AzureKeyCredential(os.getenv("AZURE_SEARCH_API_KEY")))
+        app.on_cleanup.append(lambda _: generation.close())
+
     search_manager = SearchManager(
         service_name=os.getenv("AZURE_SEARCH_SERVICE_NAME"),
         api_key=os.getenv("AZURE_SEARCH_API_KEY"),
         index_name=os.getenv("AZURE_SEARCH_INDEX"),
-        embedding_model="text-embedding-3-large"
+        embedding_model="text-embedding-3-large",
+        embedding_timeout=float(os.environ.get("AZURE_OPENAI_EMBEDDING_TIMEOUT") or 10.0),
+        embedding_max_retries=int(os.environ.get("AZURE_OPENAI_EMBEDDING_MAX_RETRIES") or 2),
+        embedding_cache=EmbeddingCache(
+            path=os.environ.get("EMBEDDING_CACHE_PATH") or None,
+            max_memory_bytes=int(float(os.environ.get("EMBEDDING_CACHE_MAX_MB") or 64) * 1024 * 1024),
+            ttl=float(os.environ.get("EMBEDDING_CACHE_TTL") or 24 * 3600)
+        ),
+        local_index=local_index,
+        embedding_dimensions=int(os.environ.get("EMBEDDING_DIMENSIONS") or 0) or None,
+        # Azure AI Search rejects it on an index without vector compression, there it only applies to local rescoring
+        oversampling=oversampling if search_backend == "azure" and os.environ.get("SEARCH_VECTOR_COMPRESSION") else None,
+        result_cache=SearchResultCache(
+            # Re-indexing with index_manager.py invalidates cached results, the local backends don't change while running
+            generation=generation,
+            max_entries=int(os.environ.get("SEARCH_RESULT_CACHE_SIZE") or 2048),
+            ttl=float(os.environ.get("SEARCH_RESULT_CACHE_TTL") or 300)
+        ) if os.environ.get("SEARCH_RESULT_CACHE_SIZE") != "0" else None
     )
+    app.on_cleanup.append(lambda _: search_manager.close())
 
-    attach_rag_tools(rtmt, credentials=search_credential, search_manager=search_manager)
+    attach_rag_tools(rtmt, credentials=search_credential, search_manager=search_manager, token_manager=token_manager)
     rtmt.attach_to_app(app, "/realtime")
+    app.router.add_get("/metrics", metrics_handler)
 
-    current_directory = Path(__file__).parent
     app.add_routes([web.get('/', lambda _: web.FileResponse(current_directory / 'static/index.html'))])
     app.router.add_static('/', path=current_directory / 'static', name='static')
     
@@ -0,0 +1,65 @@
+import asyncio
+import base64
+import json
+import os
+import time
+
+import aiohttp
+from azure.core.credentials import AzureKeyCredential
+
+from rtmt import RTMiddleTier
+
+# One minute of a typical voice session: the browser sends 100 ms PCM16 chunks (4800 bytes) and the
+# service streams audio back in chunks of similar size, interleaved with transcript deltas
+CLIENT_APPENDS_PER_MINUTE = 600
+SERVER_AUDIO_DELTAS_PER_MINUTE = 600
+SERVER_TRANSCRIPT_DELTAS_PER_MINUTE = 300
+SERVER_RESPONSES_PER_MINUTE = 6
+AUDIO_CHUNK_BYTES = 4800
+
+def _text(message: dict) -> aiohttp.WSMessage:
+    return aiohttp.WSMessage(aiohttp.WSMsgType.TEXT, json.dumps(message), None)
+
+def build_session_minute() -> tuple[list[aiohttp.WSMessage], list[aiohttp.WSMessage]]:
+    audio = base64.b64encode(os.urandom(AUDIO_CHUNK_BYTES)).decode("ascii")
+
+    to_server = [_text({"type": "session.update", "session": {"turn_detection": {"type": "server_vad"}}})]
+    to_server += [_text({"type": "input_audio_buffer.append", "audio": audio}) for _ in range(CLIENT_APPENDS_PER_MINUTE)]
+
+    to_client = [_text({"type": "session.created", "event_id": "event_0", "session": {"id": "sess_0"}})]
+    audio_per_response = SERVER_AUDIO_DELTAS_PER_MINUTE // SERVER_RESPONSES_PER_MINUTE
+    transcript_per_response = SERVER_TRANSCRIPT_DELTAS_PER_MINUTE // SERVER_RESPONSES_PER_MINUTE
+    for r in range(SERVER_RESPONSES_PER_MINUTE):
+        to_client.append(_text({"type": "input_audio_buffer.committed", "event_id": f"event_{r}_c", "item_id": f"item_{r}"}))
+        to_client.append(_text({"type": "conversation.item.created", "event_id": f"event_{r}_i", "previous_item_id": None, "item": {"id": f"item_{r}", "type": "message"}}))
+        for i in range(audio_per_response):
+            to_client.append(_text({"type": "response.audio.delta", "event_id": f"event_{r}_{i}_a", "response_id": f"resp_{r}", "item_id": f"item_{r}", "output_index": 0, "content_index": 0, "delta": audio}))
+            if i < transcript_per_response:
+                to_client.append(_text({"type": "response.audio_transcript.delta", "event_id": f"event_{r}_{i}_t", "response_id": f"resp_{r}", "item_id": f"item_{r}", "output_index": 0, "content_index": 0, "delta": "word "}))
+        to_client.append(_text({"type": "response.done", "event_id": f"event_{r}_d", "response": {"id": f"resp_{r}", "output": [{"type": "message"}]}}))
+    return to_client, to_server
+
+async def run(rtmt: RTMiddleTier, to_client: list[aiohttp.WSMessage], to_server: list[aiohttp.WSMessage], sessions: int) -> tuple[float, float]:
+    session = rtmt._create_session(None)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for _ in range(sessions):
+        for msg in to_server:
+            await rtmt._process_message_to_server(msg, session)
+        for msg in to_client:
+            await rtmt._process_message_to_client(msg, session)
+    return time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+async def main(sessions: int = 20):
+    rtmt = RTMiddleTier(endpoint="http://localhost", deployment="benchmark", credentials=AzureKeyCredential("benchmark"))
+    to_client, to_server = build_session_minute()
+    frames = (len(to_client) + len(to_server)) * sessions
+
+    print(f"{len(to_client)} upstream and {len(to_server)} client frames per session-minute, {sessions} session-minutes per run")
+    for fast_path in (False, True):
+        rtmt.fast_path = fast_path
+        wall, cpu = await run(rtmt, to_client, to_server, sessions)
+        label = "fast path" if fast_path else "full parse"
+        print(f"{label:>10}: {frames / wall:>10,.0f} msg/s, {cpu / sessions * 1000:>7.1f} ms CPU per session-minute")
+
+if __name__ == "__main__":
+    asyncio.run(main())
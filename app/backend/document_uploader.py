@@ -0,0 +1,106 @@
+import asyncio
+import json
+import random
+from typing import Any, Dict, Iterator, List
+
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from azure.search.documents.aio import SearchClient
+
+# Limits of Azure AI Search per indexing request
+MAX_BATCH_DOCUMENTS = 1000
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+# Per document (and per request) statuses worth another try: version conflicts, index busy, throttling, service errors
+_RETRYABLE_STATUS = {409, 422, 429, 500, 502, 503, 504}
+
+# Upper bound of a serialized float with its separator, e.g. "-0.012345678901234567,"
+_FLOAT_BYTES = 24
+
+def _document_bytes(doc: Dict[str, Any]) -> int:
+    # Serializing the vectors just to measure them would cost as much as the upload's own serialization
+    vectors = {key: value for key, value in doc.items() if isinstance(value, list) and value and isinstance(value[0], float)}
+    rest = {key: value for key, value in doc.items() if key not in vectors}
+    return (len(json.dumps(rest, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8"))
+            + sum(len(key) + 6 + _FLOAT_BYTES * len(value) for key, value in vectors.items()))
+
+def chunk_documents(documents: List[Dict[str, Any]], max_documents: int = MAX_BATCH_DOCUMENTS,
+                    max_bytes: int = MAX_BATCH_BYTES) -> Iterator[tuple[List[Dict[str, Any]], int]]:
+    """Splits documents into (chunk, serialized bytes) that each fit in one indexing request."""
+    chunk, chunk_bytes = [], 0
+    for doc in documents:
+        size = _document_bytes(doc)
+        if chunk and (len(chunk) >= max_documents or chunk_bytes + size > max_bytes):
+            yield chunk, chunk_bytes
+            chunk, chunk_bytes = [], 0
+        chunk.append(doc)
+        chunk_bytes += size
+    if chunk:
+        yield chunk, chunk_bytes
+
+class DocumentUploader:
+    """Sends index actions in chunks within the service's request limits, a few chunks at a time.
+
+    A response can succeed for some documents and fail for others. Only the documents that failed with a
+    transient status are sent again, with exponential backoff. What still fails after max_attempts is
+    returned to the caller.
+    """
+
+    def __init__(self, search_client: SearchClient, key_field: str = "id", max_batch_documents: int = MAX_BATCH_DOCUMENTS,
+                 max_batch_bytes: int = MAX_BATCH_BYTES * 3 // 4, max_concurrency: int = 4, max_attempts: int = 5):
+        self.search_client = search_client
+        self.key_field = key_field
+        self.max_batch_documents = min(max_batch_documents, MAX_BATCH_DOCUMENTS)
+        # Headroom for the request envelope and the @search.action of every document
+        self.max_batch_bytes = min(max_batch_bytes, MAX_BATCH_BYTES)
+        self.max_attempts = max_attempts
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.documents = 0
+        self.bytes = 0
+        self.requests = 0
+        self.retried = 0
+        self.failed = 0
+
+    async def _send_chunk(self, method: str, chunk: List[Dict[str, Any]], chunk_bytes: int, failures: Dict[str, str]):
+        pending = {str(doc[self.key_field]): doc for doc in chunk}
+        for attempt in range(1, self.max_attempts + 1):
+            async with self._semaphore:
+                try:
+                    results = await getattr(self.search_client, method)(documents=list(pending.values()))
+                    errors = {result.key: (result.status_code, result.error_message) for result in results if not result.succeeded}
+                except HttpResponseError as e:
+                    errors = {key: (e.status_code, str(e.message)) for key in pending}
+                except (ServiceRequestError, ServiceResponseError) as e:
+                    errors = {key: (503, str(e)) for key in pending}
+                self.requests += 1
+            retry = {key: pending[key] for key, (status, _) in errors.items()
+                     if status in _RETRYABLE_STATUS and key in pending} if attempt < self.max_attempts else {}
+            for key, (status, message) in errors.items():
+                if key not in retry:
+                    failures[key] = f"{status}: {message}"
+                    self.failed += 1
+            if not retry:
+                break
+            self.retried += len(retry)
+            pending = retry
+            await asyncio.sleep(min(30.0, 2 ** attempt) * random.uniform(0.5, 1.0))
+        self.documents += len(chunk)
+        self.bytes += chunk_bytes
+
+    async def send(self, method: str, documents: List[Dict[str, Any]]) -> Dict[str, str]:
+        """Applies a SearchClient method ("upload_documents", "merge_or_upload_documents", "delete_documents", ...)
+        to documents. Returns the error of every document that wasn't indexed, by key."""
+        failures: Dict[str, str] = {}
+        tasks = [asyncio.create_task(self._send_chunk(method, chunk, chunk_bytes, failures))
+                 for chunk, chunk_bytes in chunk_documents(documents, self.max_batch_documents, self.max_batch_bytes)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return failures
+
+    def summary(self, seconds: float) -> str:
+        seconds = max(seconds, 1e-9)
+        return (f"Sent {self.documents} documents (~{self.bytes / 1e6:.1f} MB) in {self.requests} requests, "
+                f"{self.documents / seconds:.0f} docs/s, {self.bytes / 1e6 / seconds:.1f} MB/s; "
+                f"{self.retried} retried, {self.failed} failed")
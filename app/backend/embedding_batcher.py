@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Callable, Optional
+
+from openai import APIConnectionError, APITimeoutError, AsyncAzureOpenAI, InternalServerError, RateLimitError
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _encoding = None
+
+logger = logging.getLogger("voicerag")
+
+# Limits of the embeddings API per request and per input
+MAX_BATCH_INPUTS = 2048
+MAX_INPUT_TOKENS = 8191
+
+def count_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # Without tiktoken, about four characters per token is close enough for batching and rate limiting
+    return len(text) // 4 + 1
+
+def _truncate(text: str) -> str:
+    if _encoding is not None:
+        tokens = _encoding.encode(text)
+        return _encoding.decode(tokens[:MAX_INPUT_TOKENS]) if len(tokens) > MAX_INPUT_TOKENS else text
+    return text[:MAX_INPUT_TOKENS * 3]
+
+def _retry_after(error: RateLimitError) -> Optional[float]:
+    headers = error.response.headers if error.response is not None else {}
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers[header]) * scale
+        except (KeyError, ValueError):
+            continue
+    return None
+
+class AdaptiveRateLimiter:
+    """Bounds concurrent requests and tokens per minute, backing off when the service answers 429.
+
+    Concurrency is additive-increase/multiplicative-decrease: halved (and everything paused for the
+    Retry-After period) on a 429, raised by one after each window of successful requests.
+    """
+
+    def __init__(self, max_concurrency: int = 4, tokens_per_minute: Optional[int] = None):
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.active = 0
+        self.throttled = 0
+        self._paused_until = 0.0
+        self._successes = 0
+        self._spent: deque[tuple[float, int]] = deque()
+        self._spent_tokens = 0
+        self._released = asyncio.Event()
+
+    def _token_delay(self, tokens: int, now: float) -> float:
+        if self.tokens_per_minute is None:
+            return 0.0
+        while self._spent and self._spent[0][0] <= now - 60:
+            self._spent_tokens -= self._spent.popleft()[1]
+        # A single batch over the budget would wait forever, it goes through once the window is empty
+        if self._spent_tokens + tokens <= self.tokens_per_minute or not self._spent:
+            return 0.0
+        excess = self._spent_tokens + tokens - self.tokens_per_minute
+        for spent_at, spent in self._spent:
+            excess -= spent
+            if excess <= 0:
+                return spent_at + 60 - now
+        return 60.0
+
+    async def acquire(self, tokens: int):
+        while True:
+            now = time.monotonic()
+            delay = max(self._paused_until - now, self._token_delay(tokens, now))
+            if delay <= 0 and self.active < self.concurrency:
+                self.active += 1
+                if self.tokens_per_minute is not None:
+                    self._spent.append((now, tokens))
+                    self._spent_tokens += tokens
+                return
+            self._released.clear()
+            try:
+                await asyncio.wait_for(self._released.wait(), timeout=delay if delay > 0 else None)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, throttled: bool = False, retry_after: Optional[float] = None):
+        self.active -= 1
+        if throttled:
+            self.throttled += 1
+            self.concurrency = max(1, self.concurrency // 2)
+            self._successes = 0
+            self._paused_until = max(self._paused_until, time.monotonic() + (retry_after if retry_after is not None else 1.0))
+        else:
+            self._successes += 1
+            if self._successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self._successes = 0
+        self._released.set()
+
+class EmbeddingBatcher:
+    """Embeds many texts with few requests: batches sized by input count and tokens, sent concurrently under an AdaptiveRateLimiter."""
+
+    def __init__(self, client: AsyncAzureOpenAI, model: str, dimensions: Optional[int] = None, max_batch_inputs: int = 256,
+                 max_batch_tokens: int = 100_000, max_concurrency: int = 4, tokens_per_minute: Optional[int] = None, max_attempts: int = 8):
+        self.client = client
+        self.model = model
+        self.dimensions = dimensions
+        self.max_batch_inputs = min(max_batch_inputs, MAX_BATCH_INPUTS)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_attempts = max_attempts
+        self.limiter = AdaptiveRateLimiter(max_concurrency, tokens_per_minute)
+
+    def _batches(self, texts: list[str]) -> list[tuple[int, list[str], int]]:
+        batches = []
+        start, batch, batch_tokens = 0, [], 0
+        for i, text in enumerate(texts):
+            tokens = count_tokens(text)
+            if batch and (len(batch) >= self.max_batch_inputs or batch_tokens + tokens > self.max_batch_tokens):
+                batches.append((start, batch, batch_tokens))
+                start, batch, batch_tokens = i, [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append((start, batch, batch_tokens))
+        return batches
+
+    async def _embed_batch(self, batch: list[str], tokens: int) -> list[list[float]]:
+        kwargs = {"dimensions": self.dimensions} if self.dimensions else {}
+        for attempt in range(1, self.max_attempts + 1):
+            await self.limiter.acquire(tokens)
+            throttled, retry_after = False, None
+            try:
+                response = await self.client.embeddings.create(input=batch, model=self.model, **kwargs)
+            except RateLimitError as e:
+                throttled, retry_after = True, _retry_after(e)
+                if attempt == self.max_attempts:
+                    raise
+            except (APIConnectionError, APITimeoutError, InternalServerError):
+                if attempt == self.max_attempts:
+                    raise
+            else:
+                return [data.embedding for data in sorted(response.data, key=lambda d: d.index)]
+            finally:
+                # Also on errors that aren't retried and on cancellation, or the slot and its tokens stay taken
+                self.limiter.release(throttled=throttled, retry_after=retry_after)
+            if throttled:
+                logger.info("Embeddings throttled, retrying in %.1fs at concurrency %d", retry_after or 1.0, self.limiter.concurrency)
+            else:
+                await asyncio.sleep(min(30.0, 2 ** attempt) * random.uniform(0.5, 1.0))
+
+    async def embed(self, texts: list[str], on_progress: Optional[Callable[[int, int, int, float], None]] = None) -> list[list[float]]:
+        """Returns one embedding per text, in order. on_progress(texts_done, texts_total, tokens_done, seconds) follows each batch."""
+        # The API rejects empty inputs and inputs over the model's context
+        texts = [_truncate(text) if text.strip() else " " for text in texts]
+        embeddings: list[Optional[list[float]]] = [None] * len(texts)
+        started = time.monotonic()
+        done, tokens_done = 0, 0
+
+        async def run(start: int, batch: list[str], tokens: int):
+            nonlocal done, tokens_done
+            embeddings[start:start + len(batch)] = await self._embed_batch(batch, tokens)
+            done += len(batch)
+            tokens_done += tokens
+            if on_progress is not None:
+                on_progress(done, len(texts), tokens_done, time.monotonic() - started)
+
+        tasks = [asyncio.create_task(run(*batch)) for batch in self._batches(texts)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return embeddings
@@ -0,0 +1,139 @@
+import asyncio
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Optional
+
+from metrics import EMBEDDING_CACHE_EVICTIONS, EMBEDDING_CACHE_LOOKUPS
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+
+def normalize_query(text: str) -> str:
+    # "Flats in Neubau, with balcony?" and "flats in neubau with balcony" embed to practically the same vector
+    return " ".join(_PUNCTUATION.sub(" ", text.casefold()).split())
+
+def cache_key(text: str, model: str, dimensions: Optional[int] = None) -> str:
+    return hashlib.sha256(f"{model}\0{dimensions or 0}\0{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """Query embeddings in a bounded in-memory LRU, backed by an optional SQLite file that outlives the process.
+
+    The SQLite file runs in WAL mode, so several gunicorn workers can point at the same path. Vectors are
+    kept as packed float32 in both tiers (12 KiB for a 3072 dimension embedding).
+    """
+
+    def __init__(self, path: Optional[str] = None, max_memory_bytes: int = 64 * 1024 * 1024, ttl: float = 24 * 3600,
+                 disk_ttl: float = 30 * 24 * 3600, max_disk_entries: int = 200_000):
+        self.path = path
+        self.max_memory_bytes = max_memory_bytes
+        self.ttl = ttl
+        self.disk_ttl = disk_ttl
+        self.max_disk_entries = max_disk_entries
+        self._memory: OrderedDict[str, tuple[float, array]] = OrderedDict()
+        self._memory_bytes = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._disk_writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        if path:
+            self._open(path)
+
+    def _open(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=5.0, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, created REAL NOT NULL, vector BLOB NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_created ON embeddings (created)")
+
+    def _remember(self, key: str, vector: array, expires_at: float):
+        size = vector.itemsize * len(vector)
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= previous[1].itemsize * len(previous[1])
+        self._memory[key] = (expires_at, vector)
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.itemsize * len(evicted)
+            self.evictions += 1
+            EMBEDDING_CACHE_EVICTIONS.inc()
+
+    def _read_disk(self, key: str) -> Optional[tuple[float, array]]:
+        with self._db_lock:
+            row = self._db.execute("SELECT created, vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None or row[0] + self.disk_ttl < time.time():
+            return None
+        vector = array("f")
+        vector.frombytes(row[1])
+        return row[0], vector
+
+    def _write_disk(self, key: str, vector: array):
+        with self._db_lock:
+            self._db.execute("INSERT OR REPLACE INTO embeddings (key, created, vector) VALUES (?, ?, ?)", (key, time.time(), vector.tobytes()))
+            self._disk_writes += 1
+            # Trimming on every write would scan the index each time, every few hundred writes is plenty
+            if self._disk_writes % 256 == 0:
+                self._db.execute("DELETE FROM embeddings WHERE created < ?", (time.time() - self.disk_ttl,))
+                self._db.execute("DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.max_disk_entries,))
+
+    async def get(self, key: str) -> Optional[list[float]]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                EMBEDDING_CACHE_LOOKUPS.inc(("memory",))
+                return entry[1].tolist()
+            self._memory.pop(key)
+            self._memory_bytes -= entry[1].itemsize * len(entry[1])
+            self.expirations += 1
+        if self._db is not None:
+            stored = await asyncio.to_thread(self._read_disk, key)
+            if stored is not None:
+                created, vector = stored
+                # Stays in memory no longer than it would have had it been fetched when it was first stored
+                remaining = min(self.ttl, created + self.disk_ttl - time.time())
+                self._remember(key, vector, time.monotonic() + remaining)
+                self.disk_hits += 1
+                EMBEDDING_CACHE_LOOKUPS.inc(("disk",))
+                return vector.tolist()
+        self.misses += 1
+        EMBEDDING_CACHE_LOOKUPS.inc(("miss",))
+        return None
+
+    async def put(self, key: str, embedding: list[float]):
+        vector = array("f", embedding)
+        self._remember(key, vector, time.monotonic() + self.ttl)
+        if self._db is not None:
+            await asyncio.to_thread(self._write_disk, key, vector)
+
+    def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hit_ratio, 4),
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
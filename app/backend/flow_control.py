@@ -0,0 +1,148 @@
+import asyncio
+from collections import deque
+from enum import Enum
+from typing import Callable, Optional
+
+class QueuePolicy(Enum):
+    # Stop reading from the sender until the queue drains, which pushes back through TCP
+    BLOCK = "block"
+    # Throw away the oldest queued droppable frames (e.g. stale audio) first, then block
+    DROP_STALE = "drop_stale"
+
+class MemoryBudget:
+    """Caps the bytes queued across all the queues of one session."""
+    __slots__ = ("limit", "used", "changed")
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.changed = asyncio.Condition()
+
+class FrameQueue:
+    """Bounded FIFO of outgoing frames for one direction of a session.
+
+    Once a put would take the queue past high_watermark bytes (or the session past its memory budget),
+    the policy kicks in: stale droppable frames are discarded, and if that isn't enough the writer waits
+    until the queue has drained to low_watermark. Writers that wait are let through in the order they
+    came, and nothing overtakes them, so frames are sent in the order they were put.
+    """
+    __slots__ = ("name", "high_watermark", "low_watermark", "policy", "is_droppable", "budget", "_frames", "_bytes", "_closed", "_waiting",
+                 "frames_in", "frames_out", "bytes_in", "dropped_frames", "dropped_bytes", "blocked_count", "blocked_seconds", "peak_bytes")
+
+    def __init__(self, name: str, high_watermark: int, low_watermark: int, budget: MemoryBudget,
+                 policy: QueuePolicy = QueuePolicy.BLOCK, is_droppable: Optional[Callable[[str | bytes], bool]] = None):
+        self.name = name
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.budget = budget
+        self.policy = policy
+        self.is_droppable = is_droppable
+        self._frames: deque[str | bytes] = deque()
+        self._bytes = 0
+        self._closed = False
+        # One ticket per writer waiting to put a frame, in arrival order
+        self._waiting: deque[object] = deque()
+        self.frames_in = 0
+        self.frames_out = 0
+        self.bytes_in = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+        self.blocked_count = 0
+        self.blocked_seconds = 0.0
+        self.peak_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    @property
+    def queued_bytes(self) -> int:
+        return self._bytes
+
+    def _over_limit(self, size: int) -> bool:
+        # An empty queue always takes a frame, otherwise a single oversized frame would never get through
+        if not self._frames:
+            return False
+        return self._bytes + size > self.high_watermark or self.budget.used + size > self.budget.limit
+
+    def _drained(self) -> bool:
+        return self._closed or not self._frames or (self._bytes <= self.low_watermark and self.budget.used <= self.budget.limit)
+
+    def _drop_stale(self):
+        if self.is_droppable is None:
+            return
+        kept: deque[str | bytes] = deque()
+        while self._frames:
+            frame = self._frames.popleft()
+            if self._bytes > self.low_watermark and self.is_droppable(frame):
+                self._bytes -= len(frame)
+                self.budget.used -= len(frame)
+                self.dropped_frames += 1
+                self.dropped_bytes += len(frame)
+            else:
+                kept.append(frame)
+        self._frames = kept
+
+    async def put(self, frame: str | bytes):
+        if self._closed:
+            return
+        size = len(frame)
+        if self._waiting or self._over_limit(size):
+            if self.policy is QueuePolicy.DROP_STALE and self._over_limit(size):
+                self._drop_stale()
+            # Even a frame that would fit queues up behind writers already waiting, or it would overtake them
+            if self._waiting or self._over_limit(size):
+                self.blocked_count += 1
+                started = asyncio.get_running_loop().time()
+                ticket = object()
+                self._waiting.append(ticket)
+                async with self.budget.changed:
+                    try:
+                        await self.budget.changed.wait_for(lambda: self._closed or (self._waiting[0] is ticket and self._drained()))
+                    finally:
+                        self._waiting.remove(ticket)
+                        # The next writer in line may go now, also when this one was cancelled
+                        self.budget.changed.notify_all()
+                self.blocked_seconds += asyncio.get_running_loop().time() - started
+                if self._closed:
+                    return
+        self._frames.append(frame)
+        self._bytes += size
+        self.budget.used += size
+        self.frames_in += 1
+        self.bytes_in += size
+        self.peak_bytes = max(self.peak_bytes, self._bytes)
+        async with self.budget.changed:
+            self.budget.changed.notify_all()
+
+    async def get(self) -> Optional[str | bytes]:
+        """Returns the next frame, or None once the queue is closed."""
+        async with self.budget.changed:
+            await self.budget.changed.wait_for(lambda: self._frames or self._closed)
+            if not self._frames:
+                return None
+            frame = self._frames.popleft()
+            self._bytes -= len(frame)
+            self.budget.used -= len(frame)
+            self.frames_out += 1
+            self.budget.changed.notify_all()
+        return frame
+
+    async def close(self):
+        self._closed = True
+        self.budget.used -= self._bytes
+        self._bytes = 0
+        self._frames.clear()
+        async with self.budget.changed:
+            self.budget.changed.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            "frames_in": self.frames_in,
+            "frames_out": self.frames_out,
+            "bytes_in": self.bytes_in,
+            "peak_bytes": self.peak_bytes,
+            "dropped_frames": self.dropped_frames,
+            "dropped_bytes": self.dropped_bytes,
+            "blocked_count": self.blocked_count,
+            "blocked_seconds": round(self.blocked_seconds, 3),
+        }
@@ -1,9 +1,10 @@
 import os
 import dotenv
 import asyncio
-from typing import List, Dict, Any
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
 
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.indexes.aio import SearchIndexClient
 from azure.search.documents.aio import SearchClient
@@ -12,6 +13,8 @@ from azure.search.documents.indexes.models import (
     AzureOpenAIVectorizer,
     HnswAlgorithmConfiguration,
     HnswParameters,
+    ScalarQuantizationCompressionConfiguration,
+    ScalarQuantizationParameters,
     SearchableField,
     SearchField,
     SearchFieldDataType,
@@ -25,8 +28,18 @@ from azure.search.documents.indexes.models import (
     VectorSearchProfile,
 )
 
+from document_uploader import DocumentUploader
+from embedding_batcher import EmbeddingBatcher
+from index_manifest import IndexManifest
+from ingestion import IngestionPipeline, IngestionReport
+from result_cache import IndexGeneration, generation_index
+
 dotenv.load_dotenv(override=True)
 
+# Azure AI Search vector compression: None or int8 scalar quantization. Binary quantization needs a newer
+# azure-search-documents than requirements.txt pins.
+VECTOR_COMPRESSIONS = (None, "scalar")
+
 class IndexManager:
     def __init__(
         self,
@@ -36,11 +49,20 @@ class IndexManager:
         endpoint_env_var="AZURE_SEARCH_SERVICE",
         index_name="flat-index",
         embedding_dimensions=3072,
-        use_int_vectorization=True
+        use_int_vectorization=True,
+        embedding_concurrency=4,
+        embedding_tokens_per_minute=None,
+        vector_compression=None,
+        oversampling=None
     ):
+        if vector_compression not in VECTOR_COMPRESSIONS:
+            raise ValueError(f"Unknown vector compression '{vector_compression}', expected one of {', '.join(map(str, VECTOR_COMPRESSIONS))}")
         self.index_name = index_name
         self.embedding_model = embedding_model
+        # text-embedding-3 models can return shorter vectors (256, 512, 1024...) at some loss of quality
         self.embedding_dimensions = embedding_dimensions
+        self.vector_compression = vector_compression
+        self.oversampling = oversampling
         self.use_int_vectorization = use_int_vectorization
 
         self.azure_search_endpoint = f"https://{service_name}.search.windows.net"
@@ -50,11 +72,19 @@ class IndexManager:
             credential=self.azure_search_credential
         )
 
-        # OpenAI client for embedding
-        self.azure_openai_client = AzureOpenAI(
+        # OpenAI client for embedding, retries are left to the batcher which knows about the rate limits
+        self.azure_openai_client = AsyncAzureOpenAI(
             api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
             azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_API_KEY")
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            max_retries=0
+        )
+        self.embedder = EmbeddingBatcher(
+            self.azure_openai_client,
+            self.embedding_model,
+            dimensions=self.embedding_dimensions,
+            max_concurrency=embedding_concurrency,
+            tokens_per_minute=embedding_tokens_per_minute
         )
 
         self.index = self._build_index()
@@ -104,7 +134,8 @@ class IndexManager:
             SearchField(
                 name="embedding",
                 type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
-                hidden=False,
+                # Only used for scoring, returning it would add 3072 floats to every result
+                hidden=True,
                 searchable=True,
                 filterable=False,
                 sortable=False,
@@ -127,6 +158,17 @@ class IndexManager:
             )
         ]
 
+        compressions = []
+        if self.vector_compression == "scalar":
+            # int8 vectors in the HNSW graph, a quarter of the float32 memory; the oversampled candidates are
+            # re-ranked with the original vectors
+            compressions.append(ScalarQuantizationCompressionConfiguration(
+                name="embedding_compression",
+                rerank_with_original_vectors=True,
+                default_oversampling=self.oversampling,
+                parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+            ))
+
         index = SearchIndex(
             name=self.index_name,
             fields=fields,
@@ -153,42 +195,109 @@ class IndexManager:
                         name="embedding_config",
                         algorithm_configuration_name="hnsw_config",
                         vectorizer=(f"{self.index_name}-vectorizer" if self.use_int_vectorization else None),
+                        compression_configuration_name="embedding_compression" if compressions else None,
                     ),
                 ],
                 vectorizers=vectorizers,
+                compressions=compressions or None,
             ),
         )
         return index
 
     async def create_index_if_not_exists(self):
-        existing_indexes = [idx.name async for idx in self.search_index_client.list_indexes()]
+        existing_indexes = {idx.name: idx async for idx in self.search_index_client.list_indexes()}
         if self.index_name not in existing_indexes:
             await self.search_index_client.create_index(self.index)
             print(f"Index '{self.index_name}' created successfully.")
         else:
             print(f"Index '{self.index_name}' already exists.")
+            # Vector dimensions and compression can't be changed on an existing index
+            existing = next((field for field in existing_indexes[self.index_name].fields if field.name == "embedding"), None)
+            if existing is not None and existing.vector_search_dimensions != self.embedding_dimensions:
+                print(f"Warning: its embedding field has {existing.vector_search_dimensions} dimensions, not {self.embedding_dimensions}: "
+                      f"delete it or use a new AZURE_SEARCH_INDEX")
+        if generation_index(self.index_name).name not in existing_indexes:
+            await self.search_index_client.create_index(generation_index(self.index_name))
 
-    def _calculate_embedding(self, text: str) -> List[float]:
-        response = self.azure_openai_client.embeddings.create(input=text, model=self.embedding_model)
-        return response.data[0].embedding
+    async def bump_generation(self) -> int:
+        """Tells the app's search result caches that the index changed, the results they hold were computed against the previous documents."""
+        async with IndexGeneration(self.azure_search_endpoint, self.index_name, self.azure_search_credential) as generation:
+            return await generation.bump()
 
-    async def upload_documents(self, documents: List[Dict[str, Any]]):
-        # Calculate embeddings for each document
-        for doc in documents:
-            # You can decide what field(s) to use for embeddings. Here we use 'description' + 'title'
-            combined_text = f"{doc.get('title', '')} {doc.get('description', '')}".strip()
-            doc["embedding"] = self._calculate_embedding(combined_text)
+    async def _calculate_embedding(self, text: str) -> List[float]:
+        return (await self.embedder.embed([text]))[0]
 
-        search_client = SearchClient(
+    @staticmethod
+    def _report_progress(done: int, total: int, tokens: int, seconds: float):
+        print(f"Embedded {done}/{total} documents in {seconds:.1f}s ({done / max(seconds, 1e-9):.0f} docs/s, {tokens / max(seconds, 1e-9):.0f} tokens/s)")
+
+    @staticmethod
+    def _embedding_text(doc: Dict[str, Any]) -> str:
+        # You can decide what field(s) to use for embeddings. Here we use 'description' + 'title'
+        return f"{doc.get('title', '')} {doc.get('description', '')}".strip()
+
+    def search_client(self) -> SearchClient:
+        return SearchClient(
             endpoint=self.azure_search_endpoint,
             index_name=self.index_name,
             credential=self.azure_search_credential
         )
-        result = await search_client.upload_documents(documents=documents)
-        print("Documents uploaded successfully:", result)
+
+    async def upload_documents(self, documents: List[Dict[str, Any]]):
+        texts = [self._embedding_text(doc) for doc in documents]
+        embeddings = await self.embedder.embed(texts, on_progress=self._report_progress)
+        for doc, embedding in zip(documents, embeddings):
+            doc["embedding"] = embedding
+
+        started = time.monotonic()
+        async with self.search_client() as search_client:
+            uploader = DocumentUploader(search_client)
+            failures = await uploader.send("upload_documents", documents)
+        print(uploader.summary(time.monotonic() - started))
+        for key, error in list(failures.items())[:10]:
+            print(f"Document {key} was not indexed: {error}")
+        await self.bump_generation()
+
+    async def sync_documents(self, documents: Iterable[Dict[str, Any]], manifest_path: str = "data/index_manifest.json", full: bool = False,
+                             on_uploaded: Optional[Callable[[Dict[str, Any]], None]] = None, **pipeline_options) -> IngestionReport:
+        """Brings the index in line with documents, embedding and sending only what changed since the manifest was written.
+
+        documents may be a lazy iterable such as ingestion.iter_documents, it is consumed once as a stream.
+        """
+        manifest = IndexManifest(manifest_path, self.index_name, self.embedding_model, self.embedding_dimensions)
+        if full:
+            # Everything is embedded again, but what left the catalog is still deleted
+            manifest.invalidate()
+        pipeline_options.setdefault("embed_workers", self.embedder.limiter.max_concurrency)
+        report = await IngestionPipeline(self, **pipeline_options).run(documents, manifest, on_uploaded)
+
+        if report.changed:
+            await self.bump_generation()
+        for stage in report.stages:
+            print(stage.summary(report.seconds))
+        if report.uploader is not None:
+            print(report.uploader.summary(report.seconds))
+        print(report.summary())
+        return report
 
 
 if __name__ == "__main__":
+    import argparse
+
+    import numpy as np
+
+    from ingestion import iter_documents
+
+    parser = argparse.ArgumentParser(description="Index a JSON or JSONL catalog, embedding and uploading only listings that changed since the last run")
+    parser.add_argument("catalog", nargs="?", default="data/flat_data.json", help="JSON array or JSONL file of listings (default: %(default)s)")
+    parser.add_argument("--full", action="store_true", help="ignore the manifest and re-embed and re-upload everything")
+    parser.add_argument("--batch-size", type=int, default=256, help="documents per embedding request and upload (default: %(default)s)")
+    parser.add_argument("--queue-batches", type=int, default=4, help="batches buffered between pipeline stages (default: %(default)s)")
+    parser.add_argument("--upload-workers", type=int, default=2, help="concurrent upload requests (default: %(default)s)")
+    parser.add_argument("--local", action="store_true",
+                        help="also rebuild the snapshots for SEARCH_BACKEND=local/ann, which holds every vector of the catalog in memory")
+    args = parser.parse_args()
+
     service_name = os.getenv("AZURE_SEARCH_SERVICE_NAME")
     api_key = os.getenv("AZURE_SEARCH_API_KEY")
     embedding_model = "text-embedding-3-large"
@@ -198,12 +307,78 @@ if __name__ == "__main__":
         service_name=service_name,
         api_key=api_key,
         embedding_model=embedding_model,
-        index_name=AZURE_SEARCH_INDEX
+        index_name=AZURE_SEARCH_INDEX,
+        embedding_dimensions=int(os.getenv("EMBEDDING_DIMENSIONS") or 3072),
+        vector_compression=os.getenv("SEARCH_VECTOR_COMPRESSION") or None,
+        oversampling=float(os.getenv("SEARCH_OVERSAMPLING") or 0) or None,
+        embedding_concurrency=int(os.getenv("EMBEDDING_CONCURRENCY") or 4),
+        embedding_tokens_per_minute=int(os.getenv("EMBEDDING_TOKENS_PER_MINUTE") or 0) or None
         )
     asyncio.run(index_manager.create_index_if_not_exists())
-    # read the documents in data/dlat_data.json
-    import json
-    with open("data/flat_data.json", "r") as f:
-        documents = json.load(f)
 
-    asyncio.run(index_manager.upload_documents(documents))
\ No newline at end of file
+    # Only for the local snapshots, and only float32 copies of new vectors; the documents themselves are
+    # dropped after their upload, so without --local memory doesn't grow with the catalog
+    new_vectors: Dict[str, np.ndarray] = {}
+    def keep_vector(doc: Dict[str, Any]):
+        new_vectors[str(doc["id"])] = np.asarray(doc["embedding"], dtype=np.float32)
+
+    asyncio.run(index_manager.sync_documents(
+        iter_documents(args.catalog),
+        full=args.full,
+        on_uploaded=keep_vector if args.local else None,
+        batch_size=args.batch_size,
+        queue_batches=args.queue_batches,
+        upload_workers=args.upload_workers
+    ))
+
+    if args.local:
+        # Same vectors for SEARCH_BACKEND=local, so the in-process search doesn't have to embed the catalog again.
+        # Listings that weren't re-embedded take their vector from the previous local snapshot.
+        from ann_index import IVFIndex, snapshot_path
+        from local_search import LocalVectorIndex
+        previous = {}
+        if os.path.exists("data/flat_index.npz"):
+            snapshot = LocalVectorIndex.load("data/flat_index.npz")
+            # Vectors of another size are from before EMBEDDING_DIMENSIONS changed, the manifest re-embedded everything then
+            if snapshot.dimensions == index_manager.embedding_dimensions:
+                previous = snapshot.embeddings_by_id()
+        documents, vectors, missing = [], [], False
+        for doc in iter_documents(args.catalog):
+            vector = new_vectors.get(str(doc["id"]), previous.get(doc["id"]))
+            if vector is None:
+                missing = True
+                break
+            documents.append(doc)
+            vectors.append(vector)
+        if missing:
+            print("Local indexes not updated, some listings have no embedding in them yet: run with --full --local once")
+        elif documents:
+            embeddings = np.array(vectors, dtype=np.float32)
+            # The flat snapshot stays float32 and is quantized when loaded (LOCAL_INDEX_PRECISION). The IVF index is
+            # quantized when built and keeps the full-precision vectors for rescoring next to the codes.
+            LocalVectorIndex(documents, embeddings).save("data/flat_index.npz")
+            ann_precision = os.getenv("ANN_INDEX_PRECISION") or "float32"
+            ivf = None
+            if not args.full and snapshot_path("data/flat_ivf") is not None:
+                ivf = IVFIndex.load("data/flat_ivf", mmap=False, rescore=True)
+                if ivf.dimensions != index_manager.embedding_dimensions or ivf.precision != ann_precision or \
+                        (ann_precision != "float32" and ivf.originals is None):
+                    ivf = None
+            if ivf is not None:
+                # Only new and changed listings are filed under the trained centroids, and what left the catalog
+                # is deleted; k-means is retrained with --full, or once most of the index changed
+                stored = {doc.get("id"): doc for doc in ivf.documents}
+                catalog_ids = {doc.get("id") for doc in documents}
+                stale = [id for id in stored if id not in catalog_ids]
+                changed = [i for i, doc in enumerate(documents) if str(doc["id"]) in new_vectors
+                           or stored.get(doc.get("id")) != {key: value for key, value in doc.items() if key != "embedding"}]
+                if len(stale) + len(changed) > len(ivf) // 2:
+                    ivf = None
+                else:
+                    ivf.delete(stale)
+                    ivf.insert([documents[i] for i in changed], embeddings[changed])
+                    print(f"IVF index updated in place: {len(changed)} listings inserted, {len(stale)} deleted")
+            if ivf is None:
+                ivf = IVFIndex.build(documents, embeddings, precision=ann_precision, rescore=ann_precision != "float32")
+            ivf.save("data/flat_ivf")
+            print("Local indexes written to data/flat_index.npz and data/flat_ivf")
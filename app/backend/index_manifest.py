@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+def _hash(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+def metadata_hash(doc: Dict[str, Any]) -> str:
+    return _hash(json.dumps({key: value for key, value in doc.items() if key != "embedding"}, sort_keys=True, ensure_ascii=False, default=str))
+
+class IndexManifest:
+    """What was last indexed, per listing id: a hash of the embedded text and a hash of all other fields.
+
+    Stored as JSON next to the catalog. It is only valid for the index, model and dimensions it was written
+    for; with anything else every document is embedded again, though its ids still tell which listings left
+    the catalog and have to be deleted.
+    """
+
+    def __init__(self, path: str, index_name: str, embedding_model: str, embedding_dimensions: Optional[int]):
+        self.path = path
+        self.scope = {"index": index_name, "model": embedding_model, "dimensions": embedding_dimensions}
+        self.documents: Dict[str, Dict[str, str]] = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return
+        self.documents = stored.get("documents", {})
+        if any(stored.get(key) != value for key, value in self.scope.items()):
+            self.invalidate()
+
+    def invalidate(self):
+        """Marks every listing as not embedded yet, keeping the ids for stale()."""
+        for entry in self.documents.values():
+            entry["text"] = None
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({**self.scope, "documents": self.documents}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def classify(self, doc: Dict[str, Any], text: str) -> str:
+        """Returns "embed" for listings not indexed yet or whose embedded text changed, "merge" when only other fields
+        changed (the indexed document keeps its embedding) and "unchanged" otherwise."""
+        entry = self.documents.get(str(doc["id"]))
+        if entry is None or entry["text"] != _hash(text):
+            return "embed"
+        return "merge" if entry["metadata"] != metadata_hash(doc) else "unchanged"
+
+    def stale(self, seen: Iterable[str]) -> List[str]:
+        """Ids in the manifest that are not among seen, i.e. listings gone from the catalog."""
+        seen = set(seen)
+        return [id for id in self.documents if id not in seen]
+
+    def record(self, doc: Dict[str, Any], text: str):
+        self.documents[str(doc["id"])] = {"text": _hash(text), "metadata": metadata_hash(doc)}
+
+    def forget(self, id: str):
+        self.documents.pop(id, None)
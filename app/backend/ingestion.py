@@ -0,0 +1,233 @@
+import asyncio
+import json
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from document_uploader import DocumentUploader
+from index_manifest import IndexManifest
+
+if TYPE_CHECKING:
+    from index_manager import IndexManager
+
+_WHITESPACE = " \t\r\n"
+
+def iter_documents(path: str, chunk_size: int = 1 << 16) -> Iterator[Dict[str, Any]]:
+    """Yields the objects of a JSON array or a JSONL file one at a time, holding at most a chunk and one document in memory."""
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        # offset: characters of the file before buffer, for the position in errors
+        buffer, pos, eof, offset = "", 0, False, 0
+        in_array: Optional[bool] = None
+        closed = False
+        while True:
+            # Between documents: whitespace, and in an array the commas
+            separators = _WHITESPACE + "," if in_array and not closed else _WHITESPACE
+            while pos < len(buffer) and buffer[pos] in separators:
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    if in_array and not closed:
+                        raise ValueError(f"Invalid JSON in {path} at character {offset}: Expecting ']'")
+                    return
+                offset += len(buffer)
+                buffer, pos = f.read(chunk_size), 0
+                eof = not buffer
+                continue
+            if in_array is None:
+                in_array = buffer[pos] == "["
+                pos += in_array
+                continue
+            if closed:
+                raise ValueError(f"Invalid JSON in {path} at character {offset + pos}: Extra data after the array")
+            if in_array and buffer[pos] == "]":
+                closed = True
+                pos += 1
+                continue
+            try:
+                doc, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise ValueError(f"Invalid JSON in {path} at character {offset + e.pos}: {e.msg}") from e
+                # The document runs past the end of the buffer
+                chunk = f.read(chunk_size)
+                offset += pos
+                buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+                continue
+            if not isinstance(doc, dict):
+                raise ValueError(f"Expected a JSON object in {path} at character {offset + pos}, got {type(doc).__name__}")
+            pos = end
+            yield doc
+
+class StageStats:
+    """Throughput of one pipeline stage. Time starved waiting on an empty input queue means the stage upstream
+    is the bottleneck, time blocked on a full output queue means the stage downstream is."""
+    __slots__ = ("name", "workers", "documents", "busy", "starved", "blocked")
+
+    def __init__(self, name: str, workers: int = 1):
+        self.name = name
+        self.workers = workers
+        self.documents = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    async def get(self, queue: asyncio.Queue) -> Any:
+        started = time.monotonic()
+        item = await queue.get()
+        self.starved += time.monotonic() - started
+        return item
+
+    async def put(self, queue: asyncio.Queue, item: Any):
+        started = time.monotonic()
+        await queue.put(item)
+        self.blocked += time.monotonic() - started
+
+    def summary(self, seconds: float) -> str:
+        worker_seconds = max(seconds * self.workers, 1e-9)
+        return (f"{self.name}: {self.documents} docs, {self.documents / max(seconds, 1e-9):.0f} docs/s, busy {self.busy / worker_seconds:.0%}, "
+                f"starved {self.starved / worker_seconds:.0%}, blocked {self.blocked / worker_seconds:.0%}")
+
+class IngestionReport:
+    def __init__(self, stages: List[StageStats]):
+        self.stages = stages
+        self.seconds = 0.0
+        self.embedded = 0
+        self.merged = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.failed: List[str] = []
+        self.uploader: Optional[DocumentUploader] = None
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.embedded or self.merged or self.deleted)
+
+    def summary(self) -> str:
+        return (f"Skipped {self.unchanged} unchanged documents, embedded {self.embedded}, merged {self.merged}, deleted {self.deleted}"
+                + (f", {len(self.failed)} failed and will be retried next run" if self.failed else ""))
+
+class IngestionPipeline:
+    """Reads, embeds and uploads a catalog as a stream.
+
+    The reader classifies each document against the manifest and batches the ones that need work. Embedding
+    and upload workers take batches from bounded queues, so however large the catalog, only a few batches
+    (and their embeddings) are in memory at a time. Deletions are sent once the whole catalog has been read.
+    """
+
+    def __init__(self, index_manager: "IndexManager", batch_size: int = 256, queue_batches: int = 4,
+                 embed_workers: int = 4, upload_workers: int = 2, report_interval: float = 10.0):
+        self.index_manager = index_manager
+        # Documents per embedding request, and per hand-off to the uploader which splits them to the service's request limits
+        self.batch_size = batch_size
+        self.queue_batches = queue_batches
+        self.embed_workers = embed_workers
+        self.upload_workers = upload_workers
+        self.report_interval = report_interval
+
+    async def run(self, documents: Iterable[Dict[str, Any]], manifest: IndexManifest,
+                  on_uploaded: Optional[Callable[[Dict[str, Any]], None]] = None) -> IngestionReport:
+        """Syncs the index with documents. on_uploaded(doc) is called for every re-embedded document the service accepted."""
+        manager = self.index_manager
+        read_stats, embed_stats, upload_stats = StageStats("read"), StageStats("embed", self.embed_workers), StageStats("upload", self.upload_workers)
+        report = IngestionReport([read_stats, embed_stats, upload_stats])
+        embed_queue: asyncio.Queue = asyncio.Queue(self.queue_batches)
+        upload_queue: asyncio.Queue = asyncio.Queue(self.queue_batches)
+        started = time.monotonic()
+
+        async def read():
+            seen = set()
+            batches: Dict[str, List[Dict[str, Any]]] = {"embed": [], "merge": []}
+            mark = time.monotonic()
+            for doc in documents:
+                id = str(doc["id"])
+                seen.add(id)
+                read_stats.documents += 1
+                kind = manifest.classify(doc, manager._embedding_text(doc))
+                if kind == "unchanged":
+                    report.unchanged += 1
+                    continue
+                batches[kind].append(doc)
+                if len(batches[kind]) >= self.batch_size:
+                    read_stats.busy += time.monotonic() - mark
+                    await read_stats.put(embed_queue if kind == "embed" else upload_queue, (kind, batches[kind]))
+                    batches[kind] = []
+                    mark = time.monotonic()
+            read_stats.busy += time.monotonic() - mark
+            if batches["embed"]:
+                await read_stats.put(embed_queue, ("embed", batches["embed"]))
+            if batches["merge"]:
+                await read_stats.put(upload_queue, ("merge", batches["merge"]))
+            # Only after the whole catalog was read is it known what disappeared from it
+            stale = manifest.stale(seen)
+            for i in range(0, len(stale), self.batch_size):
+                await read_stats.put(upload_queue, ("delete", [{"id": id} for id in stale[i:i + self.batch_size]]))
+            for _ in range(self.embed_workers):
+                await read_stats.put(embed_queue, None)
+
+        async def embed():
+            while (item := await embed_stats.get(embed_queue)) is not None:
+                _, batch = item
+                mark = time.monotonic()
+                embeddings = await manager.embedder.embed([manager._embedding_text(doc) for doc in batch])
+                for doc, embedding in zip(batch, embeddings):
+                    doc["embedding"] = embedding
+                embed_stats.busy += time.monotonic() - mark
+                embed_stats.documents += len(batch)
+                await embed_stats.put(upload_queue, item)
+
+        async def embed_stage():
+            await asyncio.gather(*(embed() for _ in range(self.embed_workers)))
+            for _ in range(self.upload_workers):
+                await embed_stats.put(upload_queue, None)
+
+        # Methods of SearchClient per kind of batch. The merge leaves the stored embedding of those documents as it is.
+        methods = {"embed": "upload_documents", "merge": "merge_or_upload_documents", "delete": "delete_documents"}
+
+        async def upload(uploader: DocumentUploader):
+            while (item := await upload_stats.get(upload_queue)) is not None:
+                kind, batch = item
+                mark = time.monotonic()
+                failures = await uploader.send(methods[kind], batch)
+                # Only what the service accepted goes into the manifest, the rest is retried on the next run
+                report.failed.extend(failures)
+                for doc in batch:
+                    key = str(doc["id"])
+                    if key in failures:
+                        continue
+                    if kind == "delete":
+                        manifest.forget(key)
+                        report.deleted += 1
+                        continue
+                    manifest.record(doc, manager._embedding_text(doc))
+                    if kind == "embed":
+                        report.embedded += 1
+                        if on_uploaded is not None:
+                            on_uploaded(doc)
+                    else:
+                        report.merged += 1
+                upload_stats.busy += time.monotonic() - mark
+                upload_stats.documents += len(batch)
+
+        async def progress():
+            while True:
+                await asyncio.sleep(self.report_interval)
+                seconds = time.monotonic() - started
+                print(f"[{seconds:.0f}s] queued for embedding {embed_queue.qsize()}/{self.queue_batches} batches, "
+                      f"for upload {upload_queue.qsize()}/{self.queue_batches}; "
+                      + "; ".join(stage.summary(seconds) for stage in report.stages))
+
+        async with manager.search_client() as search_client:
+            uploader = DocumentUploader(search_client, max_concurrency=self.upload_workers)
+            report.uploader = uploader
+            tasks = [asyncio.create_task(read()), asyncio.create_task(embed_stage())]
+            tasks += [asyncio.create_task(upload(uploader)) for _ in range(self.upload_workers)]
+            reporter = asyncio.create_task(progress())
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks + [reporter]:
+                    task.cancel()
+                # Whatever was uploaded before a failure doesn't need to be sent again
+                manifest.save()
+        report.seconds = time.monotonic() - started
+        return report
@@ -0,0 +1,418 @@
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+import aiohttp
+from aiohttp import web
+
+from recording import SOURCE_CLIENT, SOURCE_MIDDLE_TIER, SOURCE_UPSTREAM, RecordedFrame, SessionRecording
+from rtmt import BINARY_AUDIO_PROTOCOL, peek_event_type
+
+# Capacity test for the realtime voice path without any network access: a local stub replays recorded (or
+# synthetic) realtime service traffic, the app from app.create_app() runs in its own worker process pointed
+# at that stub, and N fake browsers replay the client side of the recording against it.
+#
+#   python loadtest.py --clients 10,50,100,200
+#   python loadtest.py --recording recordings/<session>.jsonl --clients 50 --output report.json
+#
+# Sessions are recorded by the app itself when REALTIME_RECORD_DIR is set.
+
+DATA_FILE = Path(__file__).parent.parent.parent / "data" / "flat_data.json"
+
+# Middle tier messages the realtime service reacts to; the stub holds back what followed them in the recording
+# until the same messages (and the same amount of input audio) have arrived
+_TRIGGER_EVENTS = frozenset({
+    "session.update",
+    "input_audio_buffer.commit",
+    "input_audio_buffer.clear",
+    "conversation.item.create",
+    "response.create",
+    "response.cancel",
+})
+
+def _event_type(data: str) -> str:
+    return peek_event_type(data) or json.loads(data)["type"]
+
+def _appended_audio_bytes(data: str) -> int:
+    return len(base64.b64decode(json.loads(data)["audio"]))
+
+class _ScriptedFrame:
+    __slots__ = ("data", "t", "triggers", "audio_bytes", "gate_t")
+
+    def __init__(self, data: str, t: float, triggers: int, audio_bytes: int, gate_t: float):
+        self.data = data
+        self.t = t
+        self.triggers = triggers
+        self.audio_bytes = audio_bytes
+        self.gate_t = gate_t
+
+def _upstream_script(recording: SessionRecording) -> list[_ScriptedFrame]:
+    script = []
+    triggers = audio_bytes = 0
+    gate_t = 0.0
+    for frame in recording:
+        if frame.source == SOURCE_MIDDLE_TIER and not frame.binary:
+            event_type = _event_type(frame.data)
+            if event_type == "input_audio_buffer.append":
+                audio_bytes += _appended_audio_bytes(frame.data)
+                gate_t = frame.t
+            elif event_type in _TRIGGER_EVENTS:
+                triggers += 1
+                gate_t = frame.t
+        elif frame.source == SOURCE_UPSTREAM:
+            script.append(_ScriptedFrame(frame.data, frame.t, triggers, audio_bytes, gate_t))
+    return script
+
+class StubRealtimeServer:
+    """Emulates /openai/realtime by replaying the upstream side of a recording, paced by what the middle tier sends."""
+
+    def __init__(self, recording: SessionRecording, speed: float = 1.0):
+        self.script = _upstream_script(recording)
+        self.speed = speed
+        self.connections = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handler(self, request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.connections += 1
+        loop = asyncio.get_running_loop()
+        received = {"triggers": 0, "audio_bytes": 0}
+        changed = asyncio.Event()
+
+        async def receive():
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                event_type = _event_type(msg.data)
+                if event_type == "input_audio_buffer.append":
+                    received["audio_bytes"] += _appended_audio_bytes(msg.data)
+                elif event_type in _TRIGGER_EVENTS:
+                    received["triggers"] += 1
+                changed.set()
+
+        async def replay():
+            anchor_wall, anchor_t = loop.time(), 0.0
+            for frame in self.script:
+                if received["triggers"] < frame.triggers or received["audio_bytes"] < frame.audio_bytes:
+                    while received["triggers"] < frame.triggers or received["audio_bytes"] < frame.audio_bytes:
+                        changed.clear()
+                        await changed.wait()
+                    anchor_wall, anchor_t = loop.time(), frame.gate_t
+                delay = anchor_wall + (frame.t - anchor_t) / self.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await ws.send_str(frame.data)
+
+        receiver = asyncio.create_task(receive())
+        replayer = asyncio.create_task(replay())
+        try:
+            await receiver
+        finally:
+            replayer.cancel()
+            await asyncio.wait([replayer])
+        return ws
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_get("/openai/realtime", self._handler)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        bound_host, bound_port = self._runner.addresses[0][:2]
+        return f"http://{bound_host}:{bound_port}"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+def synthetic_recording(turns: int = 4, speech_seconds: float = 2.0, response_audio_chunks: int = 30, tool_turns: tuple[int, ...] = (1, 3), tool_seconds: float = 0.3) -> SessionRecording:
+    """A plausible session: server VAD turns of 100 ms PCM16 chunks, streamed audio answers and search tool calls."""
+    chunk = base64.b64encode(os.urandom(4800)).decode("ascii")
+    frames: list[RecordedFrame] = []
+
+    def add(t: float, source: str, message: dict):
+        frames.append(RecordedFrame(t, source, json.dumps(message)))
+
+    def both(t: float, message: dict):
+        add(t, SOURCE_CLIENT, message)
+        add(t, SOURCE_MIDDLE_TIER, message)
+
+    def respond(t: float, r: str) -> float:
+        add(t, SOURCE_UPSTREAM, {"type": "response.created", "event_id": f"{r}_created", "response": {"id": r, "output": []}})
+        add(t + 0.01, SOURCE_UPSTREAM, {"type": "response.output_item.added", "event_id": f"{r}_added", "response_id": r, "item": {"id": f"{r}_item", "type": "message"}})
+        for i in range(response_audio_chunks):
+            t += 0.05
+            add(t, SOURCE_UPSTREAM, {"type": "response.audio.delta", "event_id": f"{r}_a{i}", "response_id": r, "item_id": f"{r}_item", "output_index": 0, "content_index": 0, "delta": chunk})
+            add(t, SOURCE_UPSTREAM, {"type": "response.audio_transcript.delta", "event_id": f"{r}_t{i}", "response_id": r, "item_id": f"{r}_item", "output_index": 0, "content_index": 0, "delta": "word "})
+        add(t + 0.01, SOURCE_UPSTREAM, {"type": "response.audio.done", "event_id": f"{r}_audio_done", "response_id": r, "item_id": f"{r}_item"})
+        add(t + 0.02, SOURCE_UPSTREAM, {"type": "response.done", "event_id": f"{r}_done", "response": {"id": r, "status": "completed", "output": [{"id": f"{r}_item", "type": "message"}]}})
+        return t + 0.02
+
+    add(0.05, SOURCE_UPSTREAM, {"type": "session.created", "event_id": "session_created", "session": {"id": "sess_synthetic"}})
+    both(0.1, {"type": "session.update", "session": {"turn_detection": {"type": "server_vad"}}})
+    add(0.15, SOURCE_UPSTREAM, {"type": "session.updated", "event_id": "session_updated", "session": {"id": "sess_synthetic"}})
+
+    t = 0.5
+    for turn in range(turns):
+        start = t
+        for i in range(int(speech_seconds * 10)):
+            both(t, {"type": "input_audio_buffer.append", "audio": chunk})
+            if i == 2:
+                add(t + 0.01, SOURCE_UPSTREAM, {"type": "input_audio_buffer.speech_started", "event_id": f"turn{turn}_started", "audio_start_ms": int((t - start) * 1000)})
+            t += 0.1
+        user_item = f"turn{turn}_user"
+        add(t, SOURCE_UPSTREAM, {"type": "input_audio_buffer.speech_stopped", "event_id": f"turn{turn}_stopped", "audio_end_ms": int((t - start) * 1000)})
+        add(t + 0.01, SOURCE_UPSTREAM, {"type": "input_audio_buffer.committed", "event_id": f"turn{turn}_committed", "item_id": user_item})
+        add(t + 0.02, SOURCE_UPSTREAM, {"type": "conversation.item.created", "event_id": f"turn{turn}_user_created", "previous_item_id": None, "item": {"id": user_item, "type": "message", "role": "user"}})
+        t += 0.3
+        if turn in tool_turns:
+            r, call_id = f"turn{turn}_call", f"call_{turn}"
+            arguments = json.dumps({"query": "flat in Neubau with balcony"})
+            call = {"id": f"{r}_item", "type": "function_call", "call_id": call_id, "name": "search", "arguments": arguments}
+            add(t, SOURCE_UPSTREAM, {"type": "response.created", "event_id": f"{r}_created", "response": {"id": r, "output": []}})
+            add(t + 0.01, SOURCE_UPSTREAM, {"type": "response.output_item.added", "event_id": f"{r}_added", "response_id": r, "item": {**call, "arguments": ""}})
+            add(t + 0.02, SOURCE_UPSTREAM, {"type": "conversation.item.created", "event_id": f"{r}_item_created", "previous_item_id": user_item, "item": {**call, "arguments": ""}})
+            add(t + 0.05, SOURCE_UPSTREAM, {"type": "response.function_call_arguments.delta", "event_id": f"{r}_args", "response_id": r, "call_id": call_id, "delta": arguments})
+            add(t + 0.06, SOURCE_UPSTREAM, {"type": "response.function_call_arguments.done", "event_id": f"{r}_args_done", "response_id": r, "call_id": call_id, "arguments": arguments})
+            add(t + 0.07, SOURCE_UPSTREAM, {"type": "response.output_item.done", "event_id": f"{r}_item_done", "response_id": r, "item": call})
+            add(t + 0.08, SOURCE_UPSTREAM, {"type": "response.done", "event_id": f"{r}_done", "response": {"id": r, "status": "completed", "output": [call]}})
+            t += 0.08 + tool_seconds
+            add(t, SOURCE_MIDDLE_TIER, {"type": "conversation.item.create", "item": {"type": "function_call_output", "call_id": call_id, "output": "{}"}})
+            add(t + 0.01, SOURCE_MIDDLE_TIER, {"type": "response.create"})
+            t += 0.3
+        t = respond(t, f"turn{turn}_answer") + 1.0
+    frames.sort(key=lambda frame: frame.t)
+    return SessionRecording(frames)
+
+def _percentile(values: list[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+class _ClientStats:
+    def __init__(self):
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.bytes_received = 0
+        # End of the user's audio to the first audio of the answer, tool calls included
+        self.turn_latencies: list[float] = []
+        # Longest silence between two audio chunks of the same answer
+        self.audio_gaps: list[float] = []
+        self.errors = 0
+
+async def _run_client(http: aiohttp.ClientSession, url: str, frames: list[RecordedFrame], duration: float, speed: float, binary: bool, stats: _ClientStats):
+    loop = asyncio.get_running_loop()
+    state = {"last_sent": loop.time(), "awaiting_audio": True, "last_audio": None, "max_gap": 0.0}
+    protocols = (BINARY_AUDIO_PROTOCOL,) if binary else ()
+    try:
+        async with http.ws_connect(url, protocols=protocols) as ws:
+            async def receive():
+                async for msg in ws:
+                    now = loop.time()
+                    stats.frames_received += 1
+                    stats.bytes_received += len(msg.data) if msg.data else 0
+                    event_type = None if msg.type == aiohttp.WSMsgType.BINARY else peek_event_type(msg.data)
+                    if msg.type == aiohttp.WSMsgType.BINARY or event_type == "response.audio.delta":
+                        if state["awaiting_audio"]:
+                            stats.turn_latencies.append(now - state["last_sent"])
+                            state["awaiting_audio"] = False
+                        elif state["last_audio"] is not None:
+                            state["max_gap"] = max(state["max_gap"], now - state["last_audio"])
+                        state["last_audio"] = now
+                    elif event_type == "response.done":
+                        if state["last_audio"] is not None:
+                            stats.audio_gaps.append(state["max_gap"])
+                        state.update(awaiting_audio=True, last_audio=None, max_gap=0.0)
+
+            receiver = asyncio.create_task(receive())
+            started = loop.time()
+            for frame in frames:
+                delay = started + frame.t / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if binary and not frame.binary and peek_event_type(frame.data) == "input_audio_buffer.append":
+                    await ws.send_bytes(base64.b64decode(json.loads(frame.data)["audio"]))
+                elif frame.binary:
+                    await ws.send_bytes(frame.data)
+                else:
+                    await ws.send_str(frame.data)
+                state["last_sent"] = loop.time()
+                stats.frames_sent += 1
+            # Let the last answer play out before hanging up
+            await asyncio.sleep(max(0.0, started + duration / speed + 1.0 - loop.time()))
+            await ws.close()
+            await receiver
+    except (aiohttp.ClientError, ConnectionResetError, asyncio.TimeoutError):
+        stats.errors += 1
+
+def _stub_listings() -> list[dict[str, Any]]:
+    with open(DATA_FILE, "r") as f:
+        return json.load(f)[:5]
+
+def _serve_middle_tier(port: int, upstream_endpoint: str, tool_latency: float, audio_coalesce_ms: Optional[float]):
+    # Imported first so the .env loading done at import time can't point the worker at real services afterwards
+    import app as voicerag_app
+    from rtmt import RTMT_APP_KEY, ToolResult, ToolResultDirection
+
+    os.environ.update({
+        "RUNNING_IN_PRODUCTION": "1",
+        "AZURE_OPENAI_ENDPOINT": upstream_endpoint,
+        "AZURE_OPENAI_REALTIME_DEPLOYMENT": "loadtest",
+        "AZURE_OPENAI_API_KEY": "loadtest",
+        "AZURE_OPENAI_API_VERSION": os.environ.get("AZURE_OPENAI_API_VERSION") or "2024-10-01-preview",
+        "AZURE_SEARCH_SERVICE_NAME": "loadtest",
+        "AZURE_SEARCH_API_KEY": "loadtest",
+        "AZURE_SEARCH_INDEX": "loadtest",
+        "REALTIME_RECORD_DIR": "",
+    })
+    listings = _stub_listings()
+
+    async def search(args: Any) -> ToolResult:
+        await asyncio.sleep(tool_latency)
+        return ToolResult({"listings": listings}, ToolResultDirection.TO_CLIENT)
+
+    async def make_app() -> web.Application:
+        application = await voicerag_app.create_app()
+        rtmt = application[RTMT_APP_KEY]
+        # The search tool would reach Azure, answer with catalog listings after a fixed delay instead
+        rtmt.tools["search"].target = search
+        if audio_coalesce_ms:
+            rtmt.audio_coalesce_ms = audio_coalesce_ms
+        return application
+
+    web.run_app(make_app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _process_usage(pid: int) -> tuple[float, int]:
+    """CPU seconds and resident bytes of a process, from /proc (Linux only)."""
+    with open(f"/proc/{pid}/stat", "r") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    with open(f"/proc/{pid}/statm", "r") as f:
+        rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    return cpu, rss
+
+async def _wait_until_serving(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as http:
+        while True:
+            try:
+                async with http.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Middle tier did not come up at {url}")
+            await asyncio.sleep(0.2)
+
+async def run_level(base_url: str, worker_pid: int, recording: SessionRecording, clients: int, ramp_seconds: float, speed: float, binary: bool) -> dict[str, Any]:
+    frames = list(recording.from_source(SOURCE_CLIENT))
+    stats = [_ClientStats() for _ in range(clients)]
+    cpu_before, rss_before = _process_usage(worker_pid)
+    peak_rss = rss_before
+
+    async def sample_memory():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, _process_usage(worker_pid)[1])
+            await asyncio.sleep(0.25)
+
+    async def start_client(i: int, http: aiohttp.ClientSession):
+        await asyncio.sleep(ramp_seconds * i / clients)
+        await _run_client(http, f"{base_url}/realtime", frames, recording.duration, speed, binary, stats[i])
+
+    sampler = asyncio.create_task(sample_memory())
+    started = time.monotonic()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as http:
+        await asyncio.gather(*(start_client(i, http) for i in range(clients)))
+    elapsed = time.monotonic() - started
+    sampler.cancel()
+    cpu_after, _ = _process_usage(worker_pid)
+
+    latencies = [latency for s in stats for latency in s.turn_latencies]
+    gaps = [gap for s in stats for gap in s.audio_gaps]
+    frames_relayed = sum(s.frames_sent + s.frames_received for s in stats)
+    cpu = cpu_after - cpu_before
+    session_minutes = clients * recording.duration / speed / 60
+    ms = lambda value: round(value * 1000, 1) if value is not None else None
+    return {
+        "clients": clients,
+        "seconds": round(elapsed, 2),
+        "errors": sum(s.errors for s in stats),
+        "frames_per_second": round(frames_relayed / elapsed, 1),
+        "mbytes_to_clients_per_second": round(sum(s.bytes_received for s in stats) / elapsed / 1e6, 2),
+        "turns": len(latencies),
+        "turn_latency_ms": {"p50": ms(_percentile(latencies, 50)), "p95": ms(_percentile(latencies, 95)), "p99": ms(_percentile(latencies, 99)), "max": ms(max(latencies, default=None))},
+        "audio_gap_ms": {"p50": ms(_percentile(gaps, 50)), "p99": ms(_percentile(gaps, 99)), "max": ms(max(gaps, default=None))},
+        "worker_cpu_percent": round(cpu / elapsed * 100, 1),
+        "worker_cpu_ms_per_session_minute": round(cpu * 1000 / session_minutes, 1) if session_minutes else None,
+        "worker_rss_mb": round(rss_before / 1e6, 1),
+        "worker_peak_rss_mb": round(peak_rss / 1e6, 1),
+        "worker_kb_per_session": round((peak_rss - rss_before) / 1e3 / clients, 1),
+    }
+
+def _print_report(results: list[dict[str, Any]]):
+    print(f"{'clients':>8} {'errors':>6} {'frames/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'gap p99':>8} {'cpu %':>7} {'cpu ms/min':>10} {'kB/sess':>8}")
+    for r in results:
+        latency, gap = r["turn_latency_ms"], r["audio_gap_ms"]
+        print(f"{r['clients']:>8} {r['errors']:>6} {r['frames_per_second']:>10,.0f} {latency['p50'] or 0:>8} {latency['p95'] or 0:>8} {latency['p99'] or 0:>8} "
+              f"{gap['p99'] or 0:>8} {r['worker_cpu_percent']:>7} {r['worker_cpu_ms_per_session_minute'] or 0:>10} {r['worker_kb_per_session']:>8}")
+
+async def main(args: argparse.Namespace):
+    recording = SessionRecording.load(args.recording) if args.recording else synthetic_recording()
+    stub = StubRealtimeServer(recording, speed=args.speed)
+    upstream_endpoint = await stub.start()
+
+    port = _free_port()
+    worker = multiprocessing.Process(target=_serve_middle_tier, args=(port, upstream_endpoint, args.tool_latency, args.audio_coalesce_ms), daemon=True)
+    worker.start()
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        await _wait_until_serving(f"{base_url}/metrics")
+        results = []
+        for clients in args.clients:
+            result = await run_level(base_url, worker.pid, recording, clients, args.ramp, args.speed, args.binary)
+            results.append(result)
+            _print_report([result])
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"recording": args.recording or "synthetic", "speed": args.speed, "binary": args.binary, "levels": results}, f, indent=2)
+            print(f"Report written to {args.output}")
+    finally:
+        worker.terminate()
+        worker.join()
+        await stub.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the realtime middle tier against a local stub of the realtime service")
+    parser.add_argument("--recording", help="session recording (.jsonl) to replay, defaults to a synthetic session")
+    parser.add_argument("--synthesize", metavar="PATH", help="write the synthetic session to PATH and exit")
+    parser.add_argument("--clients", type=lambda value: [int(n) for n in value.split(",")], default=[10, 50, 100], help="comma separated concurrency levels")
+    parser.add_argument("--ramp", type=float, default=2.0, help="seconds over which clients connect")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier")
+    parser.add_argument("--tool-latency", type=float, default=0.3, help="seconds the stubbed search tool takes")
+    parser.add_argument("--audio-coalesce-ms", type=float, help="enable input audio coalescing in the worker")
+    parser.add_argument("--binary", action="store_true", help="use the binary PCM16 transport")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    if args.synthesize:
+        synthetic_recording().save(args.synthesize)
+    else:
+        asyncio.run(main(args))
@@ -0,0 +1,185 @@
+import json
+import math
+import os
+from typing import Any, Callable, Iterable, Optional
+
+import numpy as np
+
+PRECISIONS = ("float32", "float16", "int8", "binary")
+
+# Candidates per requested result that a quantized search re-scores with the full-precision vectors
+DEFAULT_OVERSAMPLING = 4.0
+
+# Rows scored per step when the matrix is stored below float32, keeps the temporary float32 copy cache sized
+_SCORE_BLOCK_ROWS = 256
+# Binary rows are 32 times smaller and their temporaries are bytes, so they are scored in larger steps
+_BINARY_BLOCK_ROWS = 8192
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+_bit_count = getattr(np, "bitwise_count", _POPCOUNT.__getitem__)
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+def precision_of(codes: np.ndarray) -> str:
+    return "binary" if codes.dtype == np.uint8 else str(codes.dtype)
+
+def quantize(vectors: np.ndarray, precision: str) -> tuple[np.ndarray, Optional[np.ndarray]]:
+    """Codes for L2-normalized vectors, plus a float32 scale per row for int8. binary keeps one sign bit per
+    dimension, packed eight to a byte."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {', '.join(PRECISIONS)}")
+    if precision == "int8":
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+        return np.ascontiguousarray(np.round(vectors / scales[:, None]).astype(np.int8)), scales.astype(np.float32)
+    if precision == "binary":
+        return np.ascontiguousarray(np.packbits(vectors > 0, axis=1)), None
+    return np.ascontiguousarray(vectors.astype(precision)), None
+
+def dequantize(codes: np.ndarray, scales: Optional[np.ndarray], dimensions: int) -> np.ndarray:
+    """Approximate float32 vectors back from codes (exact for float32)."""
+    if codes.dtype == np.uint8:
+        return (np.unpackbits(codes, axis=1, count=dimensions).astype(np.float32) * 2 - 1) / np.sqrt(dimensions)
+    vectors = codes.astype(np.float32)
+    if scales is not None:
+        vectors *= scales[:, None]
+    return vectors
+
+def quantized_scores(codes: np.ndarray, scales: Optional[np.ndarray], query: np.ndarray) -> np.ndarray:
+    """Cosine similarity of a normalized query to every row of codes, estimated for quantized codes.
+
+    Binary codes are compared by Hamming distance to the query's sign bits: the cosine of two sign vectors
+    that differ in h of d dimensions is 1 - 2h/d.
+    """
+    if codes.dtype == np.float32:
+        return codes @ query
+    scores = np.empty(len(codes), dtype=np.float32)
+    if codes.dtype == np.uint8:
+        bits = np.packbits(query > 0)
+        for start in range(0, len(codes), _BINARY_BLOCK_ROWS):
+            block = codes[start:start + _BINARY_BLOCK_ROWS]
+            scores[start:start + len(block)] = 1 - 2 * _bit_count(block ^ bits).sum(axis=1, dtype=np.int32) / len(query)
+        return scores
+    for start in range(0, len(codes), _SCORE_BLOCK_ROWS):
+        block = codes[start:start + _SCORE_BLOCK_ROWS]
+        scores[start:start + len(block)] = block.astype(np.float32) @ query
+    if scales is not None:
+        scores *= scales
+    return scores
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+def originals_path(path: str) -> str:
+    """Where a snapshot keeps its full-precision vectors, as a plain .npy file that can be memory-mapped."""
+    return f"{os.path.splitext(path)[0]}.originals.npy"
+
+class LocalVectorIndex:
+    """Listings and their embeddings held in one contiguous matrix, searched in-process by cosine similarity.
+
+    Rows are L2-normalized when loaded, so a cosine top-k is a single matrix-vector product. float16 halves
+    the memory of the matrix; int8 quarters it, with a float32 scale per row to undo the quantization; binary
+    keeps one bit per dimension. With rescoring, a quantized search takes k * oversampling candidates and
+    orders them by their full-precision vectors, which a loaded snapshot leaves on disk, memory-mapped.
+    """
+
+    def __init__(self, documents: list[dict[str, Any]], embeddings: np.ndarray, precision: str = "float32",
+                 rescore: bool = False, oversampling: float = DEFAULT_OVERSAMPLING):
+        if len(documents) != len(embeddings):
+            raise ValueError(f"Got {len(documents)} documents but {len(embeddings)} embeddings")
+        self.precision = precision
+        self.documents = [{key: value for key, value in doc.items() if key != "embedding"} for doc in documents]
+        vectors = normalize(embeddings)
+        self._dimensions = vectors.shape[1]
+        self.vectors, self._scales = quantize(vectors, precision)
+        # A float32 index is its own full-precision copy
+        self.originals: Optional[np.ndarray] = vectors if rescore and precision != "float32" else None
+        self.oversampling = oversampling
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    @property
+    def dimensions(self) -> int:
+        return self._dimensions
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes of the matrix that every search scans, full-precision vectors for rescoring not included."""
+        return self.vectors.nbytes + (self._scales.nbytes if self._scales is not None else 0)
+
+    def search(self, embedding: Iterable[float], k: int = 3, where: Optional[Callable[[dict[str, Any]], bool]] = None) -> list[dict[str, Any]]:
+        """Top-k documents by cosine similarity, shaped like Azure AI Search results (fields plus '@search.score')."""
+        query = np.asarray(embedding, dtype=np.float32)
+        if query.shape != (self.dimensions,):
+            raise ValueError(f"Query has {query.size} dimensions, the index has {self.dimensions}")
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        scores = quantized_scores(self.vectors, self._scales, query)
+        if where is not None:
+            # Filtered out rows can never make it into the top-k
+            scores[[i for i, doc in enumerate(self.documents) if not where(doc)]] = -np.inf
+        if self.originals is None:
+            top = top_k(scores, k)
+        else:
+            candidates = top_k(scores, math.ceil(k * self.oversampling))
+            candidates = np.sort(candidates[scores[candidates] != -np.inf])
+            # In row order, so a memory-mapped matrix is read front to back
+            scores[candidates] = np.asarray(self.originals[candidates], dtype=np.float32) @ query
+            top = candidates[np.argsort(-scores[candidates], kind="stable")][:k]
+        return [{**self.documents[i], "@search.score": float(scores[i])} for i in top if scores[i] != -np.inf]
+
+    def filter(self, where: Callable[[dict[str, Any]], bool], top: int = 50) -> list[dict[str, Any]]:
+        return [dict(doc) for doc in self.documents if where(doc)][:top]
+
+    def as_float32(self) -> np.ndarray:
+        """The normalized vectors: the full-precision ones if kept, otherwise approximated from the quantized matrix."""
+        if self.originals is not None:
+            return np.asarray(self.originals, dtype=np.float32)
+        return dequantize(self.vectors, self._scales, self.dimensions)
+
+    def embeddings_by_id(self) -> dict[Any, np.ndarray]:
+        """The stored vectors by document id (normalized, and approximate for quantized indexes without rescoring)."""
+        return {doc.get("id"): vector for doc, vector in zip(self.documents, self.as_float32())}
+
+    @staticmethod
+    def from_documents(documents: list[dict[str, Any]], precision: str = "float32", **kwargs) -> "LocalVectorIndex":
+        """Builds the index from documents that carry their vector in an 'embedding' field, as uploaded by IndexManager."""
+        return LocalVectorIndex(documents, np.array([doc["embedding"] for doc in documents], dtype=np.float32), precision, **kwargs)
+
+    def save(self, path: str):
+        # Stored as held in memory, so a quantized index stays quantized on disk. Full-precision vectors, when
+        # there are any, go to a separate .npy file instead of being stored twice.
+        full = self.vectors if self.precision == "float32" else self.originals
+        if full is not None:
+            np.save(originals_path(path), np.asarray(full, dtype=np.float32))
+        np.savez(path, vectors=self.vectors if self.precision != "float32" else np.empty((0, self.dimensions), dtype=np.float32),
+                 scales=self._scales if self._scales is not None else np.empty(0, dtype=np.float32),
+                 documents=np.array(json.dumps(self.documents)), precision=np.array(self.precision), dimensions=np.array(self.dimensions))
+
+    @staticmethod
+    def load(path: str, precision: Optional[str] = None, rescore: bool = False, oversampling: float = DEFAULT_OVERSAMPLING) -> "LocalVectorIndex":
+        """Loads a snapshot, re-quantized to precision if given. Rescoring needs the snapshot's full-precision vectors."""
+        with np.load(path) as snapshot:
+            codes = snapshot["vectors"]
+            scales = snapshot["scales"] if snapshot["scales"].size else None
+            documents = json.loads(str(snapshot["documents"]))
+            # Snapshots written before binary precision and the separate full-precision file
+            stored_precision = str(snapshot["precision"]) if "precision" in snapshot.files else precision_of(codes)
+            dimensions = int(snapshot["dimensions"]) if "dimensions" in snapshot.files else codes.shape[1]
+        originals = np.load(originals_path(path), mmap_mode="r") if os.path.exists(originals_path(path)) else None
+        if originals is None and stored_precision == "float32":
+            originals = codes
+        index = LocalVectorIndex(documents, originals if originals is not None else dequantize(codes, scales, dimensions),
+                                 precision or stored_precision, oversampling=oversampling)
+        if rescore and index.precision != "float32":
+            if originals is None:
+                raise ValueError(f"{path} has no full-precision vectors to rescore with, rebuild it with index_manager.py")
+            index.originals = originals
+        return index
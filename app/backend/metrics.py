@@ -0,0 +1,147 @@
+import bisect
+import math
+from typing import Iterable
+
+from aiohttp import web
+
+# Everything runs on the event loop, so metrics are plain numbers updated without locks
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Metric:
+    kind: str
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {} if self.labelnames else {(): 0}
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels: tuple = ()) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+    def set(self, value: float, labels: tuple = ()):
+        self._values[labels] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: one count per bucket plus the +Inf bucket, then the sum of observed values
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, labels: tuple = ()):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def count(self, labels: tuple = ()) -> int:
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> Iterable[str]:
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total[0])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric '{metric.name}' is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+REGISTRY = Registry()
+
+# Realtime middle tier
+ACTIVE_SESSIONS = REGISTRY.register(Gauge(
+    "voicerag_realtime_active_sessions", "Realtime sessions currently connected"))
+MESSAGES = REGISTRY.register(Counter(
+    "voicerag_realtime_messages_total", "Realtime messages received, by direction and event type", ("direction", "type")))
+MESSAGE_BYTES = REGISTRY.register(Counter(
+    "voicerag_realtime_message_bytes_total", "Realtime message bytes received, by direction and event type", ("direction", "type")))
+UPSTREAM_CONNECT_SECONDS = REGISTRY.register(Histogram(
+    "voicerag_realtime_upstream_connect_seconds", "Time until the upstream realtime socket is ready for a new session", ("prewarmed",)))
+RESPONSE_AUDIO_SECONDS = REGISTRY.register(Histogram(
+    "voicerag_realtime_committed_to_first_audio_seconds", "Time from input_audio_buffer.committed to the first response.audio.delta"))
+QUEUE_DROPPED_FRAMES = REGISTRY.register(Counter(
+    "voicerag_realtime_queue_dropped_frames_total", "Frames dropped by send queues under backpressure", ("queue",)))
+QUEUE_BLOCKED_SECONDS = REGISTRY.register(Counter(
+    "voicerag_realtime_queue_blocked_seconds_total", "Time readers spent blocked on full send queues", ("queue",)))
+
+# Tools
+TOOL_SECONDS = REGISTRY.register(Histogram(
+    "voicerag_tool_duration_seconds", "Tool execution time", ("tool",)))
+TOOL_CALLS = REGISTRY.register(Counter(
+    "voicerag_tool_calls_total", "Tool calls by outcome", ("tool", "outcome")))
+
+# Search
+EMBEDDING_SECONDS = REGISTRY.register(Histogram(
+    "voicerag_embedding_duration_seconds", "Query embedding round trip time"))
+SEARCH_SECONDS = REGISTRY.register(Histogram(
+    "voicerag_search_duration_seconds", "Search round trip time, by SearchManager method", ("method",)))
+SEARCH_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "voicerag_search_cache_lookups_total", "Search result cache lookups: hit, coalesced onto an identical search in flight, or miss", ("result",)))
+EMBEDDING_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "voicerag_embedding_cache_lookups_total", "Query embedding cache lookups, by the tier that answered (memory, disk or miss)", ("result",)))
+EMBEDDING_CACHE_EVICTIONS = REGISTRY.register(Counter(
+    "voicerag_embedding_cache_evictions_total", "Query embeddings evicted from the in-memory cache to stay under its memory limit"))
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=REGISTRY.render().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
@@ -1,22 +1,47 @@
-from typing import Any
+from typing import Any, AsyncIterator, Optional
 
+from search_filters import VIENNA_DISTRICTS, SearchFilters
 from search_manager import SearchManager
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import DefaultAzureCredential
 
 from rtmt import RTMiddleTier, Tool, ToolResult, ToolResultDirection
+from token_manager import SEARCH_SCOPE, TokenManager
 
 _search_tool_schema = {
     "type": "function",
     "name": "search",
-    "description": "Search the knowledge base for flat listings. The knowlege base will be searched for the query and the results will be returned  ",
+    "description": "Search the knowledge base for flat listings. The knowlege base will be searched for the query and the results will be returned. "
+                   "Pass every hard constraint the user stated (budget, rooms, size, district, amenities) as a parameter so only matching listings come back.",
     "parameters": {
         "type": "object",
         "properties": {
             "query": {
                 "type": "string",
                 "description": "Search query"
-            }
+            },
+            "queries": {
+                "type": "array",
+                "items": {"type": "string"},
+                "description": "Further sub-queries or interpretations of the request (e.g. one per district the user mentioned). "
+                               "They are searched together with 'query' in one go and the results are merged"
+            },
+            "min_price": {"type": "number", "description": "Minimum monthly rent in EUR"},
+            "max_price": {"type": "number", "description": "Maximum monthly rent in EUR"},
+            "min_rooms": {"type": "integer", "description": "Minimum number of rooms"},
+            "max_rooms": {"type": "integer", "description": "Maximum number of rooms"},
+            "min_size": {"type": "number", "description": "Minimum size in square meters"},
+            "max_size": {"type": "number", "description": "Maximum size in square meters"},
+            "locations": {
+                "type": "array",
+                "items": {"type": "string", "enum": VIENNA_DISTRICTS},
+                "description": "Vienna districts the flat may be in"
+            },
+            "furnished": {"type": "boolean", "description": "Only set if the user requires (true) or rules out (false) a furnished flat"},
+            "pets_allowed": {"type": "boolean", "description": "Only set if the user needs pets to be allowed"},
+            "balcony": {"type": "boolean", "description": "Only set if the user requires a balcony"},
+            "elevator": {"type": "boolean", "description": "Only set if the user requires an elevator"},
+            "smoking_allowed": {"type": "boolean", "description": "Only set if the user needs smoking to be allowed"}
         },
         "required": ["query"],
         "additionalProperties": False
@@ -175,32 +200,30 @@ _update_preferences_schema = {
 async def _search_tool(
     search_manager, 
     args: Any
-) -> ToolResult:
+) -> AsyncIterator[ToolResult]:
     print(f"Searching for '{args['query']}' in the knowledge base.")
-    # Use the SearchManager to get vector-based search results
-    results = await search_manager.search_by_embedding(args['query'], k=5)
+    # Constraints are applied by the search itself rather than by the model re-reading unfiltered results
+    try:
+        filters = SearchFilters.from_args(args)
+    except ValueError as e:
+        # Let the model correct the arguments instead of searching without the constraint
+        yield ToolResult(str(e), ToolResultDirection.TO_SERVER)
+        return
 
-    listings = []
-    for r in results:
-        # Extract listing details from the search result. These field names must match your index schema.
-        listing = {
-            "id": r.get("id", "unknown_id"),
-            "title": r.get("title", ""),
-            "description": r.get("description", ""),
-            "location": r.get("location", ""),
-            "price": r.get("price", 0.0),
-            "contact": r.get("contact", ""),
-            "rooms": r.get("rooms", 0),
-            "size": r.get("size", 0),
-            "floor": r.get("floor", 0),
-            "availability": r.get("availability", ""),
-            "lat": r.get("lat", 0.0),
-            "lng": r.get("lng", 0.0),
-        }
-        listings.append(listing)
+    extra_queries = [q for q in args.get("queries") or [] if isinstance(q, str) and q.strip()]
+    if extra_queries:
+        results = await search_manager.search_many([args['query'], *extra_queries], k=5, filters=filters or None)
+        yield ToolResult({"listings": [listing.to_dict() for listing in results]}, ToolResultDirection.TO_CLIENT)
+        return
 
-    # Return the listings list as JSON to the frontend
-    return ToolResult({"listings": listings}, ToolResultDirection.TO_CLIENT)
+    # Every page of results is sent to the frontend as it arrives, so pins show up on the map before the
+    # whole result set is in when it takes several pages; the last result also goes to the model
+    listings = []
+    async for page in search_manager.search_stream(args['query'], k=5, filters=filters or None):
+        listings.extend(listing.to_dict() for listing in page)
+        yield ToolResult({"listings": list(listings)}, ToolResultDirection.TO_CLIENT)
+    if not listings:
+        yield ToolResult({"listings": []}, ToolResultDirection.TO_CLIENT)
 
 
 async def _return_listing_id_tool( 
@@ -244,10 +267,14 @@ async def _update_preferences_tool(args: Any) -> ToolResult:
 def attach_rag_tools(rtmt: RTMiddleTier,
     credentials: AzureKeyCredential | DefaultAzureCredential,
     search_manager: SearchManager, 
+    token_manager: Optional[TokenManager] = None,
     ) -> None:
     
     if not isinstance(credentials, AzureKeyCredential):
-        credentials.get_token("https://search.azure.com/.default") # warm this up before we start getting requests
+        if token_manager is not None:
+            token_manager.add_scope(SEARCH_SCOPE) # fetched on startup and kept fresh in the background
+        else:
+            credentials.get_token(SEARCH_SCOPE) # warm this up before we start getting requests
 
     rtmt.tools["search"] = Tool(
         schema=_search_tool_schema, 
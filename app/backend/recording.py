@@ -0,0 +1,93 @@
+import base64
+import json
+import time
+from typing import Iterator, Optional
+
+# Where a recorded frame was seen by the middle tier
+SOURCE_CLIENT = "client"            # received from the browser
+SOURCE_UPSTREAM = "upstream"        # received from the realtime service
+SOURCE_MIDDLE_TIER = "middle_tier"  # sent by the middle tier to the realtime service
+
+class RecordedFrame:
+    __slots__ = ("t", "source", "data")
+
+    def __init__(self, t: float, source: str, data: str | bytes):
+        self.t = t
+        self.source = source
+        self.data = data
+
+    @property
+    def binary(self) -> bool:
+        return isinstance(self.data, bytes)
+
+    def to_json(self) -> str:
+        if isinstance(self.data, bytes):
+            return json.dumps({"t": round(self.t, 6), "source": self.source, "data": base64.b64encode(self.data).decode("ascii"), "binary": True})
+        return json.dumps({"t": round(self.t, 6), "source": self.source, "data": self.data})
+
+    @staticmethod
+    def from_json(line: str) -> "RecordedFrame":
+        entry = json.loads(line)
+        data = base64.b64decode(entry["data"]) if entry.get("binary") else entry["data"]
+        return RecordedFrame(entry["t"], entry["source"], data)
+
+class SessionRecording:
+    """Both sides of one realtime session with the time each frame was seen, stored as JSON lines.
+
+    A recording loaded from a file reads its frames from there every time they are iterated, so a long
+    session is never held in memory as a whole.
+    """
+
+    def __init__(self, frames: Optional[list[RecordedFrame]] = None, path: Optional[str] = None):
+        self._frames = frames if frames is not None else []
+        self.path = path
+        self._duration: Optional[float] = None
+
+    def __iter__(self) -> Iterator[RecordedFrame]:
+        if self.path is None:
+            yield from self._frames
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield RecordedFrame.from_json(line)
+
+    def from_source(self, source: str) -> Iterator[RecordedFrame]:
+        return (frame for frame in self if frame.source == source)
+
+    @property
+    def duration(self) -> float:
+        if self._duration is None:
+            self._duration = max((frame.t for frame in self), default=0.0)
+        return self._duration
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            for frame in self:
+                f.write(frame.to_json())
+                f.write("\n")
+
+    @staticmethod
+    def load(path: str) -> "SessionRecording":
+        return SessionRecording(path=path)
+
+class SessionRecorder:
+    """Writes the frames of a live session to a recording file as they are seen.
+
+    Frames go through a buffered file, so a session costs at most buffer_size bytes of memory however long
+    it runs, and the disk is written in buffer_size pieces rather than once per frame.
+    """
+
+    def __init__(self, path: str, buffer_size: int = 64 * 1024):
+        self.path = path
+        self._file = open(path, "w", encoding="utf-8", buffering=buffer_size)
+        self._started = time.monotonic()
+        self.frames = 0
+
+    def add(self, source: str, data: str | bytes):
+        self._file.write(RecordedFrame(time.monotonic() - self._started, source, data).to_json())
+        self._file.write("\n")
+        self.frames += 1
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError, ServiceRequestError
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.indexes.models import SearchIndex, SimpleField
+
+from metrics import SEARCH_CACHE_LOOKUPS
+
+logger = logging.getLogger("voicerag")
+
+_GENERATION_KEY = "generation"
+
+def generation_index(index_name: str) -> SearchIndex:
+    """The one-document index next to index_name that holds its generation."""
+    return SearchIndex(name=f"{index_name}-generation", fields=[
+        SimpleField(name="id", type="Edm.String", key=True),
+        SimpleField(name="value", type="Edm.Int64"),
+    ])
+
+class IndexGeneration:
+    """A counter IndexManager bumps after every change to the index, so every worker sees the index changed.
+
+    The indexer usually runs on another host than the app, so the counter lives in the search service, in a
+    one-document index next to the listings (see generation_index). Workers re-read it in the background at
+    most every check_interval seconds, a cache lookup never waits for the service.
+    """
+
+    def __init__(self, endpoint: str, index_name: str, credential: AzureKeyCredential, check_interval: float = 5.0):
+        self.search_client = SearchClient(endpoint=endpoint, index_name=generation_index(index_name).name, credential=credential)
+        self.check_interval = check_interval
+        self._value = 0
+        self._checked_at = float("-inf")
+        self._refresh: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "IndexGeneration":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def current(self) -> int:
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval and (self._refresh is None or self._refresh.done()):
+            self._checked_at = now
+            self._refresh = asyncio.get_running_loop().create_task(self._fetch())
+        return self._value
+
+    async def _read(self) -> int:
+        try:
+            return int((await self.search_client.get_document(key=_GENERATION_KEY))["value"])
+        except ResourceNotFoundError:
+            # No index or no document yet: nothing was indexed since generations were introduced
+            return 0
+
+    async def _fetch(self):
+        try:
+            self._value = await self._read()
+        except (HttpResponseError, ServiceRequestError) as e:
+            # Cached results then live until their TTL, as if the index hadn't changed
+            logger.warning("Failed to read the index generation: %s", e)
+
+    async def bump(self) -> int:
+        value = await self._read() + 1
+        await self.search_client.merge_or_upload_documents(documents=[{"id": _GENERATION_KEY, "value": value}])
+        self._value, self._checked_at = value, time.monotonic()
+        return value
+
+    async def close(self):
+        if self._refresh is not None:
+            self._refresh.cancel()
+        await self.search_client.close()
+
+class SearchResultCache:
+    """LRU of search results tagged with the index generation they were computed against.
+
+    Without a generation the index is taken to never change while the process runs, as for the local
+    backends which load their snapshot once at startup.
+
+    Concurrent lookups of a key that is being computed wait for that computation instead of starting their
+    own. If it fails or is cancelled one of the waiters takes it over and the others wait for that one.
+    """
+
+    def __init__(self, generation: Optional[IndexGeneration] = None, max_entries: int = 2048, ttl: float = 300):
+        self.generation = generation
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[int, float, Any]] = OrderedDict()
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _generation(self) -> int:
+        return self.generation.current() if self.generation is not None else 0
+
+    async def lookup(self, key: Hashable) -> Optional[Any]:
+        """The cached result for key, waiting for it if another caller is computing it. None means the caller should
+        compute it: a miss, or the computation it waited for failed and nobody has taken it over yet."""
+        while True:
+            generation = self._generation()
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] == generation and entry[1] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    SEARCH_CACHE_LOOKUPS.inc(("hit",))
+                    return entry[2]
+                del self._entries[key]
+            future = self._inflight.get((generation, key))
+            if future is None:
+                break
+            value = await asyncio.shield(future)
+            if value is not None:
+                self.coalesced += 1
+                SEARCH_CACHE_LOOKUPS.inc(("coalesced",))
+                return value
+            # Abandoned: look again, so only one of the waiters becomes the next one to compute it
+        self.misses += 1
+        SEARCH_CACHE_LOOKUPS.inc(("miss",))
+        return None
+
+    def begin(self, key: Hashable) -> tuple[tuple[Hashable, asyncio.Future], bool]:
+        """Registers the caller as the one computing key. Returns the ticket to complete() or abandon() it and whether
+        the caller owns the computation, if not it should go back to lookup() and wait for the owner's result."""
+        ticket = (self._generation(), key)
+        future = self._inflight.get(ticket)
+        if future is not None:
+            return (ticket, future), False
+        future = self._inflight[ticket] = asyncio.get_running_loop().create_future()
+        return (ticket, future), True
+
+    def complete(self, ticket: tuple[Hashable, asyncio.Future], value: Any):
+        (generation, key), future = ticket
+        if self._inflight.get((generation, key)) is future:
+            del self._inflight[(generation, key)]
+        if not future.done():
+            future.set_result(value)
+        # A result computed against an index that has since changed is handed to the waiters but not kept
+        if generation == self._generation():
+            self._entries[key] = (generation, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def abandon(self, ticket: tuple[Hashable, asyncio.Future]):
+        (generation, key), future = ticket
+        if self._inflight.get((generation, key)) is future:
+            del self._inflight[(generation, key)]
+        if not future.done():
+            future.set_result(None)
+
+    async def get_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        while True:
+            cached = await self.lookup(key)
+            if cached is not None:
+                return cached
+            ticket, owner = self.begin(key)
+            if owner:
+                break
+        try:
+            value = await compute()
+        except BaseException:
+            self.abandon(ticket)
+            raise
+        self.complete(ticket, value)
+        return value
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+        }
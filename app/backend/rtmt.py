@@ -1,16 +1,100 @@
 import asyncio
+import base64
+import inspect
 import json
 import logging
+import os
+import re
+import time
+import uuid
+from collections import deque
+from contextlib import aclosing
 from enum import Enum
 from typing import Any, Callable, Optional
 
 import aiohttp
 from aiohttp import web
 from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from azure.identity import DefaultAzureCredential
+
+from flow_control import FrameQueue, MemoryBudget, QueuePolicy
+from metrics import (
+    ACTIVE_SESSIONS,
+    MESSAGE_BYTES,
+    MESSAGES,
+    QUEUE_BLOCKED_SECONDS,
+    QUEUE_DROPPED_FRAMES,
+    RESPONSE_AUDIO_SECONDS,
+    TOOL_CALLS,
+    TOOL_SECONDS,
+    UPSTREAM_CONNECT_SECONDS,
+)
+from recording import SOURCE_CLIENT, SOURCE_MIDDLE_TIER, SOURCE_UPSTREAM, SessionRecorder
+from token_manager import COGNITIVE_SERVICES_SCOPE, TokenManager
 
 logger = logging.getLogger("voicerag")
 
+# Realtime events put "type" first (optionally right after "event_id"), so the event type of a frame can be
+# read from a bounded prefix without parsing the whole message, which for audio is mostly base64 payload
+_EVENT_TYPE_PREFIX = re.compile(r'\s*\{\s*(?:"event_id"\s*:\s*"[^"\\]*"\s*,\s*)?"type"\s*:\s*"([^"\\]*)"')
+_EVENT_TYPE_SCAN_LIMIT = 256
+
+# The only events the middle tier rewrites or swallows, everything else is forwarded untouched
+_CLIENT_BOUND_EVENTS = frozenset({
+    "session.created",
+    "response.output_item.added",
+    "conversation.item.created",
+    "response.function_call_arguments.delta",
+    "response.function_call_arguments.done",
+    "response.output_item.done",
+    "response.done",
+})
+_SERVER_BOUND_EVENTS = frozenset({
+    "session.update",
+})
+
+# Events a client may send, anything else is counted as "other" so clients can't blow up metric cardinality
+_CLIENT_EVENT_TYPES = frozenset({
+    "session.update",
+    "input_audio_buffer.append",
+    "input_audio_buffer.commit",
+    "input_audio_buffer.clear",
+    "conversation.item.create",
+    "conversation.item.truncate",
+    "conversation.item.delete",
+    "response.create",
+    "response.cancel",
+})
+
+def peek_event_type(data: str | bytes) -> Optional[str]:
+    """Returns the event type of a raw frame, or None if it can't be read cheaply from the prefix."""
+    if isinstance(data, bytes):
+        data = data[:_EVENT_TYPE_SCAN_LIMIT].decode("utf-8", errors="ignore")
+    match = _EVENT_TYPE_PREFIX.match(data, 0, _EVENT_TYPE_SCAN_LIMIT)
+    return match.group(1) if match else None
+
+def _is_stale_audio(frame: str | bytes) -> bool:
+    # Late audio is worse than skipped audio for a live conversation, so it's the first to go under pressure.
+    # Binary frames to the client only ever carry audio
+    return isinstance(frame, bytes) or peek_event_type(frame) == "response.audio.delta"
+
+# WebSocket subprotocol a client offers on /realtime to exchange audio as raw PCM16 binary frames: its binary
+# frames are appended to the input audio buffer and response.audio.delta events arrive as binary frames
+# (without the event envelope), every other event stays JSON text
+BINARY_AUDIO_PROTOCOL = "realtime.pcm16"
+
+_AUDIO_DELTA_FIELD = '"delta":"'
+
+def _audio_delta_bytes(data: str) -> bytes:
+    # The delta is plain base64, so it can be sliced out instead of parsing the whole event
+    start = data.find(_AUDIO_DELTA_FIELD)
+    if start != -1:
+        start += len(_AUDIO_DELTA_FIELD)
+        end = data.find('"', start)
+        if end != -1 and "\\" not in data[start:end]:
+            return base64.b64decode(data[start:end])
+    return base64.b64decode(json.loads(data)["delta"])
+
 class ToolResultDirection(Enum):
     TO_SERVER = 1
     TO_CLIENT = 2
@@ -44,6 +128,71 @@ class RTToolCall:
         self.tool_call_id = tool_call_id
         self.previous_id = previous_id
 
+class RTSession:
+    """State of a single browser connection, owned by the handler that created it."""
+    __slots__ = ("id", "client_ws", "server_ws", "to_server", "to_client", "tools_pending", "tool_tasks", "started_at", "upstream_connected_at", "upstream_prewarmed", "first_audio_at", "closed_at", "committed_at", "binary_audio", "recording",
+                 "pending_audio", "pending_audio_chunks", "pending_audio_arrivals", "audio_flush_timer", "audio_appends_in", "audio_frames_out", "audio_delay_total")
+
+    def __init__(self, client_ws: web.WebSocketResponse, to_server: FrameQueue, to_client: FrameQueue, binary_audio: bool = False):
+        self.id = uuid.uuid4().hex
+        self.client_ws = client_ws
+        self.server_ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        # Outgoing frames waiting to be written to each socket
+        self.to_server = to_server
+        self.to_client = to_client
+        self.tools_pending: dict[str, RTToolCall] = {}
+        # Tool calls and follow-up requests running in the background for this connection
+        self.tool_tasks: list[asyncio.Task] = []
+        self.started_at = time.monotonic()
+        self.upstream_connected_at: Optional[float] = None
+        self.upstream_prewarmed = False
+        self.first_audio_at: Optional[float] = None
+        self.closed_at: Optional[float] = None
+        # Last input_audio_buffer.committed not yet answered with audio
+        self.committed_at: Optional[float] = None
+        # Client negotiated BINARY_AUDIO_PROTOCOL
+        self.binary_audio = binary_audio
+        self.recording: Optional[SessionRecorder] = None
+        # Microphone audio held back to be sent upstream as one larger input_audio_buffer.append
+        self.pending_audio = bytearray()
+        self.pending_audio_chunks = 0
+        self.pending_audio_arrivals = 0.0
+        self.audio_flush_timer: Optional[asyncio.Task] = None
+        self.audio_appends_in = 0
+        self.audio_frames_out = 0
+        self.audio_delay_total = 0.0
+
+    def track(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.tool_tasks.append(task)
+        task.add_done_callback(self._untrack)
+        return task
+
+    def _untrack(self, task: asyncio.Task):
+        if task in self.tool_tasks:
+            self.tool_tasks.remove(task)
+
+    async def close(self):
+        if self.closed_at is not None:
+            return
+        self.closed_at = time.monotonic()
+        if self.audio_flush_timer is not None:
+            self.audio_flush_timer.cancel()
+            self.audio_flush_timer = None
+        self.pending_audio.clear()
+        # Nobody is left to receive the results of tools still running
+        tasks = list(self.tool_tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+        self.tool_tasks.clear()
+        self.tools_pending.clear()
+        await self.to_server.close()
+        await self.to_client.close()
+        self.client_ws = None
+        self.server_ws = None
+
 class RTMiddleTier:
     endpoint: str
     deployment: str
@@ -51,7 +200,7 @@ class RTMiddleTier:
     
     # Tools are server-side only for now, though the case could be made for client-side tools
     # in addition to server-side tools that are invisible to the client
-    tools: dict[str, Tool] = {}
+    tools: dict[str, Tool]
 
     # Server-enforced configuration, if set, these will override the client's configuration
     # Typically at least the model name and system message will be set by the server
@@ -62,35 +211,183 @@ class RTMiddleTier:
     disable_audio: Optional[bool] = None
     voice_choice: Optional[str] = None
     api_version: str = "2024-10-01-preview"
-    _tools_pending = {}
-    _token_provider = None
+    # Forward frames the middle tier doesn't touch without parsing them
+    fast_path: bool = True
+    # Upper bound for a single tool call, after which the model is told the tool timed out
+    tool_timeout: float = 30.0
 
-    def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | DefaultAzureCredential, voice_choice: Optional[str] = None):
+    # Upstream connection pool shared by all sessions for the lifetime of the app
+    connection_limit: int = 200
+    keepalive_timeout: float = 30.0
+    dns_cache_ttl: int = 300
+    # Realtime sockets connected and configured ahead of time so new clients don't wait for the
+    # DNS/TCP/TLS/WebSocket handshakes, 0 disables the pool
+    prewarm_pool_size: int = 0
+    prewarm_max_age: float = 120.0
+
+    # Per-direction send queues, once one holds high_watermark bytes its policy applies until it has
+    # drained to low_watermark; the memory cap bounds everything queued for one session
+    queue_high_watermark: int = 1024 * 1024
+    queue_low_watermark: int = 256 * 1024
+    session_memory_cap: int = 4 * 1024 * 1024
+    # Microphone audio is never dropped, slow upstreams push back on the browser instead
+    to_server_policy: QueuePolicy = QueuePolicy.BLOCK
+    to_client_policy: QueuePolicy = QueuePolicy.DROP_STALE
+
+    # Merge consecutive input_audio_buffer.append messages into one upstream frame, holding audio back
+    # at most this long (or until this much audio is buffered); None sends every append as it arrives
+    audio_coalesce_ms: Optional[float] = None
+    # PCM16 mono at the rate the browser records at
+    input_audio_sample_rate: int = 24000
+
+    # Directory to record every session to (see recording.py and loadtest.py), None disables recording
+    record_dir: Optional[str] = None
+
+    token_manager: Optional[TokenManager] = None
+    _owns_token_manager = False
+    _http_session: Optional[aiohttp.ClientSession] = None
+
+    def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | DefaultAzureCredential, voice_choice: Optional[str] = None, token_manager: Optional[TokenManager] = None):
         self.endpoint = endpoint
         self.deployment = deployment
+        self.tools = {}
+        self._prewarmed: deque[tuple[float, aiohttp.ClientWebSocketResponse]] = deque()
+        self._prewarm_task: Optional[asyncio.Task] = None
+        self._prewarm_wakeup = asyncio.Event()
         self.voice_choice = voice_choice
         if voice_choice is not None:
             logger.info("Realtime voice choice set to %s", voice_choice)
         if isinstance(credentials, AzureKeyCredential):
             self.key = credentials.key
         else:
-            self._token_provider = get_bearer_token_provider(credentials, "https://cognitiveservices.azure.com/.default")
-            self._token_provider() # Warm up during startup so we have a token cached when the first request arrives
+            # Tokens are fetched on startup and refreshed in the background so connecting never waits on one
+            self._owns_token_manager = token_manager is None
+            self.token_manager = token_manager or TokenManager(credentials)
+            self.token_manager.add_scope(COGNITIVE_SERVICES_SCOPE)
+
+    async def _run_tool(self, item: dict, tool_call: RTToolCall, previous: Optional[asyncio.Task], session: RTSession):
+        tool = self.tools.get(item["name"])
+        args = item["arguments"]
+        started = time.monotonic()
+        outcome = "ok"
+
+        async def run() -> ToolResult:
+            target = tool.target(json.loads(args))
+            if not inspect.isasyncgen(target):
+                return await target
+            # Streaming tools yield growing results and the last one is the actual result. A result is shown
+            # to the client as partial once a newer one arrives, so a tool that yields once sends one response
+            result = None
+            async with aclosing(target) as results:
+                async for latest in results:
+                    if result is not None and result.destination == ToolResultDirection.TO_CLIENT:
+                        await session.to_client.put(json.dumps({
+                            "type": "extension.middle_tier_tool_response",
+                            "previous_item_id": tool_call.previous_id,
+                            "tool_name": item["name"],
+                            "tool_result": result.to_text(),
+                            "partial": True
+                        }))
+                    result = latest
+            return result if result is not None else ToolResult(None, ToolResultDirection.TO_SERVER)
+
+        try:
+            if tool is None:
+                # Still answer the call, later tool outputs wait for this one
+                outcome = "unknown"
+                logger.warning("Model called unknown tool '%s'", item["name"])
+                result = ToolResult(f"There is no '{item['name']}' tool, use one of: {', '.join(self.tools)}.", ToolResultDirection.TO_SERVER)
+            else:
+                result = await asyncio.wait_for(run(), timeout=self.tool_timeout)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            logger.warning("Tool '%s' timed out after %.1fs", item["name"], self.tool_timeout)
+            result = ToolResult(f"The '{item['name']}' tool timed out, tell the user to try again.", ToolResultDirection.TO_SERVER)
+        except Exception:
+            outcome = "error"
+            logger.exception("Tool '%s' failed", item["name"])
+            result = ToolResult(f"The '{item['name']}' tool failed, tell the user to try again.", ToolResultDirection.TO_SERVER)
+        # Names the model made up would each add a label
+        tool_label = item["name"] if tool is not None else "unknown"
+        TOOL_SECONDS.observe(time.monotonic() - started, (tool_label,))
+        TOOL_CALLS.inc((tool_label, outcome))
+
+        # Preserve the order in which the model issued the calls
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        await session.to_server.put(json.dumps({
+            "type": "conversation.item.create",
+            "item": {
+                "type": "function_call_output",
+                "call_id": item["call_id"],
+                "output": "Here is the result as returned from the search tool, read them as they are" + result.to_text() # if result.destination == ToolResultDirection.TO_SERVER else ""
+            }
+        }))
+        if result.destination == ToolResultDirection.TO_CLIENT:
+            # TODO: this will break clients that don't know about this extra message, rewrite 
+            # this to be a regular text message with a special marker of some sort
+            await session.to_client.put(json.dumps({
+                "type": "extension.middle_tier_tool_response",
+                "previous_item_id": tool_call.previous_id,
+                "tool_name": item["name"],
+                "tool_result": result.to_text()
+            }))
+
+    async def _request_response(self, pending: list[asyncio.Task], session: RTSession):
+        if pending:
+            await asyncio.wait(pending)
+        await session.to_server.put(json.dumps({
+            "type": "response.create"
+        }))
+
+    def _observe_client_event(self, event_type: str, size: int, session: RTSession):
+        MESSAGES.inc(("to_client", event_type))
+        MESSAGE_BYTES.inc(("to_client", event_type), size)
+        if event_type == "response.audio.delta":
+            if session.first_audio_at is None or session.committed_at is not None:
+                now = time.monotonic()
+                if session.first_audio_at is None:
+                    session.first_audio_at = now
+                if session.committed_at is not None:
+                    RESPONSE_AUDIO_SECONDS.observe(now - session.committed_at)
+                    session.committed_at = None
+        elif event_type == "input_audio_buffer.committed":
+            session.committed_at = time.monotonic()
+
+    def _observe_server_event(self, event_type: str, size: int):
+        event_type = event_type if event_type in _CLIENT_EVENT_TYPES else "other"
+        MESSAGES.inc(("to_server", event_type))
+        MESSAGE_BYTES.inc(("to_server", event_type), size)
+
+    async def _process_message_to_client(self, msg: str, session: RTSession) -> Optional[str | bytes]:
+        event_type = peek_event_type(msg.data)
+        if event_type is not None:
+            self._observe_client_event(event_type, len(msg.data), session)
+            if self.fast_path and event_type not in _CLIENT_BOUND_EVENTS:
+                if event_type == "response.audio.delta" and session.binary_audio:
+                    return _audio_delta_bytes(msg.data)
+                return msg.data
 
-    async def _process_message_to_client(self, msg: str, client_ws: web.WebSocketResponse, server_ws: web.WebSocketResponse) -> Optional[str]:
         message = json.loads(msg.data)
         updated_message = msg.data
 
         if message is not None:
+            if event_type is None:
+                self._observe_client_event(message["type"], len(msg.data), session)
             match message["type"]:
+                case "response.audio.delta":
+                    if session.binary_audio:
+                        updated_message = base64.b64decode(message["delta"])
+
                 case "session.created":
                     
-                    session = message["session"]
-                    session["instructions"] = ""
-                    session["tools"] = []
-                    session["voice"] = self.voice_choice
-                    session["tool_choice"] = "none"
-                    session["max_response_output_tokens"] = None
+                    session_config = message["session"]
+                    session_config["instructions"] = ""
+                    session_config["tools"] = []
+                    session_config["voice"] = self.voice_choice
+                    session_config["tool_choice"] = "none"
+                    session_config["max_response_output_tokens"] = None
                     updated_message = json.dumps(message)
 
                 case "response.output_item.added":
@@ -100,8 +397,8 @@ class RTMiddleTier:
                 case "conversation.item.created":
                     if "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
-                        if item["call_id"] not in self._tools_pending:
-                            self._tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"])
+                        if item["call_id"] not in session.tools_pending:
+                            session.tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"])
                         updated_message = None
                     elif "item" in message and message["item"]["type"] == "function_call_output":
                         updated_message = None
@@ -115,37 +412,18 @@ class RTMiddleTier:
                 case "response.output_item.done":
                     if "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
-                        tool_call = self._tools_pending[message["item"]["call_id"]]
-                        tool = self.tools[item["name"]]
-                        args = item["arguments"]
-                       
-                        result = await tool.target(json.loads(args))
-                        
-                        await server_ws.send_json({
-                            "type": "conversation.item.create",
-                            "item": {
-                                "type": "function_call_output",
-                                "call_id": item["call_id"],
-                                "output": "Here is the result as returned from the search tool, read them as they are" + result.to_text() # if result.destination == ToolResultDirection.TO_SERVER else ""
-                            }
-                        })
-                        if result.destination == ToolResultDirection.TO_CLIENT:
-                            # TODO: this will break clients that don't know about this extra message, rewrite 
-                            # this to be a regular text message with a special marker of some sort
-                            await client_ws.send_json({
-                                "type": "extension.middle_tier_tool_response",
-                                "previous_item_id": tool_call.previous_id,
-                                "tool_name": item["name"],
-                                "tool_result": result.to_text()
-                            })
+                        tool_call = session.tools_pending[item["call_id"]]
+                        # Run the tool in the background so audio and transcript events keep flowing
+                        # while it executes; outputs are still delivered in the order the calls arrived
+                        previous = session.tool_tasks[-1] if session.tool_tasks else None
+                        session.track(self._run_tool(item, tool_call, previous, session))
                         updated_message = None
 
                 case "response.done":
-                    if len(self._tools_pending) > 0:
-                        self._tools_pending.clear()
-                        await server_ws.send_json({
-                            "type": "response.create"
-                        })
+                    if len(session.tools_pending) > 0:
+                        session.tools_pending.clear()
+                        # Only ask for a new response once every tool output has reached the server
+                        session.track(self._request_response(list(session.tool_tasks), session))
                     if "response" in message and "output" in message["response"]:
                         original_length = len(message["response"]["output"])
                         message["response"]["output"] = [
@@ -156,74 +434,301 @@ class RTMiddleTier:
 
         return updated_message
 
-    async def _process_message_to_server(self, msg: str, ws: web.WebSocketResponse) -> Optional[str]:
+    def _apply_session_config(self, session_config: dict):
+        if self.system_message is not None:
+            session_config["instructions"] = self.system_message
+        if self.temperature is not None:
+            session_config["temperature"] = self.temperature
+        if self.max_tokens is not None:
+            session_config["max_response_output_tokens"] = self.max_tokens
+        if self.disable_audio is not None:
+            session_config["disable_audio"] = self.disable_audio
+        if self.voice_choice is not None:
+            session_config["voice"] = self.voice_choice
+        session_config["tool_choice"] = "auto" if len(self.tools) > 0 else "none"
+        session_config["tools"] = [tool.schema for tool in self.tools.values()]
+
+    async def _coalesce_audio(self, audio: bytes, session: RTSession):
+        session.pending_audio += audio
+        session.pending_audio_chunks += 1
+        session.pending_audio_arrivals += time.monotonic()
+        session.audio_appends_in += 1
+        if len(session.pending_audio) >= self.input_audio_sample_rate * 2 * self.audio_coalesce_ms / 1000:
+            await self._flush_audio(session)
+        elif session.audio_flush_timer is None:
+            session.audio_flush_timer = asyncio.create_task(self._flush_audio_later(session))
+
+    async def _flush_audio_later(self, session: RTSession):
+        await asyncio.sleep(self.audio_coalesce_ms / 1000)
+        # Past this point the flush is underway and must not be cancelled by the reader
+        session.audio_flush_timer = None
+        await self._flush_audio(session)
+
+    async def _flush_audio(self, session: RTSession):
+        if session.audio_flush_timer is not None:
+            session.audio_flush_timer.cancel()
+            session.audio_flush_timer = None
+        if not session.pending_audio:
+            return
+        audio = base64.b64encode(session.pending_audio).decode("ascii")
+        session.audio_delay_total += session.pending_audio_chunks * time.monotonic() - session.pending_audio_arrivals
+        session.audio_frames_out += 1
+        session.pending_audio.clear()
+        session.pending_audio_chunks = 0
+        session.pending_audio_arrivals = 0.0
+        await session.to_server.put(json.dumps({"type": "input_audio_buffer.append", "audio": audio}))
+
+    async def _process_message_to_server(self, msg: str, session: RTSession) -> Optional[str]:
+        event_type = peek_event_type(msg.data)
+        if event_type is not None:
+            self._observe_server_event(event_type, len(msg.data))
+        if self.audio_coalesce_ms:
+            if event_type == "input_audio_buffer.append":
+                await self._coalesce_audio(base64.b64decode(json.loads(msg.data)["audio"]), session)
+                return None
+            # Anything else (commit, response.create, ...) has to reach the server after the audio sent before it
+            await self._flush_audio(session)
+
+        if self.fast_path and event_type is not None and event_type not in _SERVER_BOUND_EVENTS:
+            return msg.data
+
         message = json.loads(msg.data)
         updated_message = msg.data
         if message is not None:
+            if event_type is None:
+                self._observe_server_event(message["type"], len(msg.data))
             match message["type"]:
                 case "session.update":
-                    session = message["session"]
-                    if self.system_message is not None:
-                        session["instructions"] = self.system_message
-                    if self.temperature is not None:
-                        session["temperature"] = self.temperature
-                    if self.max_tokens is not None:
-                        session["max_response_output_tokens"] = self.max_tokens
-                    if self.disable_audio is not None:
-                        session["disable_audio"] = self.disable_audio
-                    if self.voice_choice is not None:
-                        session["voice"] = self.voice_choice
-                    session["tool_choice"] = "auto" if len(self.tools) > 0 else "none"
-                    session["tools"] = [tool.schema for tool in self.tools.values()]
+                    self._apply_session_config(message["session"])
                     updated_message = json.dumps(message)
 
         return updated_message
 
-    async def _forward_messages(self, ws: web.WebSocketResponse):
-        async with aiohttp.ClientSession(base_url=self.endpoint) as session:
-            params = { "api-version": self.api_version, "deployment": self.deployment}
-            headers = {}
-            if "x-ms-client-request-id" in ws.headers:
-                headers["x-ms-client-request-id"] = ws.headers["x-ms-client-request-id"]
-            if self.key is not None:
-                headers = { "api-key": self.key }
-            else:
-                headers = { "Authorization": f"Bearer {self._token_provider()}" } # NOTE: no async version of token provider, maybe refresh token on a timer?
-            async with session.ws_connect("/openai/realtime", headers=headers, params=params) as target_ws:
-                async def from_client_to_server():
-                    async for msg in ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_server(msg, ws)
-                            if new_msg is not None:
-                                await target_ws.send_str(new_msg)
-                        else:
-                            print("Error: unexpected message type:", msg.type)
-                    
-                    # Means it is gracefully closed by the client then time to close the target_ws
-                    if target_ws:
-                        print("Closing OpenAI's realtime socket connection.")
-                        await target_ws.close()
-                        
-                async def from_server_to_client():
-                    async for msg in target_ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_client(msg, ws, target_ws)
-                            if new_msg is not None:
-                                await ws.send_str(new_msg)
-                        else:
-                            print("Error: unexpected message type:", msg.type)
-
-                try:
-                    await asyncio.gather(from_client_to_server(), from_server_to_client())
-                except ConnectionResetError:
-                    # Ignore the errors resulting from the client disconnecting the socket
-                    pass
+    async def _process_audio_to_server(self, audio: bytes, session: RTSession) -> Optional[str]:
+        self._observe_server_event("input_audio_buffer.append", len(audio))
+        if self.audio_coalesce_ms:
+            await self._coalesce_audio(audio, session)
+            return None
+        return json.dumps({"type": "input_audio_buffer.append", "audio": base64.b64encode(audio).decode("ascii")})
+
+    def _create_session(self, client_ws: web.WebSocketResponse) -> RTSession:
+        budget = MemoryBudget(self.session_memory_cap)
+        to_server = FrameQueue("to_server", self.queue_high_watermark, self.queue_low_watermark, budget, self.to_server_policy)
+        to_client = FrameQueue("to_client", self.queue_high_watermark, self.queue_low_watermark, budget, self.to_client_policy, _is_stale_audio)
+        binary_audio = client_ws is not None and client_ws.ws_protocol == BINARY_AUDIO_PROTOCOL
+        session = RTSession(client_ws, to_server, to_client, binary_audio)
+        if self.record_dir is not None:
+            session.recording = SessionRecorder(os.path.join(self.record_dir, f"{session.id}.jsonl"))
+        return session
+
+    async def _pump(self, queue: FrameQueue, target: web.WebSocketResponse | aiohttp.ClientWebSocketResponse, recording: Optional[SessionRecorder] = None):
+        while (frame := await queue.get()) is not None:
+            if recording is not None:
+                recording.add(SOURCE_MIDDLE_TIER, frame)
+            try:
+                if isinstance(frame, bytes):
+                    await target.send_bytes(frame)
+                else:
+                    await target.send_str(frame)
+            except ConnectionResetError:
+                # The socket is gone, _forward_messages ends the session once this pump returns
+                return
+
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        if self._http_session is None or self._http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+                enable_cleanup_closed=True)
+            self._http_session = aiohttp.ClientSession(base_url=self.endpoint, connector=connector)
+        return self._http_session
+
+    async def _connect_upstream(self, client_request_id: Optional[str] = None) -> aiohttp.ClientWebSocketResponse:
+        params = { "api-version": self.api_version, "deployment": self.deployment}
+        headers = {}
+        if client_request_id is not None:
+            headers["x-ms-client-request-id"] = client_request_id
+        if self.key is not None:
+            headers["api-key"] = self.key
+        else:
+            headers["Authorization"] = f"Bearer {await self.token_manager.get_token(COGNITIVE_SERVICES_SCOPE)}"
+        return await self._get_http_session().ws_connect("/openai/realtime", headers=headers, params=params)
+
+    async def _acquire_upstream(self, client_request_id: Optional[str] = None) -> tuple[aiohttp.ClientWebSocketResponse, bool]:
+        now = time.monotonic()
+        while self._prewarmed:
+            created_at, target_ws = self._prewarmed.popleft()
+            if target_ws.closed or now - created_at > self.prewarm_max_age:
+                await target_ws.close()
+                continue
+            self._prewarm_wakeup.set()
+            return target_ws, True
+        if self.prewarm_pool_size > 0:
+            self._prewarm_wakeup.set()
+        return await self._connect_upstream(client_request_id), False
+
+    async def _maintain_prewarmed(self):
+        # The session.update is sent on connect so the socket is ready for audio as soon as it's handed out;
+        # the events it produces (session.created/updated) stay queued and are relayed to the client then
+        session_update = {"type": "session.update", "session": {}}
+        self._apply_session_config(session_update["session"])
+        failures = 0
+        while True:
+            try:
+                await self._refill_prewarmed(session_update)
+                failures = 0
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                failures += 1
+                logger.warning("Failed to prewarm a realtime connection: %s", e)
+            except Exception:
+                # e.g. the credential failing to get a token, the pool must still be refilled once it recovers
+                failures += 1
+                logger.exception("Failed to prewarm a realtime connection")
+            self._prewarm_wakeup.clear()
+            if failures:
+                await asyncio.sleep(min(60.0, 2.0 ** failures))
+                continue
+            try:
+                await asyncio.wait_for(self._prewarm_wakeup.wait(), timeout=min(self.prewarm_max_age / 2, 30))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _refill_prewarmed(self, session_update: dict):
+        now = time.monotonic()
+        while self._prewarmed and (self._prewarmed[0][1].closed or now - self._prewarmed[0][0] > self.prewarm_max_age):
+            _, stale_ws = self._prewarmed.popleft()
+            await stale_ws.close()
+        while len(self._prewarmed) < self.prewarm_pool_size:
+            target_ws = await self._connect_upstream()
+            try:
+                await target_ws.send_json(session_update)
+            except BaseException:
+                await target_ws.close()
+                raise
+            self._prewarmed.append((time.monotonic(), target_ws))
+
+    @staticmethod
+    def _prewarm_done(task: asyncio.Task):
+        if task.cancelled():
+            logger.info("Stopped prewarming realtime connections")
+        elif task.exception() is not None:
+            logger.error("Prewarming realtime connections stopped", exc_info=task.exception())
+
+    async def _on_startup(self, app: web.Application):
+        self._get_http_session()
+        if self.prewarm_pool_size > 0:
+            logger.info("Keeping %d prewarmed realtime connections", self.prewarm_pool_size)
+            self._prewarm_task = asyncio.create_task(self._maintain_prewarmed())
+            self._prewarm_task.add_done_callback(self._prewarm_done)
+
+    async def _on_cleanup(self, app: web.Application):
+        if self._prewarm_task is not None:
+            self._prewarm_task.cancel()
+            await asyncio.wait([self._prewarm_task])
+            self._prewarm_task = None
+        while self._prewarmed:
+            _, target_ws = self._prewarmed.popleft()
+            await target_ws.close()
+        if self._http_session is not None:
+            await self._http_session.close()
+            self._http_session = None
+
+    async def _forward_messages(self, session: RTSession):
+        ws = session.client_ws
+        target_ws, session.upstream_prewarmed = await self._acquire_upstream(ws.headers.get("x-ms-client-request-id"))
+        session.upstream_connected_at = time.monotonic()
+        UPSTREAM_CONNECT_SECONDS.observe(session.upstream_connected_at - session.started_at, (str(session.upstream_prewarmed).lower(),))
+        logger.info("Realtime session %s upstream ready in %.1f ms (prewarmed: %s)",
+            session.id, (session.upstream_connected_at - session.started_at) * 1000, session.upstream_prewarmed)
+        session.server_ws = target_ws
+
+        async def from_client_to_server():
+            async for msg in ws:
+                if session.recording is not None and msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                    session.recording.add(SOURCE_CLIENT, msg.data)
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    new_msg = await self._process_message_to_server(msg, session)
+                    if new_msg is not None:
+                        await session.to_server.put(new_msg)
+                elif msg.type == aiohttp.WSMsgType.BINARY and session.binary_audio:
+                    new_msg = await self._process_audio_to_server(msg.data, session)
+                    if new_msg is not None:
+                        await session.to_server.put(new_msg)
+                else:
+                    print("Error: unexpected message type:", msg.type)
+            
+            # Means it is gracefully closed by the client then time to close the target_ws
+            if target_ws:
+                print("Closing OpenAI's realtime socket connection.")
+                await target_ws.close()
+                
+        async def from_server_to_client():
+            async for msg in target_ws:
+                if session.recording is not None and msg.type == aiohttp.WSMsgType.TEXT:
+                    session.recording.add(SOURCE_UPSTREAM, msg.data)
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    new_msg = await self._process_message_to_client(msg, session)
+                    if new_msg is not None:
+                        await session.to_client.put(new_msg)
+                else:
+                    print("Error: unexpected message type:", msg.type)
+
+        tasks = [
+            asyncio.create_task(from_client_to_server()),
+            asyncio.create_task(from_server_to_client()),
+            asyncio.create_task(self._pump(session.to_server, target_ws, session.recording)),
+            asyncio.create_task(self._pump(session.to_client, ws)),
+        ]
+        try:
+            # Whichever side stops first, a socket closing or a pump failing to write, ends the session
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Closing the queues wakes a reader blocked on a full one, and tools must not outlive the
+            # upstream socket they report back to
+            await session.close()
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+            await target_ws.close()
+            await ws.close()
+        for task in tasks:
+            # Errors resulting from either side disconnecting the socket are expected
+            if not task.cancelled() and task.exception() is not None and not isinstance(task.exception(), ConnectionResetError):
+                raise task.exception()
 
     async def _websocket_handler(self, request: web.Request):
-        ws = web.WebSocketResponse()
+        ws = web.WebSocketResponse(protocols=(BINARY_AUDIO_PROTOCOL,))
         await ws.prepare(request)
-        await self._forward_messages(ws)
+        session = self._create_session(ws)
+        ACTIVE_SESSIONS.inc()
+        try:
+            await self._forward_messages(session)
+        finally:
+            ACTIVE_SESSIONS.dec()
+            await session.close()
+            if session.recording is not None:
+                await asyncio.to_thread(session.recording.close)
+                logger.info("Realtime session %s recorded to %s", session.id, session.recording.path)
+            first_audio = f"{(session.first_audio_at - session.started_at) * 1000:.1f} ms" if session.first_audio_at is not None else "n/a"
+            logger.info("Realtime session %s closed after %.1fs, first audio after %s", session.id, session.closed_at - session.started_at, first_audio)
+            if session.audio_frames_out:
+                logger.info("Realtime session %s coalesced %d audio appends into %d frames (%.1fx fewer), %.1f ms added latency on average",
+                    session.id, session.audio_appends_in, session.audio_frames_out, session.audio_appends_in / session.audio_frames_out,
+                    session.audio_delay_total / session.audio_appends_in * 1000)
+            for queue in (session.to_server, session.to_client):
+                if queue.dropped_frames or queue.blocked_count:
+                    QUEUE_DROPPED_FRAMES.inc((queue.name,), queue.dropped_frames)
+                    QUEUE_BLOCKED_SECONDS.inc((queue.name,), queue.blocked_seconds)
+                    logger.warning("Realtime session %s backpressure on %s: %s", session.id, queue.name, queue.stats())
         return ws
     
     def attach_to_app(self, app, path):
-        app.router.add_get(path, self._websocket_handler)
\ No newline at end of file
+        app[RTMT_APP_KEY] = self
+        app.router.add_get(path, self._websocket_handler)
+        if self._owns_token_manager:
+            self.token_manager.attach_to_app(app)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+
+RTMT_APP_KEY = web.AppKey("rtmt", RTMiddleTier)
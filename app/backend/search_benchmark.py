@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import hashlib
+import inspect
+import itertools
+import json
+import math
+import os
+import platform
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Optional
+
+import numpy as np
+
+from ann_index import IVFIndex
+from ingestion import iter_documents
+from local_search import PRECISIONS, LocalVectorIndex, normalize, top_k
+
+# Recall against exact search versus latency and memory, for the vector search settings the app can run with.
+#
+#   python search_benchmark.py                               # vectors of data/flat_index.npz, synthetic queries
+#   python search_benchmark.py --queries queries.txt --output benchmarks/search.json
+#   python search_benchmark.py --synthetic 100000 --dimensions 3072,1024,512 -k 5,10,50
+#   python search_benchmark.py --backends flat,ivf,azure --hnsw-m 4,8 --hnsw-ef-search 100,500
+#
+# Ground truth is the exact float32 top-k of each query by cosine similarity against the catalog's stored
+# embeddings. Every configuration of every backend is scored against it, per k:
+#
+#   flat   LocalVectorIndex: precision, rescoring oversampling
+#   ivf    IVFIndex: lists, lists probed per query, precision, rescoring oversampling
+#   azure  Azure AI Search HNSW: m, efConstruction, efSearch, scalar compression with oversampling. Each
+#          configuration is a temporary index filled with the catalog vectors, deleted afterwards.
+#
+# text-embedding-3 vectors requested with fewer dimensions are the leading components of the full vector,
+# renormalized, so every dimension setting is measured from the stored vectors without embedding anything
+# again; the recall of a setting therefore includes what it loses by shortening the vectors. (Synthetic
+# vectors don't concentrate information in their leading components, on them shortening looks worse than
+# it is on real embeddings.)
+#
+# The JSON report has sorted keys, results in sweep order and fingerprints of the catalog and query vectors,
+# so the reports of two releases can be diffed line by line.
+
+DEFAULT_SNAPSHOT = Path(__file__).parent.parent.parent / "data" / "flat_index.npz"
+BACKENDS = ("flat", "ivf", "azure")
+
+def _percentile(values: list[float], percentile: float) -> Optional[float]:
+    return float(np.percentile(values, percentile)) if values else None
+
+def _fingerprint(vectors: np.ndarray) -> str:
+    return hashlib.sha256(np.ascontiguousarray(vectors, dtype=np.float32).tobytes()).hexdigest()[:16]
+
+def synthetic_vectors(n: int, dimensions: int, seed: int = 0) -> np.ndarray:
+    """Clustered random vectors, closer to embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, int(math.sqrt(n))), dimensions)).astype(np.float32)
+    return normalize(centers[rng.integers(0, len(centers), n)] + 0.7 * rng.standard_normal((n, dimensions)).astype(np.float32))
+
+def synthetic_queries(vectors: np.ndarray, n: int, noise: float = 0.8, seed: int = 1) -> np.ndarray:
+    """Catalog vectors plus noise of about noise times their length: near some listings, but not a copy of any."""
+    rng = np.random.default_rng(seed)
+    picked = vectors[rng.integers(0, len(vectors), n)]
+    return normalize(picked + noise / math.sqrt(vectors.shape[1]) * rng.standard_normal(picked.shape).astype(np.float32))
+
+def load_catalog(path: str) -> tuple[list[str], np.ndarray]:
+    """Ids and normalized vectors of a local index snapshot (.npz) or of a JSON/JSONL catalog with an 'embedding' per listing."""
+    if path.endswith(".npz"):
+        index = LocalVectorIndex.load(path)
+        return [str(doc.get("id")) for doc in index.documents], index.as_float32()
+    ids, vectors = [], []
+    for doc in iter_documents(path):
+        if "embedding" not in doc:
+            raise ValueError(f"Listing {doc.get('id')} in {path} has no embedding, benchmark the snapshot index_manager.py writes instead")
+        ids.append(str(doc["id"]))
+        vectors.append(np.asarray(doc["embedding"], dtype=np.float32))
+    return ids, normalize(np.array(vectors))
+
+async def load_queries(path: str, dimensions: int) -> np.ndarray:
+    """Query vectors of a .npy file, or of a text file with one query per line.
+
+    Text queries are embedded once and kept in <name>.embeddings.npy next to the file, so that later runs,
+    and later releases, are measured with the very same vectors.
+    """
+    if path.endswith(".npy"):
+        return normalize(np.load(path))
+    with open(path, "r", encoding="utf-8") as f:
+        texts = [line.strip() for line in f if line.strip()]
+    cached = f"{os.path.splitext(path)[0]}.embeddings.npy"
+    if os.path.exists(cached) and (vectors := np.load(cached)).shape == (len(texts), dimensions):
+        return normalize(vectors)
+
+    from dotenv import load_dotenv
+    from openai import AsyncAzureOpenAI
+
+    from embedding_batcher import EmbeddingBatcher
+
+    load_dotenv()
+    client = AsyncAzureOpenAI(api_version=os.getenv("AZURE_OPENAI_API_VERSION"), azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+                              api_key=os.getenv("AZURE_OPENAI_API_KEY"), max_retries=0)
+    try:
+        vectors = np.array(await EmbeddingBatcher(client, "text-embedding-3-large", dimensions=dimensions).embed(texts), dtype=np.float32)
+    finally:
+        await client.close()
+    np.save(cached, vectors)
+    return normalize(vectors)
+
+def _shorten(vectors: np.ndarray, dimensions: int) -> np.ndarray:
+    return normalize(vectors[:, :dimensions])
+
+# A backend yields (settings, search(query, k) -> ids, bytes of memory) per configuration. Indexes are built
+# once with full-precision vectors; rescoring is switched on and off by handing those to the index, and a
+# float32 index is never rescored, that would score the same vectors twice.
+
+def _ids(results: list[dict[str, Any]]) -> list[str]:
+    return [doc["id"] for doc in results]
+
+async def flat_configurations(ids: list[str], vectors: np.ndarray, args: argparse.Namespace) -> AsyncIterator[tuple]:
+    documents = [{"id": id} for id in ids]
+    for precision in args.precisions:
+        index = LocalVectorIndex(documents, vectors, precision, rescore=precision != "float32")
+        originals = index.originals
+        for factor in [None] + (args.oversampling if originals is not None else []):
+            index.originals, index.oversampling = (originals, factor) if factor else (None, 1.0)
+            yield {"precision": precision, "oversampling": factor}, lambda query, k: _ids(index.search(query, k)), index.nbytes
+
+async def ivf_configurations(ids: list[str], vectors: np.ndarray, args: argparse.Namespace) -> AsyncIterator[tuple]:
+    documents = [{"id": id} for id in ids]
+    for nlist, precision in itertools.product(args.ivf_nlist or [None], args.precisions):
+        index = IVFIndex.build(documents, vectors, nlist=nlist, precision=precision, rescore=precision != "float32")
+        originals = index.originals
+        for nprobe, factor in itertools.product(args.ivf_nprobe, [None] + (args.oversampling if originals is not None else [])):
+            if nprobe > index.nlist:
+                continue
+            index.originals, index.oversampling = (originals, factor) if factor else (None, 1.0)
+            yield ({"nlist": index.nlist, "nprobe": nprobe, "precision": precision, "oversampling": factor},
+                   lambda query, k, nprobe=nprobe: _ids(index.search(query, k, nprobe=nprobe)), index.nbytes)
+
+async def _wait_until_searchable(search_client, count: int, timeout: float = 600.0):
+    # Uploaded documents become searchable asynchronously
+    deadline = time.monotonic() + timeout
+    while (indexed := await search_client.get_document_count()) < count:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Only {indexed} of {count} documents searchable after {timeout:.0f}s")
+        await asyncio.sleep(2.0)
+
+async def azure_configurations(ids: list[str], vectors: np.ndarray, args: argparse.Namespace) -> AsyncIterator[tuple]:
+    from azure.core.credentials import AzureKeyCredential
+    from azure.search.documents.aio import SearchClient
+    from azure.search.documents.indexes.aio import SearchIndexClient
+    from azure.search.documents.indexes.models import (
+        HnswAlgorithmConfiguration,
+        HnswParameters,
+        ScalarQuantizationCompressionConfiguration,
+        ScalarQuantizationParameters,
+        SearchField,
+        SearchFieldDataType,
+        SearchIndex,
+        SimpleField,
+        VectorSearch,
+        VectorSearchProfile,
+    )
+    from azure.search.documents.models import VectorizedQuery
+    from dotenv import load_dotenv
+
+    from document_uploader import DocumentUploader
+
+    load_dotenv()
+    endpoint = f"https://{os.getenv('AZURE_SEARCH_SERVICE_NAME')}.search.windows.net"
+    credential = AzureKeyCredential(os.getenv("AZURE_SEARCH_API_KEY"))
+    dimensions = vectors.shape[1]
+    async with SearchIndexClient(endpoint=endpoint, credential=credential) as index_client:
+        for m, ef_construction, ef_search, compression in itertools.product(
+                args.hnsw_m, args.hnsw_ef_construction, args.hnsw_ef_search, args.azure_compression):
+            name = f"{args.azure_index_prefix}-{dimensions}-m{m}-efc{ef_construction}-efs{ef_search}-{compression}"
+            compressions = [ScalarQuantizationCompressionConfiguration(
+                name="embedding_compression", rerank_with_original_vectors=True,
+                parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+            )] if compression == "scalar" else None
+            await index_client.create_or_update_index(SearchIndex(
+                name=name,
+                fields=[
+                    SimpleField(name="id", type=SearchFieldDataType.String, key=True),
+                    SearchField(name="embedding", type=SearchFieldDataType.Collection(SearchFieldDataType.Single), searchable=True,
+                                vector_search_dimensions=dimensions, vector_search_profile_name="embedding_profile"),
+                ],
+                vector_search=VectorSearch(
+                    algorithms=[HnswAlgorithmConfiguration(name="hnsw_config", parameters=HnswParameters(
+                        m=m, ef_construction=ef_construction, ef_search=ef_search, metric="cosine"))],
+                    profiles=[VectorSearchProfile(name="embedding_profile", algorithm_configuration_name="hnsw_config",
+                                                  compression_configuration_name="embedding_compression" if compressions else None)],
+                    compressions=compressions,
+                ),
+            ))
+            try:
+                async with SearchClient(endpoint=endpoint, index_name=name, credential=credential) as search_client:
+                    failures = {}
+                    # Converted to JSON-ready lists a slice at a time, not the whole catalog at once
+                    for start in range(0, len(ids), 1000):
+                        failures.update(await DocumentUploader(search_client).send("upload_documents", [
+                            {"id": id, "embedding": vector.tolist()} for id, vector in zip(ids[start:start + 1000], vectors[start:start + 1000])
+                        ]))
+                    if failures:
+                        print(f"{name}: {len(failures)} documents failed to upload, their queries lose recall")
+                    await _wait_until_searchable(search_client, len(ids) - len(failures))
+                    statistics = await index_client.get_index_statistics(name)
+
+                    for factor in [None] + (args.oversampling if compressions else []):
+                        async def search(query: np.ndarray, k: int, factor=factor) -> list[str]:
+                            vector_query = VectorizedQuery(vector=query.tolist(), k_nearest_neighbors=k, fields="embedding",
+                                                           exhaustive=False, oversampling=factor)
+                            results = await search_client.search(vector_queries=[vector_query], select=["id"], top=k)
+                            return [doc["id"] async for doc in results]
+                        settings = {"m": m, "ef_construction": ef_construction, "ef_search": ef_search,
+                                    "compression": compression, "oversampling": factor}
+                        yield settings, search, statistics.get("vector_index_size") or 0
+            finally:
+                if not args.keep_indexes:
+                    await index_client.delete_index(name)
+
+_CONFIGURATIONS = {"flat": flat_configurations, "ivf": ivf_configurations, "azure": azure_configurations}
+
+async def measure(search: Callable, queries: np.ndarray, truth: list[list[str]], k: int) -> dict[str, Any]:
+    latencies, recalls = [], []
+    for query, expected in zip(queries, truth):
+        started = time.perf_counter()
+        ids = search(query, k)
+        if inspect.isawaitable(ids):
+            ids = await ids
+        latencies.append(time.perf_counter() - started)
+        recalls.append(len(set(ids[:k]) & set(expected[:k])) / max(1, len(expected[:k])))
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {"recall": round(float(np.mean(recalls)), 4), "latency_ms": {"p50": ms(_percentile(latencies, 50)), "p99": ms(_percentile(latencies, 99))}}
+
+async def run(ids: list[str], vectors: np.ndarray, queries: np.ndarray, args: argparse.Namespace) -> list[dict[str, Any]]:
+    ks = sorted(set(args.k))
+    # Ranked once for the largest k, the top of that ranking is the truth for every smaller k
+    truth = [[ids[i] for i in top_k(vectors @ query, ks[-1])] for query in queries]
+    results = []
+    for dimensions, backend in itertools.product(args.dimensions, args.backends):
+        shortened, shortened_queries = _shorten(vectors, dimensions), _shorten(queries, dimensions)
+        async for settings, search, nbytes in _CONFIGURATIONS[backend](ids, shortened, args):
+            for k in ks:
+                results.append({"backend": backend, "dimensions": dimensions, "settings": settings, "k": k,
+                                **await measure(search, shortened_queries, truth, k), "memory_mb": round(nbytes / 1e6, 3)})
+                _print_report(results[-1:], header=len(results) == 1)
+    return results
+
+def _print_report(results: list[dict[str, Any]], header: bool = True):
+    if header:
+        print(f"{'backend':>7} {'dims':>5} {'k':>4} {'recall':>7} {'p50 ms':>8} {'p99 ms':>8} {'MB':>9}  settings")
+    for r in results:
+        settings = " ".join(f"{key}={value}" for key, value in r["settings"].items() if value is not None)
+        print(f"{r['backend']:>7} {r['dimensions']:>5} {r['k']:>4} {r['recall']:>7} {r['latency_ms']['p50']:>8} "
+              f"{r['latency_ms']['p99']:>8} {r['memory_mb']:>9}  {settings}")
+
+async def main(args: argparse.Namespace):
+    if args.synthetic:
+        ids, vectors, catalog = [str(i) for i in range(args.synthetic)], synthetic_vectors(args.synthetic, max(args.dimensions)), f"synthetic:{args.synthetic}"
+    else:
+        (ids, vectors), catalog = load_catalog(args.catalog), os.path.basename(args.catalog)
+    args.dimensions = sorted({min(d, vectors.shape[1]) for d in args.dimensions}, reverse=True)
+    if args.queries:
+        queries, source = await load_queries(args.queries, vectors.shape[1]), os.path.basename(args.queries)
+    else:
+        queries, source = synthetic_queries(vectors, args.query_count), f"synthetic:{args.query_count}"
+    if queries.shape[1] != vectors.shape[1]:
+        raise ValueError(f"Queries have {queries.shape[1]} dimensions, the catalog {vectors.shape[1]}")
+    print(f"{len(vectors)} vectors of {vectors.shape[1]} dimensions, {len(queries)} queries")
+
+    results = await run(ids, vectors, queries, args)
+    if args.output:
+        report = {
+            "catalog": {"source": catalog, "vectors": len(vectors), "dimensions": vectors.shape[1], "sha256": _fingerprint(vectors)},
+            "queries": {"source": source, "count": len(queries), "sha256": _fingerprint(queries)},
+            "environment": {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(), "cpus": os.cpu_count()},
+            "results": results,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Report written to {args.output}")
+
+if __name__ == "__main__":
+    csv = lambda cast: lambda value: [cast(item) for item in value.split(",")]
+    parser = argparse.ArgumentParser(description="Recall@k, latency and memory of vector search settings against exact search")
+    parser.add_argument("--catalog", default=str(DEFAULT_SNAPSHOT), help="snapshot (.npz) or JSON/JSONL catalog with embeddings (default: %(default)s)")
+    parser.add_argument("--synthetic", type=int, help="benchmark this many synthetic vectors instead of a catalog")
+    parser.add_argument("--queries", help="query set: .npy of vectors, or a file with one query per line; defaults to synthetic queries")
+    parser.add_argument("--query-count", type=int, default=200, help="synthetic queries (default: %(default)s)")
+    parser.add_argument("--backends", type=csv(str), default=["flat", "ivf"], help=f"comma separated, of {', '.join(BACKENDS)} (default: flat,ivf)")
+    parser.add_argument("--dimensions", type=csv(int), default=[3072, 1024, 512, 256], help="comma separated embedding dimensions")
+    parser.add_argument("-k", type=csv(int), default=[10], help="comma separated results per query (default: 10)")
+    parser.add_argument("--precisions", type=csv(str), default=list(PRECISIONS), help="comma separated local index precisions")
+    parser.add_argument("--oversampling", type=csv(float), default=[2.0, 4.0, 10.0], help="comma separated rescoring oversampling factors")
+    parser.add_argument("--ivf-nlist", type=csv(int), help="comma separated IVF list counts (default: square root of the catalog size)")
+    parser.add_argument("--ivf-nprobe", type=csv(int), default=[4, 8, 16], help="comma separated IVF lists probed per query")
+    parser.add_argument("--hnsw-m", type=csv(int), default=[4], help="comma separated HNSW m (azure)")
+    parser.add_argument("--hnsw-ef-construction", type=csv(int), default=[400], help="comma separated HNSW efConstruction (azure)")
+    parser.add_argument("--hnsw-ef-search", type=csv(int), default=[500], help="comma separated HNSW efSearch (azure)")
+    parser.add_argument("--azure-compression", type=csv(str), default=["none"], help="comma separated: none, scalar (azure)")
+    parser.add_argument("--azure-index-prefix", default="search-benchmark", help="name prefix of the temporary indexes (azure)")
+    parser.add_argument("--keep-indexes", action="store_true", help="don't delete the temporary indexes (azure)")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args()
+    if unknown := set(args.backends) - set(BACKENDS):
+        parser.error(f"unknown backends: {', '.join(sorted(unknown))}")
+    asyncio.run(main(args))
@@ -0,0 +1,108 @@
+import math
+import re
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Optional
+
+VIENNA_DISTRICTS = [
+    "Innere Stadt", "Leopoldstadt", "Landstraße", "Wieden", "Margareten", "Mariahilf", "Neubau", "Josefstadt",
+    "Alsergrund", "Favoriten", "Simmering", "Meidling", "Hietzing", "Penzing", "Rudolfsheim-Fünfhaus", "Ottakring",
+    "Hernals", "Währing", "Döbling", "Brigittenau", "Floridsdorf", "Donaustadt", "Liesing",
+]
+_DISTRICTS_BY_NAME = {name.casefold(): name for name in VIENNA_DISTRICTS}
+# "7", "1070", "7th district", "7. Bezirk"
+_DISTRICT_NUMBER = re.compile(r"(\d{1,4})(?:st|nd|rd|th|\.)?(?:\s*(?:district|bezirk))?", re.IGNORECASE)
+
+# Tool argument / index field, numeric range constraints
+_RANGES = (("min_price", "max_price", "price"), ("min_rooms", "max_rooms", "rooms"), ("min_size", "max_size", "size"))
+AMENITIES = ("furnished", "pets_allowed", "balcony", "elevator", "smoking_allowed")
+
+def normalize_district(value: str) -> str:
+    """Maps what a voice model tends to say ("neubau", "7th district", "1070") to the district name in the index.
+
+    Raises ValueError for anything that isn't a Vienna district, a filter on it could never match.
+    """
+    value = value.strip()
+    if (name := _DISTRICTS_BY_NAME.get(value.casefold())) is not None:
+        return name
+    match = _DISTRICT_NUMBER.fullmatch(value)
+    if match is not None:
+        number = int(match.group(1))
+        # Postal codes 1010-1230 encode the district in the middle digits
+        if 1010 <= number <= 1239:
+            number = number // 10 % 100
+        if 1 <= number <= len(VIENNA_DISTRICTS):
+            return VIENNA_DISTRICTS[number - 1]
+    raise ValueError(f"Unknown district '{value}', expected one of {', '.join(VIENNA_DISTRICTS)}")
+
+def _odata_string(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+def _odata_number(value: float) -> str:
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError(f"Expected a finite number, got {value!r}")
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class SearchFilters:
+    """Structured listing constraints, compiled to an OData filter for Azure AI Search or a predicate for local backends."""
+    __slots__ = ("ranges", "locations", "amenities")
+
+    def __init__(self, ranges: Optional[Dict[str, tuple[Optional[float], Optional[float]]]] = None,
+                 locations: Optional[Iterable[str]] = None, amenities: Optional[Dict[str, bool]] = None):
+        unknown = set(ranges or ()) - {field for _, _, field in _RANGES} | set(amenities or ()) - set(AMENITIES)
+        if unknown:
+            raise ValueError(f"Unsupported filter fields: {', '.join(sorted(unknown))}")
+        # field -> (minimum, maximum), either may be None
+        self.ranges = {field: bounds for field, bounds in (ranges or {}).items() if bounds != (None, None)}
+        self.locations = tuple(sorted({normalize_district(location) for location in locations or () if location and location.strip()}))
+        self.amenities = dict(amenities or {})
+
+    @staticmethod
+    def from_args(args: Dict[str, Any]) -> "SearchFilters":
+        """Reads the optional constraints of the search tool arguments, ignoring values of the wrong type."""
+        def number(name: str) -> Optional[float]:
+            value = args.get(name)
+            return value if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value) else None
+
+        ranges = {field: (number(low), number(high)) for low, high, field in _RANGES}
+        locations = args.get("locations") or []
+        if isinstance(locations, str):
+            locations = locations.split(",")
+        amenities = {name: args[name] for name in AMENITIES if isinstance(args.get(name), bool)}
+        return SearchFilters(ranges, [location for location in locations if isinstance(location, str)], amenities)
+
+    def __bool__(self) -> bool:
+        return bool(self.ranges or self.locations or self.amenities)
+
+    def key(self) -> tuple:
+        return (tuple(sorted(self.ranges.items())), self.locations, tuple(sorted(self.amenities.items())))
+
+    def to_odata(self) -> Optional[str]:
+        return _compile_odata(self.key()) if self else None
+
+    def matches(self, doc: Dict[str, Any]) -> bool:
+        for field, (low, high) in self.ranges.items():
+            value = doc.get(field)
+            if value is None or (low is not None and value < low) or (high is not None and value > high):
+                return False
+        if self.locations and doc.get("location") not in self.locations:
+            return False
+        return all(doc.get(name) == wanted for name, wanted in self.amenities.items())
+
+@lru_cache(maxsize=1024)
+def _compile_odata(key: tuple) -> str:
+    ranges, locations, amenities = key
+    clauses = []
+    for field, (low, high) in ranges:
+        if low is not None:
+            clauses.append(f"{field} ge {_odata_number(low)}")
+        if high is not None:
+            clauses.append(f"{field} le {_odata_number(high)}")
+    if locations:
+        # search.in is cheaper than a chain of eq's; '|' as delimiter since district names contain spaces
+        if any("|" in location for location in locations):
+            clauses.append("(" + " or ".join(f"location eq {_odata_string(location)}" for location in locations) + ")")
+        else:
+            clauses.append(f"search.in(location, {_odata_string('|'.join(locations))}, '|')")
+    for name, wanted in amenities:
+        clauses.append(f"{name} eq {'true' if wanted else 'false'}")
+    return " and ".join(clauses)
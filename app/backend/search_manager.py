@@ -1,15 +1,72 @@
 import os
+import time
 import dotenv
 import asyncio
-from typing import List, Dict, Any, Optional
+from contextlib import aclosing
+from typing import AsyncIterator, Awaitable, Callable, List, Dict, Any, Optional
 
-from openai import AzureOpenAI
+import httpx
+from openai import AsyncAzureOpenAI
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import VectorizedQuery
+from azure.search.documents.models import VectorFilterMode, VectorizedQuery
+
+from embedding_cache import EmbeddingCache, cache_key, normalize_query
+from ann_index import IVFIndex
+from local_search import LocalVectorIndex
+from metrics import EMBEDDING_SECONDS, SEARCH_SECONDS
+from result_cache import SearchResultCache
+from search_filters import SearchFilters
 
 dotenv.load_dotenv(override=True)
 
+# Everything the search tool hands to the frontend; the embedding in particular is never fetched
+LISTING_FIELDS = ["id", "title", "description", "location", "price", "contact", "rooms", "size", "floor", "availability", "lat", "lng"]
+
+class Listing:
+    __slots__ = ("id", "title", "description", "location", "price", "contact", "rooms", "size", "floor", "availability", "lat", "lng", "score")
+
+    def __init__(self, id: str, title: str = "", description: str = "", location: str = "", price: float = 0.0, contact: str = "",
+                 rooms: int = 0, size: int = 0, floor: int = 0, availability: str = "", lat: float = 0.0, lng: float = 0.0,
+                 score: Optional[float] = None):
+        self.id = id
+        self.title = title
+        self.description = description
+        self.location = location
+        self.price = price
+        self.contact = contact
+        self.rooms = rooms
+        self.size = size
+        self.floor = floor
+        self.availability = availability
+        self.lat = lat
+        self.lng = lng
+        self.score = score
+
+    @staticmethod
+    def from_result(doc: Dict[str, Any]) -> "Listing":
+        return Listing(
+            id=doc.get("id", "unknown_id"),
+            title=doc.get("title") or "",
+            description=doc.get("description") or "",
+            location=doc.get("location") or "",
+            price=doc.get("price") or 0.0,
+            contact=doc.get("contact") or "",
+            rooms=doc.get("rooms") or 0,
+            size=doc.get("size") or 0,
+            floor=doc.get("floor") or 0,
+            availability=doc.get("availability") or "",
+            lat=doc.get("lat") or 0.0,
+            lng=doc.get("lng") or 0.0,
+            score=doc.get("@search.score"),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in LISTING_FIELDS}
+
+async def _collect(results) -> List[Listing]:
+    return [Listing.from_result(doc) async for doc in results]
+
 class SearchManager:
     def __init__(
         self,
@@ -17,9 +74,25 @@ class SearchManager:
         api_key: str,
         index_name: str,
         embedding_model: str,
+        embedding_timeout: float = 10.0,
+        embedding_max_retries: int = 2,
+        max_connections: int = 20,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        local_index: Optional[LocalVectorIndex | IVFIndex] = None,
+        result_cache: Optional[SearchResultCache] = None,
+        embedding_dimensions: Optional[int] = None,
+        oversampling: Optional[float] = None,
     ):
         self.index_name = index_name
         self.embedding_model = embedding_model
+        # Must match the dimensions the index was built with (IndexManager's embedding_dimensions)
+        self.embedding_dimensions = embedding_dimensions
+        # Only valid against an index with vector compression, where it widens the candidates rescored at full precision
+        self.oversampling = oversampling
+        self.embedding_cache = embedding_cache
+        # When set, searches run in-process over this index instead of going to Azure AI Search
+        self.local_index = local_index
+        self.result_cache = result_cache
         self.azure_search_endpoint = f"https://{service_name}.search.windows.net"
         self.azure_search_credential = AzureKeyCredential(api_key)
 
@@ -29,31 +102,177 @@ class SearchManager:
             credential=self.azure_search_credential
         )
 
-        self.azure_openai_client = AzureOpenAI(
+        # One keep-alive pool shared by every embedding request of the worker, so concurrent tool calls
+        # don't each pay for a TLS handshake and never block the event loop
+        self._http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(embedding_timeout, connect=min(embedding_timeout, 5.0))
+        )
+        self.azure_openai_client = AsyncAzureOpenAI(
             api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
             azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_API_KEY")
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            http_client=self._http_client,
+            timeout=embedding_timeout,
+            max_retries=embedding_max_retries
         )
 
-    def _calculate_embedding(self, text: str) -> List[float]:
-        response = self.azure_openai_client.embeddings.create(input=text, model=self.embedding_model)
-        return response.data[0].embedding
-
-    async def search_by_embedding(self, query: str, k: int = 3) -> List[Dict[str, Any]]:
-        query_embedding = self._calculate_embedding(query)
-        vector_query = VectorizedQuery(
-            kind="vector",
-            vector=query_embedding,
-            fields="embedding",
-            k_nearest_neighbors=k,
-            exhaustive=False
-        )
+    async def close(self):
+        await self.azure_openai_client.close()
+        await self.search_client.close()
+        if self.embedding_cache is not None:
+            self.embedding_cache.close()
+
+    def _dimensions_arg(self) -> Dict[str, int]:
+        return {"dimensions": self.embedding_dimensions} if self.embedding_dimensions else {}
+
+    async def _calculate_embedding(self, text: str) -> List[float]:
+        if self.embedding_cache is not None:
+            key = cache_key(text, self.embedding_model, self.embedding_dimensions)
+            if (embedding := await self.embedding_cache.get(key)) is not None:
+                return embedding
+
+        started = time.perf_counter()
+        response = await self.azure_openai_client.embeddings.create(input=text, model=self.embedding_model, **self._dimensions_arg())
+        EMBEDDING_SECONDS.observe(time.perf_counter() - started)
+        embedding = response.data[0].embedding
+
+        if self.embedding_cache is not None:
+            await self.embedding_cache.put(key, embedding)
+        return embedding
+
+    async def _calculate_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Embeds several texts with a single embeddings request for everything not already cached."""
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        keys = [cache_key(text, self.embedding_model, self.embedding_dimensions) for text in texts]
+        missing: Dict[str, List[int]] = {}
+        for i, key in enumerate(keys):
+            if self.embedding_cache is not None and (embedding := await self.embedding_cache.get(key)) is not None:
+                embeddings[i] = embedding
+            else:
+                missing.setdefault(key, []).append(i)
+
+        if missing:
+            # One input per distinct query, "Neubau" and "neubau" share an embedding like they share a cache key
+            inputs = [texts[positions[0]] for positions in missing.values()]
+            started = time.perf_counter()
+            response = await self.azure_openai_client.embeddings.create(input=inputs, model=self.embedding_model, **self._dimensions_arg())
+            EMBEDDING_SECONDS.observe(time.perf_counter() - started)
+            for (key, positions), data in zip(missing.items(), sorted(response.data, key=lambda d: d.index)):
+                for i in positions:
+                    embeddings[i] = data.embedding
+                if self.embedding_cache is not None:
+                    await self.embedding_cache.put(key, data.embedding)
+        return embeddings
+
+    async def _vector_search(self, query_embedding: List[float], k: int, filters: Optional[SearchFilters], method: str) -> AsyncIterator[List[Listing]]:
+        """Yields the top-k listings a page at a time, as the search service returns them."""
+        started = time.perf_counter()
+        try:
+            if self.local_index is not None:
+                yield [Listing.from_result(doc) for doc in self.local_index.search(query_embedding, k, where=filters.matches if filters else None)]
+                return
 
-        results = await self.search_client.search(vector_queries=[vector_query])
-        output = []
-        async for page in results.by_page():
-            async for doc in page:
-                output.append(doc)
+            vector_query = VectorizedQuery(
+                kind="vector",
+                vector=query_embedding,
+                fields="embedding",
+                k_nearest_neighbors=k,
+                exhaustive=False,
+                oversampling=self.oversampling
+            )
+            # Pre-filtering restricts the nearest neighbour search itself, so k matches come back whenever k exist
+            results = await self.search_client.search(
+                vector_queries=[vector_query],
+                filter=filters.to_odata() if filters else None,
+                vector_filter_mode=VectorFilterMode.PRE_FILTER if filters else None,
+                select=LISTING_FIELDS,
+                top=k
+            )
+            count = 0
+            async for page in results.by_page():
+                listings = [Listing.from_result(doc) async for doc in page][:k - count]
+                if listings:
+                    yield listings
+                count += len(listings)
+                # Don't page in more than was asked for
+                if count >= k:
+                    break
+        finally:
+            SEARCH_SECONDS.observe(time.perf_counter() - started, (method,))
+
+    async def _cached(self, key: tuple, compute: Callable[[], Awaitable[List[Listing]]]) -> List[Listing]:
+        if self.result_cache is None:
+            return await compute()
+        return await self.result_cache.get_or_compute(key, compute)
+
+    @staticmethod
+    def _vector_key(query: str, k: int, filters: Optional[SearchFilters]) -> tuple:
+        return ("vector", normalize_query(query), k, filters.key() if filters else ())
+
+    async def _search_vector(self, query: str, k: int, filters: Optional[SearchFilters], method: str) -> List[Listing]:
+        query_embedding = await self._calculate_embedding(query)
+        async with aclosing(self._vector_search(query_embedding, k, filters, method)) as pages:
+            return [listing async for page in pages for listing in page]
+
+    async def search_stream(self, query: str, k: int = 3, filters: Optional[SearchFilters] = None) -> AsyncIterator[List[Listing]]:
+        """Yields the top-k listings a page at a time as the search service returns them, a cached result as one page."""
+        ticket = None
+        if self.result_cache is not None:
+            key = self._vector_key(query, k, filters)
+            while True:
+                if (cached := await self.result_cache.lookup(key)) is not None:
+                    yield cached
+                    return
+                ticket, owner = self.result_cache.begin(key)
+                if owner:
+                    break
+
+        collected = []
+        try:
+            query_embedding = await self._calculate_embedding(query)
+            async with aclosing(self._vector_search(query_embedding, k, filters, "search_stream")) as pages:
+                async for page in pages:
+                    collected.extend(page)
+                    yield page
+        except BaseException:
+            # Also when the consumer stops early, a partial result must not be cached
+            if ticket is not None:
+                self.result_cache.abandon(ticket)
+            raise
+        if ticket is not None:
+            self.result_cache.complete(ticket, collected)
+
+    async def search_by_embedding(self, query: str, k: int = 3) -> List[Listing]:
+        return await self._cached(self._vector_key(query, k, None), lambda: self._search_vector(query, k, None, "search_by_embedding"))
+
+    async def search_many(self, queries: List[str], k: int = 3, filters: Optional[SearchFilters] = None, rrf_k: int = 60) -> List[Listing]:
+        """Searches several queries at once and merges the rankings with reciprocal rank fusion, one entry per listing id."""
+        # A query said twice would be searched twice and count twice in the fusion
+        unique: Dict[str, str] = {}
+        for query in queries:
+            unique.setdefault(normalize_query(query), query)
+        queries = list(unique.values())
+        key = ("many", tuple(unique), k, filters.key() if filters else (), rrf_k)
+        return await self._cached(key, lambda: self._search_many(queries, k, filters, rrf_k))
+
+    async def _search_many(self, queries: List[str], k: int, filters: Optional[SearchFilters], rrf_k: int) -> List[Listing]:
+        query_embeddings = await self._calculate_embeddings(queries)
+
+        async def search(query_embedding: List[float]) -> List[Listing]:
+            async with aclosing(self._vector_search(query_embedding, k, filters, "search_many")) as pages:
+                return [listing async for page in pages for listing in page]
+
+        rankings = await asyncio.gather(*(search(query_embedding) for query_embedding in query_embeddings))
+        fused: Dict[str, float] = {}
+        listings: Dict[str, Listing] = {}
+        for ranking in rankings:
+            for rank, listing in enumerate(ranking):
+                fused[listing.id] = fused.get(listing.id, 0.0) + 1.0 / (rrf_k + rank + 1)
+                listings.setdefault(listing.id, listing)
+        output = sorted(listings.values(), key=lambda listing: fused[listing.id], reverse=True)[:k]
+        for listing in output:
+            listing.score = fused[listing.id]
         return output
 
     async def search_by_filters(
@@ -62,33 +281,34 @@ class SearchManager:
         max_price: Optional[float] = None,
         min_rooms: Optional[int] = None,
         furnished: Optional[bool] = None,
-        pet_friendly: Optional[bool] = None
-    ) -> List[Dict[str, Any]]:
-        # Construct OData filter string
-        filters = []
-        if location:
-            filters.append(f"search.in(location, '{location}', ',')")
-        if max_price is not None:
-            filters.append(f"price le {max_price}")
-        if min_rooms is not None:
-            filters.append(f"rooms ge {min_rooms}")
-        if furnished is not None:
-            filters.append(f"furnished eq {str(furnished).lower()}")
-        if pet_friendly is not None:
-            filters.append(f"pet_friendly eq {str(pet_friendly).lower()}")
-
-        filter_str = " and ".join(filters) if filters else None
+        pet_friendly: Optional[bool] = None,
+        top: int = 50,
+        filters: Optional[SearchFilters] = None
+    ) -> List[Listing]:
+        filters = filters or SearchFilters(
+            ranges={"price": (None, max_price), "rooms": (min_rooms, None)},
+            locations=location.split(",") if location else None,
+            amenities={name: value for name, value in (("furnished", furnished), ("pets_allowed", pet_friendly)) if value is not None}
+        )
+        return await self._cached(("filters", filters.key(), top), lambda: self._search_by_filters(filters, top))
+
+    async def _search_by_filters(self, filters: SearchFilters, top: int) -> List[Listing]:
+        if self.local_index is not None:
+            started = time.perf_counter()
+            output = [Listing.from_result(doc) for doc in self.local_index.filter(filters.matches, top=top)]
+            SEARCH_SECONDS.observe(time.perf_counter() - started, ("search_by_filters",))
+            return output
 
+        started = time.perf_counter()
         results = await self.search_client.search(
             search_text="",
-            filter=filter_str,
+            filter=filters.to_odata(),
             query_type="simple",
-            top=50
+            select=LISTING_FIELDS,
+            top=top
         )
-        output = []
-        async for page in results.by_page():
-            async for doc in page:
-                output.append(doc)
+        output = await _collect(results)
+        SEARCH_SECONDS.observe(time.perf_counter() - started, ("search_by_filters",))
         return output
 
     async def search_with_vector_and_filters(
@@ -96,33 +316,12 @@ class SearchManager:
         text_query: str,
         k: int = 3,
         location: Optional[str] = None,
-        max_price: Optional[float] = None
-    ) -> List[Dict[str, Any]]:
-        query_embedding = self._calculate_embedding(text_query)
-        # Construct OData filter string
-        filters = []
-        if location:
-            filters.append(f"location eq '{location}'")
-        if max_price is not None:
-            filters.append(f"price le {max_price}")
-
-        filter_str = " and ".join(filters) if filters else None
-
-        vector_query = VectorizedQuery(
-            kind="vector",
-            vector=query_embedding,
-            fields="embedding",
-            k_nearest_neighbors=k,
-            filter=filter_str,
-            vector_filter_mode="pre"  # or "post" depending on your requirement
-        )
-
-        results = await self.search_client.search(vector_queries=[vector_query])
-        output = []
-        async for page in results.by_page():
-            async for doc in page:
-                output.append(doc)
-        return output
+        max_price: Optional[float] = None,
+        filters: Optional[SearchFilters] = None
+    ) -> List[Listing]:
+        filters = filters or SearchFilters(ranges={"price": (None, max_price)}, locations=[location] if location else None)
+        return await self._cached(self._vector_key(text_query, k, filters),
+                                  lambda: self._search_vector(text_query, k, filters, "search_with_vector_and_filters"))
 
 if __name__ == "__main__":
 
@@ -137,15 +336,15 @@ if __name__ == "__main__":
     # results = asyncio.run(search_manager.search_by_embedding("stlyiii", k=5))
     # for r in results:
     #     print("---------------------------------------------")
-    #     print(f"Title: {r['title']}")
-    #     print(f"Description: {r['description']}")
-    #     print(f"Location: {r['location']}")
+    #     print(f"Title: {r.title}")
+    #     print(f"Description: {r.description}")
+    #     print(f"Location: {r.location}")
 
     # example of search by filters
-    results = asyncio.run(search_manager.search_by_filters(location="Seattle", max_price=2000.0))
+    results = asyncio.run(search_manager.search_by_filters(location="Neubau", max_price=2000.0))
     for r in results:
         print("---------------------------------------------")
-        print(f"Title: {r['title']}")
-        print(f"Description: {r['description']}")
-        print(f"Location: {r['location']}")
+        print(f"Title: {r.title}")
+        print(f"Description: {r.description}")
+        print(f"Location: {r.location}")
 
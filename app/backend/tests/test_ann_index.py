@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+
+from ann_index import IVFIndex, snapshot_path
+
+def _catalog(n: int = 200, dimensions: int = 16, seed: int = 0) -> tuple[list[dict], np.ndarray]:
+    rng = np.random.default_rng(seed)
+    return [{"id": str(i), "title": f"Listing {i}"} for i in range(n)], rng.standard_normal((n, dimensions)).astype(np.float32)
+
+def _ids(results: list[dict]) -> list[str]:
+    return [result["id"] for result in results]
+
+@pytest.fixture
+def index() -> IVFIndex:
+    documents, embeddings = _catalog()
+    return IVFIndex.build(documents, embeddings, nlist=8)
+
+def test_exhaustive_probe_finds_exact_neighbour(index):
+    documents, embeddings = _catalog()
+    assert _ids(index.search(embeddings[42], k=1, nprobe=index.nlist)) == ["42"]
+
+def test_insert_is_searchable_before_and_after_compact(index):
+    vector = np.random.default_rng(1).standard_normal(16).astype(np.float32)
+    index.insert([{"id": "new", "title": "New listing"}], vector[None, :])
+    assert len(index) == 201
+    assert _ids(index.search(vector, k=1)) == ["new"]
+    index.compact()
+    assert len(index) == 201
+    assert _ids(index.search(vector, k=1, nprobe=index.nlist)) == ["new"]
+
+def test_insert_replaces_listing_with_same_id(index):
+    documents, embeddings = _catalog()
+    index.insert([{"id": "7", "title": "Moved"}], embeddings[8][None, :])
+    assert len(index) == 200
+    results = index.search(embeddings[8], k=2, nprobe=index.nlist)
+    assert sorted(_ids(results)) == ["7", "8"]
+    assert {result["title"] for result in results} == {"Moved", "Listing 8"}
+
+def test_delete_hides_listing_before_and_after_compact(index):
+    documents, embeddings = _catalog()
+    index.delete(["42"])
+    assert len(index) == 199
+    assert "42" not in _ids(index.search(embeddings[42], k=5, nprobe=index.nlist))
+    assert not index.filter(lambda doc: doc["id"] == "42")
+    index.compact()
+    assert len(index) == 199 and len(index.documents) == 199
+    assert "42" not in _ids(index.search(embeddings[42], k=5, nprobe=index.nlist))
+
+@pytest.mark.parametrize("precision, rescore", [("float32", False), ("int8", True)])
+def test_save_load_round_trip(tmp_path, precision, rescore):
+    documents, embeddings = _catalog()
+    index = IVFIndex.build(documents, embeddings, nlist=8, precision=precision, rescore=rescore)
+    index.insert([{"id": "new"}], embeddings[3][None, :] * -1)
+    index.delete(["5"])
+    index.save(str(tmp_path))
+
+    loaded = IVFIndex.load(str(tmp_path), rescore=rescore)
+    assert (loaded.nlist, loaded.precision, len(loaded)) == (8, precision, 200)
+    assert (loaded.originals is not None) == rescore
+    for query in (embeddings[0], embeddings[99], -embeddings[3]):
+        assert _ids(loaded.search(query, k=5, nprobe=8)) == _ids(index.search(query, k=5, nprobe=8))
+
+def test_save_swaps_the_snapshot_pointer(tmp_path, index):
+    directory = str(tmp_path)
+    index.save(directory)
+    first = snapshot_path(directory)
+    index.delete(["1"])
+    index.save(directory)
+    second = snapshot_path(directory)
+    index.delete(["2"])
+    index.save(directory)
+
+    assert len({first, second, snapshot_path(directory)}) == 3
+    # The previous snapshot stays for loads that read the pointer just before the swap, older ones are removed
+    assert not os.path.exists(first) and os.path.exists(second)
+    assert len(IVFIndex.load(directory)) == 198
+
+def test_load_without_snapshot_raises(tmp_path):
+    assert snapshot_path(str(tmp_path)) is None
+    with pytest.raises(FileNotFoundError):
+        IVFIndex.load(str(tmp_path))
@@ -0,0 +1,54 @@
+import asyncio
+from collections import Counter
+from types import SimpleNamespace
+
+from document_uploader import DocumentUploader, _document_bytes, chunk_documents
+
+class StubSearchClient:
+    def __init__(self, failures: dict):
+        # key -> statuses of its failed attempts, in order, then it succeeds
+        self.failures = {key: list(statuses) for key, statuses in failures.items()}
+        self.requests: list[list[str]] = []
+
+    async def upload_documents(self, documents):
+        keys = [doc["id"] for doc in documents]
+        self.requests.append(keys)
+        results = []
+        for key in keys:
+            status = self.failures[key].pop(0) if self.failures.get(key) else 201
+            results.append(SimpleNamespace(key=key, succeeded=status < 300, status_code=status, error_message=f"status {status}"))
+        return results
+
+def test_chunks_split_by_count_and_bytes():
+    docs = [{"id": str(i), "description": "x" * 100} for i in range(5)]
+    assert [len(chunk) for chunk, _ in chunk_documents(docs, max_documents=2)] == [2, 2, 1]
+    size = _document_bytes(docs[0])
+    chunks = list(chunk_documents(docs, max_bytes=size * 3))
+    assert [len(chunk) for chunk, _ in chunks] == [3, 2]
+    assert [chunk_bytes for _, chunk_bytes in chunks] == [size * 3, size * 2]
+
+def test_document_bytes_bounds_the_vectors():
+    doc = {"id": "1", "embedding": [-0.012345678901234567] * 8}
+    assert _document_bytes(doc) >= len('{"id":"1","embedding":[' + ",".join(["-0.012345678901234567"] * 8) + "]}")
+
+def test_only_failed_keys_are_resent(monkeypatch):
+    # No backoff in the test
+    monkeypatch.setattr("document_uploader.random.uniform", lambda low, high: 0.0)
+    client = StubSearchClient({
+        "1": [503],  # transient once
+        "3": [503] * 10,  # never gets through
+        "4": [400],  # not retryable
+    })
+    uploader = DocumentUploader(client, max_batch_documents=2, max_attempts=3)
+    docs = [{"id": str(i), "title": f"Listing {i}"} for i in range(5)]
+
+    failures = asyncio.run(uploader.send("upload_documents", docs))
+
+    assert sorted(failures) == ["3", "4"]
+    assert failures["4"] == "400: status 400"
+    sent = Counter(key for request in client.requests for key in request)
+    assert sent == {"0": 1, "1": 2, "2": 1, "3": 3, "4": 1}
+    # Retries only carry the keys that failed
+    assert sorted(request for request in client.requests if len(request) == 1) == [["1"], ["3"], ["3"], ["4"]]
+    assert (uploader.documents, uploader.requests, uploader.retried, uploader.failed) == (5, 6, 3, 2)
+    assert uploader.summary(1.0).endswith("3 retried, 2 failed")
@@ -0,0 +1,30 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from embedding_batcher import EmbeddingBatcher
+
+class FailingEmbeddings:
+    def __init__(self, error: BaseException):
+        self.error = error
+        self.calls = 0
+
+    async def create(self, input, model, **kwargs):
+        self.calls += 1
+        raise self.error
+
+@pytest.mark.parametrize("error", [ValueError("bad request"), asyncio.CancelledError()])
+def test_failed_request_releases_its_slot(error):
+    async def scenario() -> EmbeddingBatcher:
+        embeddings = FailingEmbeddings(error)
+        batcher = EmbeddingBatcher(SimpleNamespace(embeddings=embeddings), "text-embedding-3-large", max_concurrency=2)
+        with pytest.raises(type(error)):
+            await batcher._embed_batch(["a listing"], 3)
+        # Not retried
+        assert embeddings.calls == 1
+        return batcher
+
+    batcher = asyncio.run(scenario())
+    assert batcher.limiter.active == 0
+    assert batcher.limiter.concurrency == 2
@@ -0,0 +1,75 @@
+import asyncio
+
+from embedding_cache import EmbeddingCache, cache_key
+
+VECTOR = [0.5, -0.25, 0.125, 1.0]
+# float32: 16 bytes per vector
+VECTOR_BYTES = 16
+
+def test_lru_evicts_least_recently_used():
+    async def scenario() -> list:
+        cache = EmbeddingCache(max_memory_bytes=3 * VECTOR_BYTES)
+        for key in ("a", "b", "c"):
+            await cache.put(key, VECTOR)
+        # "a" becomes the most recently used, so "b" goes when "d" comes in
+        assert await cache.get("a") == VECTOR
+        await cache.put("d", VECTOR)
+        found = [key for key in ("a", "b", "c", "d") if await cache.get(key) is not None]
+        assert cache.stats()["evictions"] == 1 and cache.stats()["memory_bytes"] == 3 * VECTOR_BYTES
+        return found
+
+    assert asyncio.run(scenario()) == ["a", "c", "d"]
+
+def test_memory_entries_expire():
+    async def scenario():
+        cache = EmbeddingCache(ttl=0)
+        await cache.put("a", VECTOR)
+        assert await cache.get("a") is None
+        assert cache.stats()["expirations"] == 1 and cache.stats()["memory_bytes"] == 0
+
+    asyncio.run(scenario())
+
+def test_key_includes_model_and_dimensions():
+    key = cache_key("Flats in Neubau, with balcony?", "text-embedding-3-large", 3072)
+    assert key == cache_key("flats in neubau with balcony", "text-embedding-3-large", 3072)
+    assert key != cache_key("flats in neubau with balcony", "text-embedding-3-large", 1024)
+    assert key != cache_key("flats in neubau with balcony", "text-embedding-3-small", 3072)
+    assert cache_key("flat", "text-embedding-3-large") == cache_key("flat", "text-embedding-3-large", None)
+
+def test_store_persists_across_reopening(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+
+    async def write():
+        cache = EmbeddingCache(path)
+        await cache.put("a", VECTOR)
+        cache.close()
+
+    async def read() -> dict:
+        cache = EmbeddingCache(path)
+        try:
+            assert await cache.get("a") == VECTOR
+            # Now also in memory
+            assert await cache.get("a") == VECTOR
+            assert await cache.get("b") is None
+            return cache.stats()
+        finally:
+            cache.close()
+
+    asyncio.run(write())
+    stats = asyncio.run(read())
+    assert (stats["disk_hits"], stats["memory_hits"], stats["misses"]) == (1, 1, 1)
+
+def test_expired_disk_entries_are_not_returned(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+
+    async def scenario():
+        cache = EmbeddingCache(path, disk_ttl=0)
+        await cache.put("a", VECTOR)
+        cache.close()
+        cache = EmbeddingCache(path, disk_ttl=0)
+        try:
+            assert await cache.get("a") is None
+        finally:
+            cache.close()
+
+    asyncio.run(scenario())
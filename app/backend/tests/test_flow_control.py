@@ -0,0 +1,50 @@
+import asyncio
+
+from flow_control import FrameQueue, MemoryBudget
+
+def _queue() -> FrameQueue:
+    return FrameQueue("to_server", high_watermark=100, low_watermark=20, budget=MemoryBudget(10_000))
+
+def test_put_does_not_overtake_a_blocked_writer():
+    async def scenario() -> list:
+        queue = _queue()
+        await queue.put("a" * 60)
+        # Over the high watermark: waits until the queue has drained to 20 bytes
+        flush = asyncio.create_task(queue.put("b" * 50))
+        await asyncio.sleep(0)
+        # Would fit under the high watermark, but must still go after the blocked frame
+        commit = asyncio.create_task(queue.put("c" * 10))
+        await asyncio.sleep(0)
+        assert not flush.done() and not commit.done()
+        frames = [await queue.get() for _ in range(3)]
+        await asyncio.gather(flush, commit)
+        return frames
+
+    assert [frame[0] for frame in asyncio.run(scenario())] == ["a", "b", "c"]
+
+def test_cancelled_writer_lets_the_next_one_through():
+    async def scenario() -> list:
+        queue = _queue()
+        await queue.put("a" * 60)
+        first = asyncio.create_task(queue.put("b" * 50))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(queue.put("c" * 10))
+        await asyncio.sleep(0)
+        first.cancel()
+        frames = [await queue.get()]
+        await asyncio.wait_for(second, timeout=1)
+        return frames + [await queue.get()]
+
+    assert [frame[0] for frame in asyncio.run(scenario())] == ["a", "c"]
+
+def test_close_wakes_blocked_writers():
+    async def scenario():
+        queue = _queue()
+        await queue.put("a" * 60)
+        writer = asyncio.create_task(queue.put("b" * 50))
+        await asyncio.sleep(0)
+        await queue.close()
+        await asyncio.wait_for(writer, timeout=1)
+        assert await queue.get() is None
+
+    asyncio.run(scenario())
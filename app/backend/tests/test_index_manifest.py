@@ -0,0 +1,97 @@
+import asyncio
+from types import SimpleNamespace
+
+from index_manager import IndexManager
+from index_manifest import IndexManifest
+from ingestion import IngestionPipeline
+
+def _text(doc: dict) -> str:
+    return IndexManager._embedding_text(doc)
+
+def _manifest(tmp_path, model: str = "text-embedding-3-large", dimensions=3072) -> IndexManifest:
+    return IndexManifest(str(tmp_path / "index_manifest.json"), "flat-index", model, dimensions)
+
+DOCS = [
+    {"id": "1", "title": "Altbau", "description": "Bright", "price": 1200},
+    {"id": "2", "title": "Loft", "description": "Quiet", "price": 900},
+]
+
+def test_classify(tmp_path):
+    manifest = _manifest(tmp_path)
+    doc = dict(DOCS[0])
+    assert manifest.classify(doc, _text(doc)) == "embed"
+    manifest.record(doc, _text(doc))
+    assert manifest.classify(doc, _text(doc)) == "unchanged"
+    # The stored embedding is not part of the metadata
+    assert manifest.classify({**doc, "embedding": [0.1, 0.2]}, _text(doc)) == "unchanged"
+    assert manifest.classify({**doc, "price": 1100}, _text(doc)) == "merge"
+    changed = {**doc, "description": "Dark"}
+    assert manifest.classify(changed, _text(changed)) == "embed"
+
+def test_stale_and_forget(tmp_path):
+    manifest = _manifest(tmp_path)
+    for doc in DOCS:
+        manifest.record(doc, _text(doc))
+    assert manifest.stale(["1"]) == ["2"]
+    manifest.forget("2")
+    assert manifest.stale(["1"]) == []
+
+def test_saved_manifest_is_reloaded(tmp_path):
+    manifest = _manifest(tmp_path)
+    manifest.record(DOCS[0], _text(DOCS[0]))
+    manifest.save()
+    assert _manifest(tmp_path).classify(DOCS[0], _text(DOCS[0])) == "unchanged"
+
+def test_scope_change_reembeds_but_keeps_ids(tmp_path):
+    manifest = _manifest(tmp_path)
+    for doc in DOCS:
+        manifest.record(doc, _text(doc))
+    manifest.save()
+
+    reloaded = _manifest(tmp_path, dimensions=1024)
+    assert [reloaded.classify(doc, _text(doc)) for doc in DOCS] == ["embed", "embed"]
+    assert reloaded.stale(["1"]) == ["2"]
+
+def test_invalidate_keeps_ids(tmp_path):
+    manifest = _manifest(tmp_path)
+    manifest.record(DOCS[0], _text(DOCS[0]))
+    manifest.invalidate()
+    assert manifest.classify(DOCS[0], _text(DOCS[0])) == "embed"
+    assert manifest.stale([]) == ["1"]
+
+class StubSearchClient:
+    def __init__(self):
+        self.sent: dict[str, list[str]] = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def __getattr__(self, method):
+        async def send(documents):
+            self.sent.setdefault(method, []).extend(doc["id"] for doc in documents)
+            return [SimpleNamespace(key=doc["id"], succeeded=True, status_code=200, error_message=None) for doc in documents]
+        return send
+
+def test_full_sync_after_scope_change_deletes_listings_that_left(tmp_path):
+    manifest = _manifest(tmp_path)
+    for doc in DOCS:
+        manifest.record(doc, _text(doc))
+    manifest.save()
+
+    # A new embedding size, and listing 2 left the catalog; like sync_documents(full=True)
+    manifest = _manifest(tmp_path, dimensions=1024)
+    manifest.invalidate()
+    client = StubSearchClient()
+
+    async def embed(texts):
+        return [[0.1, 0.2] for _ in texts]
+
+    manager = SimpleNamespace(_embedding_text=_text, embedder=SimpleNamespace(embed=embed), search_client=lambda: client)
+    report = asyncio.run(IngestionPipeline(manager, embed_workers=1, upload_workers=1).run([dict(DOCS[0])], manifest))
+
+    assert client.sent == {"upload_documents": ["1"], "delete_documents": ["2"]}
+    assert (report.embedded, report.deleted) == (1, 1)
+    assert _manifest(tmp_path, dimensions=1024).stale([]) == ["1"]
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from ingestion import iter_documents
+
+DOCS = [
+    {"id": "1", "title": "Altbau with a \"view\"", "description": "Rooms {large} and [bright], 3 \\ 4 minutes to the U3"},
+    {"id": "2", "title": "Loft", "tags": ["balcony", "elevator"], "location": {"district": "Neubau"}},
+    {"id": "3", "title": "Studio }]{[", "price": 850.5},
+]
+
+def _write(tmp_path, text: str) -> str:
+    path = tmp_path / "catalog.json"
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, 1 << 16])
+def test_array_split_across_chunks(tmp_path, chunk_size):
+    path = _write(tmp_path, json.dumps(DOCS, indent=2))
+    assert list(iter_documents(path, chunk_size=chunk_size)) == DOCS
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 1 << 16])
+def test_jsonl_with_blank_lines(tmp_path, chunk_size):
+    path = _write(tmp_path, "\n" + "\n\n".join(json.dumps(doc) for doc in DOCS) + "\n\n")
+    assert list(iter_documents(path, chunk_size=chunk_size)) == DOCS
+
+def test_empty_inputs(tmp_path):
+    assert list(iter_documents(_write(tmp_path, ""))) == []
+    assert list(iter_documents(_write(tmp_path, " [ ] \n"))) == []
+
+@pytest.mark.parametrize("text", [
+    '[{"id": "1"}, {"id": "2", "title": "unterminated}]',
+    '{"id": "1"}\n{"id": 2,,}\n',
+    '[{"id": "1"}, {"id": "2"}',
+    '[{"id": "1"}] {"id": "2"}',
+])
+def test_malformed_input_raises(tmp_path, text):
+    path = _write(tmp_path, text)
+    with pytest.raises(ValueError, match="Invalid JSON in .*catalog.json at character"):
+        list(iter_documents(path, chunk_size=4))
+
+def test_non_object_raises(tmp_path):
+    with pytest.raises(ValueError, match="Expected a JSON object"):
+        list(iter_documents(_write(tmp_path, '[{"id": "1"}, 2]')))
@@ -0,0 +1,102 @@
+import asyncio
+from types import SimpleNamespace
+
+from result_cache import SearchResultCache
+
+def test_concurrent_lookups_share_one_computation():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return ["listing"]
+
+    async def scenario() -> list:
+        cache = SearchResultCache()
+        results = await asyncio.gather(*(cache.get_or_compute("query", compute) for _ in range(5)))
+        assert cache.stats()["misses"] == 1 and cache.stats()["coalesced"] == 4
+        return results
+
+    assert asyncio.run(scenario()) == [["listing"]] * 5
+    assert len(calls) == 1
+
+def test_failed_computation_is_taken_over_by_one_waiter():
+    running = []
+    calls = []
+
+    async def compute():
+        running.append(1)
+        calls.append(len(running))
+        try:
+            await asyncio.sleep(0.05)
+            raise RuntimeError("search service unavailable")
+        finally:
+            running.pop()
+
+    async def scenario() -> list:
+        cache = SearchResultCache()
+        results = await asyncio.gather(*(cache.get_or_compute("query", compute) for _ in range(5)), return_exceptions=True)
+        # Every caller ran the computation in turn, none of them was served a shared result
+        assert cache.stats()["coalesced"] == 0 and cache.stats()["misses"] == 5
+        return results
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    # One at a time: the backend never sees the waiters at once
+    assert calls == [1] * 5
+
+def test_failed_computation_handover_coalesces_the_rest():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        if len(calls) == 1:
+            raise RuntimeError("search service unavailable")
+        return ["listing"]
+
+    async def scenario() -> list:
+        cache = SearchResultCache()
+        return await asyncio.gather(*(cache.get_or_compute("query", compute) for _ in range(5)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert isinstance(results[0], RuntimeError)
+    assert results[1:] == [["listing"]] * 4
+    assert len(calls) == 2
+
+def test_generation_change_invalidates_entries():
+    generation = SimpleNamespace(value=1)
+    generation.current = lambda: generation.value
+
+    async def scenario() -> list:
+        cache = SearchResultCache(generation=generation)
+        first = await cache.get_or_compute("query", lambda: asyncio.sleep(0, ["old"]))
+        cached = await cache.get_or_compute("query", lambda: asyncio.sleep(0, ["unused"]))
+        generation.value = 2
+        fresh = await cache.get_or_compute("query", lambda: asyncio.sleep(0, ["new"]))
+        return [first, cached, fresh]
+
+    assert asyncio.run(scenario()) == [["old"], ["old"], ["new"]]
+
+def test_result_computed_against_a_changed_index_is_not_kept():
+    generation = SimpleNamespace(value=1)
+    generation.current = lambda: generation.value
+
+    async def compute():
+        generation.value = 2
+        return ["stale"]
+
+    async def scenario():
+        cache = SearchResultCache(generation=generation)
+        assert await cache.get_or_compute("query", compute) == ["stale"]
+        assert await cache.lookup("query") is None
+
+    asyncio.run(scenario())
+
+def test_expired_entries_are_recomputed():
+    async def scenario() -> list:
+        cache = SearchResultCache(ttl=0)
+        await cache.get_or_compute("query", lambda: asyncio.sleep(0, ["old"]))
+        return await cache.get_or_compute("query", lambda: asyncio.sleep(0, ["new"]))
+
+    assert asyncio.run(scenario()) == ["new"]
@@ -0,0 +1,127 @@
+import asyncio
+import json
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from azure.core.credentials import AzureKeyCredential
+
+from metrics import ACTIVE_SESSIONS
+from rtmt import RTMiddleTier, RTToolCall, Tool, ToolResult, ToolResultDirection
+
+def test_upstream_disconnect_closes_client():
+    async def scenario():
+        async def upstream_handler(request: web.Request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            await ws.receive()
+            # Drop the connection without a close handshake, like a crashed or unreachable upstream
+            request.transport.abort()
+            await asyncio.sleep(5)
+            return ws
+
+        upstream_app = web.Application()
+        upstream_app.router.add_get("/openai/realtime", upstream_handler)
+        async with TestServer(upstream_app) as upstream:
+            rtmt = RTMiddleTier(str(upstream.make_url("/")), "deployment", AzureKeyCredential("key"))
+            # Small enough that the frames below fill the queue once nothing drains it
+            rtmt.queue_high_watermark = 4096
+            rtmt.queue_low_watermark = 1024
+            app = web.Application()
+            rtmt.attach_to_app(app, "/realtime")
+            sessions = ACTIVE_SESSIONS.value()
+            async with TestServer(app) as server, aiohttp.ClientSession() as client:
+                async with client.ws_connect(server.make_url("/realtime")) as ws:
+                    frame = '{"type":"input_audio_buffer.append","audio":"' + "A" * 1000 + '"}'
+                    async def send():
+                        for _ in range(100):
+                            await ws.send_str(frame)
+                            await asyncio.sleep(0.005)
+                    sender = asyncio.create_task(send())
+                    msg = await asyncio.wait_for(ws.receive(), timeout=5)
+                    sender.cancel()
+                    assert msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.CLOSING)
+                for _ in range(100):
+                    if ACTIVE_SESSIONS.value() == sessions:
+                        break
+                    await asyncio.sleep(0.05)
+                assert ACTIVE_SESSIONS.value() == sessions
+
+    asyncio.run(scenario())
+
+def test_streaming_tool_sends_partials_only_for_superseded_results():
+    async def tool_responses(results: list) -> list:
+        async def target(args):
+            for result in results:
+                yield ToolResult(result, ToolResultDirection.TO_CLIENT)
+
+        rtmt = RTMiddleTier("https://example.openai.azure.com", "deployment", AzureKeyCredential("key"))
+        rtmt.tools["search"] = Tool(target=target, schema={})
+        session = rtmt._create_session(None)
+        await rtmt._run_tool({"name": "search", "call_id": "call_1", "arguments": "{}"}, RTToolCall("call_1", "item_0"), None, session)
+        frames = [json.loads(await session.to_client.get()) for _ in range(len(session.to_client))]
+        return [(frame["tool_result"], frame.get("partial", False)) for frame in frames]
+
+    # A search answered with one page of results is one response, not a partial followed by the same final one
+    assert asyncio.run(tool_responses([{"listings": [1, 2]}])) == [('{"listings": [1, 2]}', False)]
+    assert asyncio.run(tool_responses([{"listings": [1]}, {"listings": [1, 2]}])) == [
+        ('{"listings": [1]}', True),
+        ('{"listings": [1, 2]}', False),
+    ]
+
+def test_unknown_tool_still_answers_the_call():
+    async def scenario():
+        async def target(args):
+            return ToolResult("found", ToolResultDirection.TO_SERVER)
+
+        rtmt = RTMiddleTier("https://example.openai.azure.com", "deployment", AzureKeyCredential("key"))
+        rtmt.tools["search"] = Tool(target=target, schema={})
+        session = rtmt._create_session(None)
+        first = asyncio.create_task(rtmt._run_tool(
+            {"name": "book_flight", "call_id": "call_1", "arguments": "{}"}, RTToolCall("call_1", "item_0"), None, session))
+        second = asyncio.create_task(rtmt._run_tool(
+            {"name": "search", "call_id": "call_2", "arguments": "{}"}, RTToolCall("call_2", "item_1"), first, session))
+        await asyncio.wait_for(asyncio.gather(first, second), timeout=5)
+        return [json.loads(await session.to_server.get())["item"] for _ in range(len(session.to_server))]
+
+    outputs = asyncio.run(scenario())
+    assert [output["call_id"] for output in outputs] == ["call_1", "call_2"]
+    assert "There is no 'book_flight' tool" in outputs[0]["output"]
+    assert outputs[1]["output"].endswith("found")
+
+def test_prewarm_pool_recovers_from_unexpected_errors():
+    class FakeUpstream:
+        closed = False
+
+        async def send_json(self, data):
+            pass
+
+        async def close(self):
+            self.closed = True
+
+    async def scenario() -> int:
+        rtmt = RTMiddleTier("https://example.openai.azure.com", "deployment", AzureKeyCredential("key"))
+        rtmt.prewarm_pool_size = 1
+        attempts = 0
+
+        async def connect_upstream(client_request_id=None):
+            nonlocal attempts
+            attempts += 1
+            if attempts == 1:
+                raise RuntimeError("credential unavailable")
+            return FakeUpstream()
+
+        rtmt._connect_upstream = connect_upstream
+        task = asyncio.create_task(rtmt._maintain_prewarmed())
+        try:
+            for _ in range(50):
+                if rtmt._prewarmed:
+                    break
+                await asyncio.sleep(0.1)
+            assert not task.done()
+            return len(rtmt._prewarmed)
+        finally:
+            task.cancel()
+            await asyncio.wait([task])
+
+    assert asyncio.run(scenario()) == 1
@@ -0,0 +1,55 @@
+import pytest
+
+from search_filters import SearchFilters, _odata_string, normalize_district
+
+@pytest.mark.parametrize("value, district", [
+    ("neubau", "Neubau"),
+    ("  DÖBLING ", "Döbling"),
+    ("7th district", "Neubau"),
+    ("1", "Innere Stadt"),
+    ("1070", "Neubau"),
+    ("1230", "Liesing"),
+    ("7. Bezirk", "Neubau"),
+])
+def test_normalize_district(value, district):
+    assert normalize_district(value) == district
+
+@pytest.mark.parametrize("value", ["Seattle", "24th district", "1240", "", "flat 11"])
+def test_normalize_district_rejects_unknown_districts(value):
+    with pytest.raises(ValueError, match="Unknown district"):
+        normalize_district(value)
+
+def test_odata_string_doubles_quotes():
+    assert _odata_string("x' or 1 eq 1 or 'a") == "'x'' or 1 eq 1 or ''a'"
+
+def test_hostile_location_cannot_escape_the_filter():
+    with pytest.raises(ValueError):
+        SearchFilters(locations=["Neubau' or 1 eq 1 or 'a"])
+
+def test_each_clause():
+    assert SearchFilters(ranges={"price": (500, 1200.5)}).to_odata() == "price ge 500 and price le 1200.5"
+    assert SearchFilters(ranges={"rooms": (None, 3)}).to_odata() == "rooms le 3"
+    assert SearchFilters(locations=["Innere Stadt"]).to_odata() == "search.in(location, 'Innere Stadt', '|')"
+    assert SearchFilters(amenities={"furnished": True, "pets_allowed": False}).to_odata() == "furnished eq true and pets_allowed eq false"
+
+def test_combined_filter():
+    filters = SearchFilters(ranges={"size": (40, None), "price": (None, 1500)}, locations=["1070", "wieden"], amenities={"balcony": True})
+    assert filters.to_odata() == (
+        "price le 1500 and size ge 40 and search.in(location, 'Neubau|Wieden', '|') and balcony eq true"
+    )
+    assert filters.matches({"price": 1200, "size": 55, "location": "Wieden", "balcony": True})
+    assert not filters.matches({"price": 1200, "size": 55, "location": "Döbling", "balcony": True})
+    assert not filters.matches({"price": 1200, "location": "Wieden", "balcony": True})
+
+def test_empty_filter():
+    filters = SearchFilters.from_args({"query": "bright flat", "locations": [" "], "min_price": "cheap", "furnished": "yes"})
+    assert not filters
+    assert filters.to_odata() is None
+
+def test_non_finite_numbers_are_rejected():
+    with pytest.raises(ValueError):
+        SearchFilters(ranges={"price": (float("nan"), None)}).to_odata()
+
+def test_unsupported_fields_are_rejected():
+    with pytest.raises(ValueError, match="Unsupported filter fields"):
+        SearchFilters(ranges={"id": (1, 2)})
@@ -0,0 +1,97 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from search_manager import Listing, SearchManager
+
+LATENCY = 0.2
+
+class StubEmbeddings:
+    async def create(self, input, model, **kwargs):
+        await asyncio.sleep(LATENCY)
+        return SimpleNamespace(data=[SimpleNamespace(index=0, embedding=[0.1, 0.2, 0.3])])
+
+class StubResults:
+    def __init__(self, docs):
+        self._docs = iter(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._docs)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def _pages(self):
+        yield self
+
+    def by_page(self):
+        # Azure AI Search returns the top k of a vector query in a single page
+        return self._pages()
+
+class StubSearchClient:
+    async def search(self, **kwargs):
+        await asyncio.sleep(LATENCY)
+        return StubResults([{"id": str(i), "title": f"Listing {i}", "@search.score": 1.0 - i / 10} for i in range(kwargs["top"])])
+
+    async def close(self):
+        pass
+
+def test_concurrent_searches_overlap(monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_API_VERSION", "2024-06-01")
+    monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", "https://example.openai.azure.com")
+    monkeypatch.setenv("AZURE_OPENAI_API_KEY", "key")
+
+    async def scenario() -> float:
+        manager = SearchManager("service", "key", "index", "text-embedding-3-large")
+        manager.azure_openai_client.embeddings = StubEmbeddings()
+        await manager.search_client.close()
+        manager.search_client = StubSearchClient()
+        try:
+            started = time.perf_counter()
+            results = await asyncio.gather(*(manager.search_by_embedding(f"query {i}", k=3) for i in range(10)))
+            elapsed = time.perf_counter() - started
+        finally:
+            await manager.close()
+        assert all([listing.id for listing in listings] == ["0", "1", "2"] for listings in results)
+        return elapsed
+
+    # Each search embeds and then queries the index, one latency each. Run one after the other, ten
+    # searches would take twenty latencies; overlapping, they take about two
+    assert asyncio.run(scenario()) < 4 * LATENCY
+
+def test_search_many_fuses_rankings_once_per_distinct_query(monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_API_VERSION", "2024-06-01")
+    monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", "https://example.openai.azure.com")
+    monkeypatch.setenv("AZURE_OPENAI_API_KEY", "key")
+    rankings = {
+        "bright flat": ["a", "b", "c"],
+        "balcony": ["c", "a", "d"],
+        "quiet street": ["d", "c", "e"],
+    }
+    searched = []
+
+    async def scenario() -> list:
+        manager = SearchManager("service", "key", "index", "text-embedding-3-large", result_cache=None)
+
+        async def calculate_embeddings(queries):
+            return list(queries)
+
+        async def vector_search(query, k, filters, method):
+            searched.append(query)
+            yield [Listing(id) for id in rankings[query][:k]]
+
+        manager._calculate_embeddings = calculate_embeddings
+        manager._vector_search = vector_search
+        try:
+            return await manager.search_many(["bright flat", "balcony", "Bright flat!", "quiet street"], k=3, rrf_k=0)
+        finally:
+            await manager.close()
+
+    results = asyncio.run(scenario())
+    assert sorted(searched) == ["balcony", "bright flat", "quiet street"]
+    # c: 1/3 + 1 + 1/2, a: 1 + 1/2, d: 1/3 + 1, b: 1/2, e: 1/3
+    assert [listing.id for listing in results] == ["c", "a", "d"]
+    assert [round(listing.score, 4) for listing in results] == [1.8333, 1.5, 1.3333]
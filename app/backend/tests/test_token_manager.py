@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import time
+
+from azure.core.credentials import AccessToken
+
+from token_manager import TokenManager
+
+SCOPE = "https://cognitiveservices.azure.com/.default"
+
+class StubCredential:
+    def __init__(self, lifetime: float, fail_after: int = 0, delay: float = 0.0):
+        self.lifetime = lifetime
+        # Every fetch after the first fail_after ones raises, 0 never fails
+        self.fail_after = fail_after
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes):
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+        time.sleep(self.delay)
+        if self.fail_after and call > self.fail_after:
+            raise RuntimeError("credential unavailable")
+        return AccessToken(f"token-{call}", int(time.time() + self.lifetime))
+
+def test_concurrent_requests_share_one_fetch():
+    credential = StubCredential(lifetime=3600, delay=0.1)
+
+    async def scenario() -> list:
+        manager = TokenManager(credential)
+        tokens = await asyncio.gather(*(manager.get_token(SCOPE) for _ in range(10)))
+        # Cached from now on
+        return tokens + [await manager.get_token(SCOPE)]
+
+    assert asyncio.run(scenario()) == ["token-1"] * 11
+    assert credential.calls == 1
+
+def test_token_is_refreshed_before_it_expires():
+    credential = StubCredential(lifetime=3)
+
+    async def scenario() -> list:
+        manager = TokenManager(credential, [SCOPE])
+        manager.expiry_skew = 0
+        await manager.start()
+        try:
+            first = manager.get_cached_token(SCOPE)
+            # Refreshed after half its remaining lifetime at the latest
+            await asyncio.sleep(2)
+            return [first, manager.get_cached_token(SCOPE)]
+        finally:
+            await manager.close()
+
+    assert asyncio.run(scenario()) == ["token-1", "token-2"]
+
+def test_failed_refresh_keeps_the_cached_token():
+    credential = StubCredential(lifetime=5, fail_after=1)
+
+    async def scenario() -> list:
+        manager = TokenManager(credential, [SCOPE])
+        manager.expiry_skew = 0
+        await manager.start()
+        try:
+            await asyncio.sleep(3)
+            assert credential.calls >= 2
+            return [manager.get_cached_token(SCOPE), await manager.get_token(SCOPE)]
+        finally:
+            await manager.close()
+
+    assert asyncio.run(scenario()) == ["token-1", "token-1"]
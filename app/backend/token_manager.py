@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from typing import Iterable, Optional
+
+from aiohttp import web
+from azure.core.credentials import AccessToken, TokenCredential
+
+logger = logging.getLogger("voicerag")
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+SEARCH_SCOPE = "https://search.azure.com/.default"
+
+class TokenManager:
+    """Caches bearer tokens per scope and refreshes them in the background before they expire.
+
+    Credentials from azure.identity are synchronous, so fetches run in a worker thread and never block
+    the event loop. Concurrent requests for the same scope share a single fetch.
+    """
+    # Refresh this long before a token expires
+    refresh_margin: float = 300.0
+    # Tokens this close to expiry are not handed out anymore
+    expiry_skew: float = 30.0
+    # Back-off after a failed background refresh
+    retry_interval: float = 10.0
+
+    def __init__(self, credential: TokenCredential, scopes: Iterable[str] = ()):
+        self.credential = credential
+        self.scopes: list[str] = []
+        self._tokens: dict[str, AccessToken] = {}
+        self._fetches: dict[str, asyncio.Future] = {}
+        self._refresh_tasks: dict[str, asyncio.Task] = {}
+        self._started = False
+        for scope in scopes:
+            self.add_scope(scope)
+
+    def add_scope(self, scope: str):
+        if scope in self.scopes:
+            return
+        self.scopes.append(scope)
+        if self._started:
+            self._refresh_tasks[scope] = asyncio.create_task(self._refresh_loop(scope))
+
+    def get_cached_token(self, scope: str) -> Optional[str]:
+        token = self._tokens.get(scope)
+        if token is not None and token.expires_on - time.time() > self.expiry_skew:
+            return token.token
+        return None
+
+    async def get_token(self, scope: str) -> str:
+        token = self.get_cached_token(scope)
+        if token is not None:
+            return token
+        return (await self._fetch(scope)).token
+
+    async def _fetch(self, scope: str) -> AccessToken:
+        fetch = self._fetches.get(scope)
+        if fetch is None:
+            fetch = asyncio.ensure_future(asyncio.to_thread(self.credential.get_token, scope))
+            self._fetches[scope] = fetch
+            fetch.add_done_callback(lambda f: self._on_fetched(scope, f))
+        # A caller going away must not cancel the fetch other callers are waiting on
+        return await asyncio.shield(fetch)
+
+    def _on_fetched(self, scope: str, fetch: asyncio.Future):
+        del self._fetches[scope]
+        if not fetch.cancelled() and fetch.exception() is None:
+            self._tokens[scope] = fetch.result()
+
+    async def _refresh_loop(self, scope: str):
+        while True:
+            token = self._tokens.get(scope)
+            if token is not None:
+                remaining = token.expires_on - time.time()
+                await asyncio.sleep(max(remaining - self.refresh_margin, remaining / 2, 1))
+            try:
+                await self._fetch(scope)
+            except Exception as e:
+                logger.warning("Failed to refresh token for %s: %s", scope, e)
+                await asyncio.sleep(self.retry_interval)
+
+    async def start(self):
+        if self._started:
+            return
+        self._started = True
+        # Fetch every token up front so the first connection doesn't wait for one
+        await asyncio.gather(*(self._fetch(scope) for scope in self.scopes))
+        for scope in self.scopes:
+            self._refresh_tasks[scope] = asyncio.create_task(self._refresh_loop(scope))
+
+    async def close(self):
+        self._started = False
+        tasks = list(self._refresh_tasks.values())
+        self._refresh_tasks.clear()
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def attach_to_app(self, app: web.Application):
+        app.on_startup.append(lambda _: self.start())
+        app.on_cleanup.append(lambda _: self.close())
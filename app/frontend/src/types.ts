@@ -55,6 +55,7 @@ export type ExtensionMiddleTierToolResponse = {
     previous_item_id: string;
     tool_name: string;
     tool_result: string; // JSON string that needs to be parsed into ToolResult
+    partial?: boolean; // set on intermediate results of streaming tools, a final response follows
 };
 
 export type Listing = {